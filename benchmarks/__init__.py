@@ -0,0 +1,8 @@
+"""
+Performance benchmarks.
+
+These are not run as part of the test suite.  Each module can be run directly,
+for example::
+
+    python -m benchmarks.nvp
+"""
@@ -0,0 +1,165 @@
+"""
+Latency of the Instant Update callback (``ShippingOptionsView``) without
+stored shipping quotes, with quotes stored by the first callback for a
+destination and with the quotes precomputed by ``set_txn``.
+
+PayPal gives up on the callback after ``PAYPAL_CALLBACK_TIMEOUT`` seconds.  Run
+with::
+
+    python -m benchmarks.callback --lines 20
+"""
+from __future__ import print_function
+import argparse
+from decimal import Decimal as D
+import time
+
+from benchmarks import conf
+
+
+def create_basket(num_lines):
+    from django.db.models import get_model
+    from oscar.core.loading import get_class
+    from oscar.test.factories import create_product
+
+    Basket = get_model('basket', 'Basket')
+    Selector = get_class('partner.strategy', 'Selector')
+
+    basket = Basket.objects.create()
+    if Selector:
+        basket.strategy = Selector().strategy()
+    for index in range(num_lines):
+        product = create_product(price=D('12.99'), upc='978014%07d' % index)
+        basket.add_product(product, 1)
+    basket.freeze()
+    return basket
+
+
+def register_txn(basket):
+    """
+    Call set_txn as RedirectView does and return the params sent to PayPal
+    """
+    from django.contrib.auth.models import AnonymousUser
+    from oscar.core.loading import get_class
+
+    from paypal.express import gateway
+
+    Repository = get_class('shipping.repository', 'Repository')
+
+    sent = {}
+
+    def fetch_response(method, params):
+        sent.update(params)
+        return gateway.models.ExpressTransaction(token='EC-8P797793UC466090M')
+
+    methods = Repository().get_shipping_methods(
+        user=AnonymousUser(), basket=basket)
+    original, gateway._fetch_response = gateway._fetch_response, fetch_response
+    try:
+        gateway.set_txn(
+            basket, methods, 'GBP', 'https://example.com/return/',
+            'https://example.com/cancel/',
+            update_url='https://example.com/shipping-options/%d/' % basket.id)
+    finally:
+        gateway._fetch_response = original
+    return sent
+
+
+def callback_data(params):
+    """
+    Return the data that PayPal posts to the callback for a SetExpressCheckout
+    request, once the customer has chosen an address
+    """
+    data = {
+        'METHOD': 'CallbackRequest',
+        'CALLBACKVERSION': '88.0',
+        'CURRENCYCODE': params['PAYMENTREQUEST_0_CURRENCYCODE'],
+        'PAYMENTREQUEST_0_SHIPTOSTREET': '1 Main Terrace',
+        'PAYMENTREQUEST_0_SHIPTOCITY': 'Wolverhampton',
+        'PAYMENTREQUEST_0_SHIPTOCOUNTRY': 'GB',
+        'PAYMENTREQUEST_0_SHIPTOSTATE': 'West Midlands',
+        'PAYMENTREQUEST_0_SHIPTOZIP': 'WV2 4AA',
+    }
+    prefix = 'L_PAYMENTREQUEST_0_'
+    for key, value in params.items():
+        if key.startswith(prefix):
+            data['L_' + key[len(prefix):]] = '%s' % value
+    return data
+
+
+def time_callback(basket, data, samples):
+    """
+    Return the sorted timings (in ms) and the number of queries per request
+    """
+    from django.contrib.auth.models import AnonymousUser
+    from django.db import connection
+    from django.test.client import RequestFactory
+    from django.utils.http import urlencode
+
+    from paypal.express.views import ShippingOptionsView
+
+    view = ShippingOptionsView.as_view()
+    factory = RequestFactory()
+    # PayPal posts the callback form-encoded
+    payload = urlencode(data)
+    timings = []
+    connection.use_debug_cursor = connection.force_debug_cursor = True
+    num_queries = 0
+    for __ in range(samples):
+        request = factory.post(
+            '/', payload, content_type='application/x-www-form-urlencoded')
+        request.user = AnonymousUser()
+        del connection.queries[:]
+        start = time.time()
+        response = view(request, basket_id='%d' % basket.id)
+        timings.append((time.time() - start) * 1000.0)
+        num_queries = len(connection.queries)
+        assert response.status_code == 200
+    connection.use_debug_cursor = connection.force_debug_cursor = False
+    return sorted(timings), num_queries
+
+
+def report(name, timings, num_queries):
+    def percentile(pct):
+        return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+    print("%-28s p50 %7.3fms  p99 %7.3fms  max %7.3fms  %d queries" % (
+        name, percentile(50), percentile(99), timings[-1], num_queries))
+    return percentile(99)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--lines', type=int, default=20,
+                        help="Lines in the basket (default: %(default)s)")
+    parser.add_argument('--samples', type=int, default=500,
+                        help="Callbacks to time (default: %(default)s)")
+    options = parser.parse_args(argv)
+
+    conf.setup(oscar=True)
+    from django.test.utils import override_settings
+
+    basket = create_basket(options.lines)
+    print("Instant update callback - %d basket lines\n" % options.lines)
+
+    # The basket page doesn't know the customer's address, so set_txn only
+    # stores its quotes if they don't depend on the destination.  Otherwise
+    # the first callback for each address calculates them.  The number of
+    # queries is for the last callback.
+    with override_settings(PAYPAL_SHIPPING_QUOTE_CACHE=None):
+        data = callback_data(register_txn(basket))
+        before = report("without stored quotes",
+                        *time_callback(basket, data, options.samples))
+    with override_settings(PAYPAL_SHIPPING_QUOTE_CACHE='local'):
+        data = callback_data(register_txn(basket))
+        by_callback = report("stored by first callback",
+                             *time_callback(basket, data, options.samples))
+    with override_settings(PAYPAL_SHIPPING_QUOTE_CACHE='local',
+                           PAYPAL_SHIPPING_QUOTES_BY_DESTINATION=False):
+        data = callback_data(register_txn(basket))
+        by_set_txn = report("stored by set_txn",
+                            *time_callback(basket, data, options.samples))
+    print("%-28s %.1fx (first callback), %.1fx (set_txn)" % (
+        "p99 speed-up", before / by_callback, before / by_set_txn))
+
+
+if __name__ == '__main__':
+    main()
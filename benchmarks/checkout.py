@@ -0,0 +1,327 @@
+"""
+Throughput of the checkout views against the fake PayPal server.
+
+Drives the Express Checkout flow through the real views - ``RedirectView``,
+the preview page (``SuccessResponseView`` GET), placing the order
+(``SuccessResponseView`` POST) and the Instant Update callback
+(``ShippingOptionsView``) - and the requests made when redirecting to Adaptive
+Payments, with ``benchmarks.fakepaypal`` standing in for PayPal.  For each step
+it reports requests per second, latency percentiles, database queries per
+request and the objects allocated per request.  Run with::
+
+    python -m benchmarks.checkout --checkouts 200 --output results.json
+    python -m benchmarks.checkout --compare results.json
+
+Requests are made one at a time, through Django's test client, so the figures
+are for a single worker.  The fake server adds no latency unless ``--latency``
+is given.
+
+Python 2.7 has no ``tracemalloc``, so allocations are counted as the change in
+the number of objects tracked by the garbage collector over a request, with
+collection disabled.  This counts the container objects (dicts, lists,
+instances...) a request leaves behind, including cyclic garbage, but not ones
+freed by reference counting before it returns.  The objects are counted in
+separate checkouts after the timed ones, as ``gc.get_objects()`` walks the
+whole heap.
+"""
+from __future__ import print_function
+import argparse
+import datetime
+from decimal import Decimal as D
+import gc
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from benchmarks import conf, fakepaypal
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Step(object):
+    """
+    Measurements for one step of the checkout
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.timings = []
+        self.queries = []
+        self.objects = []
+
+    def measure(self, counting, func, *args, **kwargs):
+        from django.db import connection
+
+        del connection.queries[:]
+        if counting:
+            gc.collect()
+            gc.disable()
+            try:
+                before = len(gc.get_objects())
+                result = func(*args, **kwargs)
+                self.objects.append(len(gc.get_objects()) - before)
+            finally:
+                gc.enable()
+            return result
+        start = time.time()
+        result = func(*args, **kwargs)
+        self.timings.append((time.time() - start) * 1000.0)
+        self.queries.append(len(connection.queries))
+        return result
+
+    def summary(self):
+        timings = sorted(self.timings)
+
+        def percentile(pct):
+            index = int(len(timings) * pct / 100.0)
+            return timings[min(len(timings) - 1, index)]
+
+        return {
+            'requests': len(timings),
+            'rps': len(timings) / (sum(timings) / 1000.0),
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'queries_per_request': (
+                float(sum(self.queries)) / len(self.queries)),
+            'objects_per_request': (
+                float(sum(self.objects)) / len(self.objects)
+                if self.objects else None),
+        }
+
+
+def fake_paypal_settings(server):
+    base = 'http://%s:%d' % server.server_address
+    return {
+        'PAYPAL_EXPRESS_API_URL': base + '/nvp',
+        'PAYPAL_EXPRESS_REDIRECT_URL': base + '/webscr',
+        'PAYPAL_ADAPTIVE_API_URL': base,
+        'PAYPAL_PAYFLOW_URL': base + '/payflow',
+        'PAYPAL_API_APPLICATION_ID': 'APP-80W284485P519543T',
+        'PAYPAL_CURRENCY': 'GBP',
+    }
+
+
+def create_products(num_lines):
+    from oscar.test.factories import create_product
+    return [create_product(price=D('12.99'), upc='bench-%d' % index,
+                           num_in_stock=10 ** 9)
+            for index in range(num_lines)]
+
+
+def add_to_basket(client, products):
+    from django.core.urlresolvers import NoReverseMatch, reverse
+
+    for product in products:
+        try:
+            # Oscar 0.8+
+            url = reverse('basket:add', kwargs={'pk': product.pk})
+        except NoReverseMatch:
+            url = reverse('basket:add')
+        client.post(url, {'product_id': product.id, 'quantity': 1})
+
+
+def express_checkout(steps, products, counting):
+    """
+    Go through an Express checkout, from the basket to placing the order
+    """
+    from django.core.urlresolvers import reverse
+    from django.db.models import get_model
+    from django.test.client import Client
+    from django.utils.http import urlencode
+    from django.utils.six.moves.urllib.parse import urlsplit
+    from oscar.core.loading import get_class
+    import requests
+
+    from benchmarks.callback import callback_data, register_txn
+    from paypal import nvp
+
+    Basket = get_model('basket', 'Basket')
+    Selector = get_class('partner.strategy', 'Selector')
+
+    client = Client()
+    add_to_basket(client, products)
+    response = steps['express.redirect'].measure(
+        counting, client.get, reverse('paypal-redirect'))
+    assert response.status_code == 302, response.status_code
+
+    # The customer approves the payment on PayPal and comes back
+    response = requests.get(response['Location'], allow_redirects=False)
+    return_url = urlsplit(response.headers['Location'])
+    query = nvp.decode(return_url.query)
+    basket_id = return_url.path.rstrip('/').rsplit('/', 1)[-1]
+
+    # PayPal asks for shipping options while the customer is on its site
+    basket = Basket.objects.get(id=basket_id)
+    basket.strategy = Selector().strategy()
+    data = callback_data(register_txn(basket))
+    response = steps['express.callback'].measure(
+        counting, client.post,
+        reverse('paypal-shipping-options', kwargs={'basket_id': basket_id}),
+        urlencode(data), content_type='application/x-www-form-urlencoded')
+    assert response.status_code == 200, response.status_code
+
+    response = steps['express.preview'].measure(
+        counting, client.get, '%s?%s' % (return_url.path, return_url.query))
+    assert response.status_code == 200, response.status_code
+
+    response = steps['express.place_order'].measure(
+        counting, client.post,
+        reverse('paypal-place-order', kwargs={'basket_id': basket_id}),
+        {'action': 'place_order', 'payer_id': query['PayerID'],
+         'token': query['token']})
+    assert response.status_code == 302, response.status_code
+
+
+def adaptive_redirect(steps, products, counting):
+    """
+    Make the requests that the Adaptive Payments ``RedirectView`` makes: a Pay
+    request and setting the payment options.
+    """
+    from django.db.models import get_model
+    from oscar.core.loading import get_class
+
+    from paypal.adaptive import facade
+
+    Basket = get_model('basket', 'Basket')
+    Selector = get_class('partner.strategy', 'Selector')
+
+    basket = Basket.objects.create()
+    basket.strategy = Selector().strategy()
+    for product in products:
+        basket.add_product(product, 1)
+    basket = Basket.objects.get(id=basket.id)
+    basket.strategy = Selector().strategy()
+
+    def redirect():
+        receivers = [{'email': 'merchant@example.com', 'is_primary': False,
+                      'amount': basket.total_incl_tax}]
+        url, pay_key = facade.get_pay_request_attrs(
+            receivers, basket, 'PAY', host='example.com')
+        facade.set_transaction_details(pay_key, None, basket=basket)
+
+    steps['adaptive.redirect'].measure(counting, redirect)
+
+
+FLOWS = (
+    ('express', ('express.redirect', 'express.callback', 'express.preview',
+                 'express.place_order'), express_checkout),
+    ('adaptive', ('adaptive.redirect',), adaptive_redirect),
+)
+
+
+def run(options):
+    conf.setup(oscar=True)
+    from django.core.management import call_command
+    from django.db import connection
+    from django.test.utils import override_settings, setup_test_environment
+
+    setup_test_environment()
+    call_command('loaddata', os.path.join(ROOT, 'countries.json'),
+                 verbosity=0)
+    connection.use_debug_cursor = connection.force_debug_cursor = True
+
+    latency, method_latencies = fakepaypal.parse_options(options.latency)
+    server = fakepaypal.start(fakepaypal.FakePayPal(latency, method_latencies))
+    products = create_products(options.lines)
+    steps = {}
+    for name, step_names, func in FLOWS:
+        if name not in options.flows:
+            continue
+        for step_name in step_names:
+            steps[step_name] = Step(step_name)
+        with override_settings(**fake_paypal_settings(server)):
+            for __ in range(options.warmup):
+                func(dict((key, Step(key)) for key in step_names), products,
+                     False)
+            for __ in range(options.checkouts):
+                func(steps, products, False)
+            for __ in range(min(options.checkouts, 20)):
+                func(steps, products, True)
+    server.shutdown()
+    return dict((name, step.summary()) for name, step in steps.items())
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=ROOT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def report(results, baseline=None):
+    print("%-22s %9s %9s %9s %9s %8s %10s" % (
+        'step', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'queries', 'objects'))
+    for name in sorted(results):
+        result = results[name]
+        objects = result['objects_per_request']
+        print("%-22s %9.1f %9.2f %9.2f %9.2f %8.1f %10s" % (
+            name, result['rps'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms'], result['queries_per_request'],
+            '-' if objects is None else '%.0f' % objects))
+        if baseline and name in baseline:
+            old = baseline[name]
+            old_objects = old.get('objects_per_request')
+            print("%-22s %8.1f%% %8.1f%% %8.1f%% %8.1f%% %+8.1f %10s" % (
+                '  vs baseline', change(old['rps'], result['rps']),
+                change(old['p50_ms'], result['p50_ms']),
+                change(old['p95_ms'], result['p95_ms']),
+                change(old['p99_ms'], result['p99_ms']),
+                result['queries_per_request'] - old['queries_per_request'],
+                '-' if objects is None or old_objects is None
+                else '%+.0f' % (objects - old_objects)))
+
+
+def change(old, new):
+    return (new - old) * 100.0 / old if old else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--checkouts', type=int, default=100,
+                        help="Checkouts per flow (default: %(default)s)")
+    parser.add_argument('--warmup', type=int, default=5,
+                        help="Unmeasured checkouts first "
+                             "(default: %(default)s)")
+    parser.add_argument('--lines', type=int, default=3,
+                        help="Lines in each basket (default: %(default)s)")
+    parser.add_argument('--flows', nargs='+', default=[f[0] for f in FLOWS],
+                        choices=[f[0] for f in FLOWS])
+    parser.add_argument('--latency', action='append', default=[],
+                        metavar='[METHOD=]SPEC',
+                        help="Latency of the fake PayPal server "
+                             "(see benchmarks.fakepaypal)")
+    parser.add_argument('--output', help="Write the results to a JSON file")
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help="Compare with the results in a JSON file")
+    options = parser.parse_args(argv)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as f:
+            baseline = json.load(f)['results']
+
+    results = run(options)
+    report(results, baseline)
+
+    if options.output:
+        import django
+        with open(options.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'date': datetime.datetime.utcnow().isoformat() + 'Z',
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'platform': platform.platform(),
+                'options': vars(options),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+        print("\nResults written to %s" % options.output)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,63 @@
+"""
+Django configuration for the benchmarks that need a database.
+
+By default the benchmarks run against a throwaway in-memory SQLite database,
+created the same way as for the test suite.  To benchmark against a real
+database, point ``DJANGO_SETTINGS_MODULE`` at a settings module that includes
+``paypal`` (and Oscar, where needed) in ``INSTALLED_APPS`` - for example
+``sandbox.settings`` - whose tables already exist.
+"""
+import os
+import tempfile
+
+import django
+from django.conf import settings
+
+
+def setup(oscar=False, threads=False):
+    """
+    Configure Django and create the tables.  Returns whether a throwaway
+    database is being used.
+
+    :oscar: Whether Oscar's apps are needed.  If so, the test suite's settings
+            are used.
+    :threads: Whether the database is used from more than one thread.  Each
+              connection to an in-memory SQLite database gets a database of
+              its own, so the throwaway database is put in a temporary file
+              instead.
+    """
+    created = False
+    if (not os.environ.get('DJANGO_SETTINGS_MODULE') and
+            not settings.configured):
+        if oscar:
+            # Importing the test runner configures the test settings
+            import runtests  # noqa
+        else:
+            database = {'ENGINE': 'django.db.backends.sqlite3'}
+            if threads:
+                path = os.path.join(tempfile.mkdtemp(), 'benchmarks.db')
+                database.update(NAME=path, TEST_NAME=path,
+                                OPTIONS={'timeout': 60})
+            settings.configure(
+                DATABASES={
+                    'default': database,
+                },
+                INSTALLED_APPS=[
+                    'django.contrib.auth',
+                    'django.contrib.contenttypes',
+                    'django.contrib.sites',
+                    'paypal',
+                ],
+                SITE_ID=1,
+                PAYPAL_SANDBOX_MODE=True,
+                PAYPAL_API_USERNAME='',
+                PAYPAL_API_PASSWORD='',
+                PAYPAL_API_SIGNATURE='',
+            )
+        created = True
+    if hasattr(django, 'setup'):
+        django.setup()
+    if created:
+        from django.db import connection
+        connection.creation.create_test_db(verbosity=0)
+    return created
@@ -0,0 +1,498 @@
+"""
+A stand-in for PayPal's NVP APIs, for load testing checkout without the
+sandbox.
+
+It implements the Express Checkout methods (SetExpressCheckout,
+GetExpressCheckoutDetails, DoExpressCheckoutPayment, DoCapture, DoVoid,
+RefundTransaction and AddressVerify), the Adaptive Payments actions (Pay,
+SetPaymentOptions, ExecutePayment, PaymentDetails, Refund and
+GetVerifiedStatus), Payflow Pro transactions and IPN verification postbacks,
+with configurable latency and error rates.  Responses contain the fields the
+gateways and views read; amounts are echoed back from the requests and IDs are
+random.  Postbacks are answered ``VERIFIED``, or ``INVALID`` for errors.
+Repeated Express requests with the same ``MSGSUBID`` and Payflow requests with
+the same ``X-VPS-REQUEST-ID`` get the original response back, as they do from
+PayPal (with ``DUPLICATE=1`` for Payflow).
+
+Run with::
+
+    python -m benchmarks.fakepaypal --port 8765 --latency lognormal:80:0.5
+
+and point the gateways at it::
+
+    PAYPAL_EXPRESS_API_URL = 'http://127.0.0.1:8765/nvp'
+    PAYPAL_EXPRESS_REDIRECT_URL = 'http://127.0.0.1:8765/webscr'
+    PAYPAL_ADAPTIVE_API_URL = 'http://127.0.0.1:8765'
+    PAYPAL_PAYFLOW_URL = 'http://127.0.0.1:8765/payflow'
+    PAYPAL_IPN_VERIFY_URL = 'http://127.0.0.1:8765/cgi-bin/webscr'
+
+The redirect URL sends the customer straight back to the ``RETURNURL`` of the
+SetExpressCheckout request, as if they had approved the payment.
+
+Latencies are in milliseconds and can be given per method (or Payflow
+TRXTYPE) as ``METHOD=SPEC``, where SPEC is one of ``fixed:MS``,
+``uniform:MIN:MAX``, ``normal:MEAN:SD``, ``lognormal:MEDIAN:SIGMA`` or
+``exponential:MEAN`` (a plain number means fixed).
+"""
+from __future__ import print_function
+import argparse
+from collections import OrderedDict
+import math
+import random
+import string
+import threading
+import time
+
+from django.utils import six
+from django.utils.six.moves import BaseHTTPServer, socketserver
+from django.utils.six.moves.urllib.parse import urlsplit
+
+from paypal import nvp
+
+DISTRIBUTIONS = {
+    'fixed': lambda ms: lambda: ms,
+    'uniform': lambda low, high: lambda: random.uniform(low, high),
+    'normal': lambda mean, sd: lambda: max(0.0, random.gauss(mean, sd)),
+    'lognormal': lambda median, sigma: lambda: random.lognormvariate(
+        math.log(median), sigma),
+    'exponential': lambda mean: lambda: random.expovariate(1.0 / mean),
+}
+
+# How many tokens, pay keys and replayable responses are remembered
+MAX_STATE = 100000
+
+
+def parse_latency(spec):
+    """
+    Return a function that returns a latency in milliseconds, from a spec such
+    as ``normal:50:10``
+    """
+    name, __, args = spec.partition(':')
+    try:
+        float(name)
+    except ValueError:
+        pass
+    else:
+        name, args = 'fixed', spec
+    if name not in DISTRIBUTIONS:
+        raise ValueError("Unknown latency distribution '%s'" % name)
+    return DISTRIBUTIONS[name](*[float(arg) for arg in args.split(':')])
+
+
+def parse_options(specs):
+    """
+    Return the default latency and the latencies per method for a list of
+    ``[METHOD=]SPEC`` strings
+    """
+    latency, method_latencies = None, {}
+    for spec in specs:
+        method, __, spec = spec.rpartition('=')
+        if method:
+            method_latencies[method] = parse_latency(spec)
+        else:
+            latency = parse_latency(spec)
+    return latency, method_latencies
+
+
+def random_id(length, prefix=''):
+    chars = string.ascii_uppercase + string.digits
+    return prefix + ''.join(random.choice(chars) for __ in range(length))
+
+
+class BoundedDict(OrderedDict):
+    """
+    A dict that forgets its oldest keys
+    """
+
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        if len(self) > MAX_STATE:
+            self.popitem(last=False)
+
+
+class FakePayPal(object):
+    """
+    Builds the responses.  ``respond`` is called by the request handler for
+    each request and returns the status code and body.
+    """
+
+    def __init__(self, latency=None, method_latencies=None, error_rate=0.0,
+                 http_error_rate=0.0):
+        self.latency = latency
+        self.method_latencies = method_latencies or {}
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.checkouts = BoundedDict()
+        self.replies = BoundedDict()
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def respond(self, path, body, headers):
+        path = urlsplit(path).path
+        params = nvp.decode(body, keep_blank_values=True)
+        if path.startswith('/nvp'):
+            method = params.get('METHOD', '')
+            handler = self.express
+            replay_key = params.get('MSGSUBID')
+        elif path.startswith('/payflow'):
+            method = params.get('TRXTYPE', '')
+            handler = self.payflow
+            replay_key = headers.get('X-VPS-REQUEST-ID')
+        elif path.startswith('/cgi-bin/webscr'):
+            method = params.get('cmd', '')
+            handler = self.ipn
+            replay_key = None
+        else:
+            method = path.rstrip('/').rsplit('/', 1)[-1]
+            handler = self.adaptive
+            replay_key = None
+
+        with self.lock:
+            self.counts[method] = self.counts.get(method, 0) + 1
+        self.wait(method)
+        if random.random() < self.http_error_rate:
+            return 503, ''
+
+        if replay_key:
+            replay_key = (method, replay_key)
+            with self.lock:
+                reply = self.replies.get(replay_key)
+            if reply is not None:
+                if handler == self.payflow:
+                    # Payflow flags the responses to repeated requests
+                    reply = '%s&DUPLICATE=1' % reply
+                return 200, reply
+        reply = handler(method, params)
+        if not isinstance(reply, six.string_types):
+            reply = nvp.encode(reply)
+        if replay_key:
+            with self.lock:
+                self.replies[replay_key] = reply
+        return 200, reply
+
+    def redirect(self, path):
+        """
+        Return the URL to send a customer redirected to PayPal on to
+        """
+        query = nvp.decode(urlsplit(path).query)
+        with self.lock:
+            checkout = self.checkouts.get(query.get('token'))
+        if checkout is None:
+            return None
+        separator = '&' if '?' in checkout['RETURNURL'] else '?'
+        return '%s%s%s' % (checkout['RETURNURL'], separator, nvp.encode([
+            ('token', query['token']), ('PayerID', checkout['PAYERID'])]))
+
+    def wait(self, method):
+        latency = self.method_latencies.get(method, self.latency)
+        if latency is not None:
+            time.sleep(latency() / 1000.0)
+
+    def is_error(self):
+        return random.random() < self.error_rate
+
+    # Express Checkout
+
+    def express(self, method, params):
+        handler = getattr(self, 'express_%s' % method, None)
+        if handler is None:
+            return self.express_error(params, '81002', "Unspecified Method")
+        if self.is_error():
+            return self.express_error(params, '10001', "Internal Error")
+        return handler(params)
+
+    def express_envelope(self, params, ack='Success'):
+        return [
+            ('TIMESTAMP', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+            ('CORRELATIONID', random_id(13).lower()),
+            ('ACK', ack),
+            ('VERSION', params.get('VERSION', '')),
+            ('BUILD', '2808426'),
+        ]
+
+    def express_error(self, params, code, message):
+        return self.express_envelope(params, 'Failure') + [
+            ('L_ERRORCODE0', code),
+            ('L_SHORTMESSAGE0', message),
+            ('L_LONGMESSAGE0', message),
+            ('L_SEVERITYCODE0', 'Error'),
+        ]
+
+    def express_SetExpressCheckout(self, params):
+        token = random_id(17, 'EC-')
+        checkout = {
+            'RETURNURL': params.get('RETURNURL', ''),
+            'PAYERID': random_id(13),
+            'AMT': params.get('PAYMENTREQUEST_0_AMT', '0.00'),
+            'CURRENCYCODE': params.get('PAYMENTREQUEST_0_CURRENCYCODE', 'GBP'),
+            'SHIPPINGOPTIONNAME': params.get('L_SHIPPINGOPTIONNAME0', ''),
+            'SHIPPINGAMT': params.get('PAYMENTREQUEST_0_SHIPPINGAMT', '0.00'),
+        }
+        with self.lock:
+            self.checkouts[token] = checkout
+        return [('TOKEN', token)] + self.express_envelope(params)
+
+    def express_GetExpressCheckoutDetails(self, params):
+        token = params.get('TOKEN')
+        with self.lock:
+            checkout = self.checkouts.get(token)
+        if checkout is None:
+            return self.express_error(params, '10410', "Invalid token")
+        pairs = [('TOKEN', token)] + self.express_envelope(params) + [
+            ('CHECKOUTSTATUS', 'PaymentActionNotInitiated'),
+            ('EMAIL', 'buyer@example.com'),
+            ('PAYERID', checkout['PAYERID']),
+            ('PAYERSTATUS', 'verified'),
+            ('FIRSTNAME', 'Test'),
+            ('LASTNAME', 'Buyer'),
+            ('COUNTRYCODE', 'GB'),
+            ('CURRENCYCODE', checkout['CURRENCYCODE']),
+            ('AMT', checkout['AMT']),
+            ('SHIPPINGAMT', checkout['SHIPPINGAMT']),
+            ('PAYMENTREQUEST_0_CURRENCYCODE', checkout['CURRENCYCODE']),
+            ('PAYMENTREQUEST_0_AMT', checkout['AMT']),
+            ('PAYMENTREQUEST_0_SHIPPINGAMT', checkout['SHIPPINGAMT']),
+            ('PAYMENTREQUEST_0_SHIPTONAME', 'Test Buyer'),
+            ('PAYMENTREQUEST_0_SHIPTOSTREET', '1 Main Terrace'),
+            ('PAYMENTREQUEST_0_SHIPTOCITY', 'Wolverhampton'),
+            ('PAYMENTREQUEST_0_SHIPTOSTATE', 'West Midlands'),
+            ('PAYMENTREQUEST_0_SHIPTOZIP', 'W12 4LQ'),
+            ('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE', 'GB'),
+        ]
+        if checkout['SHIPPINGOPTIONNAME']:
+            pairs.append(('SHIPPINGOPTIONNAME',
+                          checkout['SHIPPINGOPTIONNAME']))
+        return pairs
+
+    def express_DoExpressCheckoutPayment(self, params):
+        action = params.get('PAYMENTREQUEST_0_PAYMENTACTION', 'Sale')
+        return [('TOKEN', params.get('TOKEN', ''))] + \
+            self.express_envelope(params) + [
+                ('PAYMENTINFO_0_TRANSACTIONID', random_id(17)),
+                ('PAYMENTINFO_0_TRANSACTIONTYPE', 'expresscheckout'),
+                ('PAYMENTINFO_0_PAYMENTTYPE', 'instant'),
+                ('PAYMENTINFO_0_AMT', params.get('PAYMENTREQUEST_0_AMT', '')),
+                ('PAYMENTINFO_0_CURRENCYCODE',
+                 params.get('PAYMENTREQUEST_0_CURRENCYCODE', '')),
+                ('PAYMENTINFO_0_PAYMENTSTATUS',
+                 'Completed' if action == 'Sale' else 'Pending'),
+                ('PAYMENTINFO_0_ACK', 'Success'),
+            ]
+
+    def express_DoCapture(self, params):
+        return [('AUTHORIZATIONID', params.get('AUTHORIZATIONID', ''))] + \
+            self.express_envelope(params) + [
+                ('TRANSACTIONID', random_id(17)),
+                ('AMT', params.get('AMT', '')),
+                ('CURRENCYCODE', params.get('CURRENCYCODE', '')),
+                ('PAYMENTSTATUS', 'Completed'),
+            ]
+
+    def express_DoVoid(self, params):
+        return [('AUTHORIZATIONID', params.get('AUTHORIZATIONID', ''))] + \
+            self.express_envelope(params)
+
+    def express_RefundTransaction(self, params):
+        return [('REFUNDTRANSACTIONID', random_id(17))] + \
+            self.express_envelope(params) + [
+                ('GROSSREFUNDAMT', params.get('AMT', '')),
+                ('CURRENCYCODE', params.get('CURRENCYCODE', '')),
+                ('REFUNDSTATUS', 'Instant'),
+            ]
+
+    def express_AddressVerify(self, params):
+        return self.express_envelope(params) + [
+            ('CONFIRMATIONCODE', 'Confirmed'),
+            ('STREETMATCH', 'Matched'),
+            ('ZIPMATCH', 'Matched'),
+            ('COUNTRYCODE', 'GB'),
+        ]
+
+    # Adaptive Payments and Accounts
+
+    def adaptive(self, action, params):
+        handler = getattr(self, 'adaptive_%s' % action, None)
+        if handler is None:
+            return self.adaptive_error('580001', "Invalid request")
+        if self.is_error():
+            return self.adaptive_error('520002', "Internal error")
+        return self.adaptive_envelope() + handler(params)
+
+    def adaptive_envelope(self, ack='Success'):
+        return [
+            ('responseEnvelope.timestamp',
+             time.strftime('%Y-%m-%dT%H:%M:%S.000-00:00', time.gmtime())),
+            ('responseEnvelope.ack', ack),
+            ('responseEnvelope.correlationId', random_id(13).lower()),
+            ('responseEnvelope.build', '2486531'),
+        ]
+
+    def adaptive_error(self, code, message):
+        return self.adaptive_envelope('Failure') + [
+            ('error(0).errorId', code),
+            ('error(0).domain', 'PLATFORM'),
+            ('error(0).severity', 'Error'),
+            ('error(0).category', 'Application'),
+            ('error(0).message', message),
+        ]
+
+    def adaptive_Pay(self, params):
+        return [('payKey', random_id(17, 'AP-')),
+                ('paymentExecStatus', 'CREATED')]
+
+    def adaptive_SetPaymentOptions(self, params):
+        return []
+
+    def adaptive_ExecutePayment(self, params):
+        return [('paymentExecStatus', 'COMPLETED')]
+
+    def adaptive_PaymentDetails(self, params):
+        return [('payKey', params.get('payKey', '')),
+                ('status', 'COMPLETED'),
+                ('currencyCode', 'USD')]
+
+    def adaptive_Refund(self, params):
+        pairs = [('currencyCode', params.get('currencyCode', 'USD'))]
+        index = 0
+        while 'receiverList.receiver(%d).email' % index in params:
+            prefix = 'refundInfoList.refundInfo(%d).' % index
+            pairs.extend([
+                (prefix + 'receiver.email',
+                 params['receiverList.receiver(%d).email' % index]),
+                (prefix + 'receiver.amount',
+                 params.get('receiverList.receiver(%d).amount' % index, '')),
+                (prefix + 'refundStatus', 'REFUNDED'),
+            ])
+            index += 1
+        return pairs
+
+    def adaptive_GetVerifiedStatus(self, params):
+        return [
+            ('accountStatus', 'VERIFIED'),
+            ('userInfo.emailAddress', 'seller@example.com'),
+            ('userInfo.name.firstName', params.get('firstName', '')),
+            ('userInfo.name.lastName', params.get('lastName', '')),
+        ]
+
+    # Payflow Pro
+
+    def payflow(self, trxtype, params):
+        if self.is_error():
+            return [('RESULT', '12'), ('PNREF', random_id(12)),
+                    ('RESPMSG', 'Declined')]
+        pairs = [('RESULT', '0'), ('PNREF', random_id(12)),
+                 ('RESPMSG', 'Approved')]
+        if trxtype in ('S', 'A'):
+            pairs.extend([('AUTHCODE', random_id(6)), ('AVSADDR', 'Y'),
+                          ('AVSZIP', 'Y'), ('CVV2MATCH', 'Y')])
+        return pairs
+
+    # IPN verification
+
+    def ipn(self, cmd, params):
+        if cmd != '_notify-validate':
+            return ''
+        return 'INVALID' if self.is_error() else 'VERIFIED'
+
+
+class RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    # Keep connections alive, as PayPal does
+    protocol_version = 'HTTP/1.1'
+    # Send each response in one go, rather than a packet per header
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        status, content = self.server.paypal.respond(
+            self.path, body, self.headers)
+        self.reply(status, content)
+
+    def do_GET(self):
+        url = None
+        if self.path.startswith('/webscr'):
+            url = self.server.paypal.redirect(self.path)
+        if url is None:
+            self.reply(404, '')
+        else:
+            self.reply(302, '', [('Location', url)])
+
+    def reply(self, status, content, headers=()):
+        if isinstance(content, six.text_type):
+            content = content.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/plain; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(
+                self, format, *args)
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, address, paypal, verbose=False):
+        BaseHTTPServer.HTTPServer.__init__(self, address, RequestHandler)
+        self.paypal = paypal
+        self.verbose = verbose
+
+
+def start(paypal=None, host='127.0.0.1', port=0):
+    """
+    Start a server in a background thread and return it.  Its URL is
+    ``'http://%s:%d' % server.server_address``.
+    """
+    server = Server((host, port), paypal or FakePayPal())
+    thread = threading.Thread(target=server.serve_forever,
+                              name='fake-paypal')
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument(
+        '--latency', action='append', default=[], metavar='[METHOD=]SPEC',
+        help="Latency distribution, for all methods or just one")
+    parser.add_argument(
+        '--error-rate', type=float, default=0.0,
+        help="Fraction of requests that get an error response")
+    parser.add_argument(
+        '--http-error-rate', type=float, default=0.0,
+        help="Fraction of requests that get a 503")
+    parser.add_argument('--seed', type=int,
+                        help="Seed for the random number generator")
+    parser.add_argument('--verbose', action='store_true',
+                        help="Log each request")
+    options = parser.parse_args(argv)
+
+    if options.seed is not None:
+        random.seed(options.seed)
+    latency, method_latencies = parse_options(options.latency)
+    paypal = FakePayPal(latency, method_latencies, options.error_rate,
+                        options.http_error_rate)
+    server = Server((options.host, options.port), paypal, options.verbose)
+    print("Fake PayPal listening on http://%s:%d" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        for method, count in sorted(paypal.counts.items()):
+            print("%-28s %d" % (method, count))
+
+
+if __name__ == '__main__':
+    main()
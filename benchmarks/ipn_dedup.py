@@ -0,0 +1,134 @@
+"""
+Storing IPN messages when the same messages are delivered many times at once,
+as they are when PayPal retries.
+
+Each message is stored ``--deliveries`` times from ``--threads`` threads in
+parallel, in a random order.  Reports the rate and latency of storing
+deliveries, and fails unless each message was stored once with every delivery
+counted and its handlers run once.  Run with::
+
+    python -m benchmarks.ipn_dedup --messages 500 --deliveries 10 --threads 16
+
+SQLite serialises writes, so use ``DJANGO_SETTINGS_MODULE`` to measure against
+the database you run in production.
+"""
+from __future__ import print_function
+import argparse
+from multiprocessing.pool import ThreadPool
+import random
+import sys
+import threading
+import time
+import uuid
+
+from benchmarks import conf
+
+
+def raw_message(run_id, index):
+    return (
+        'mc_gross=19.95&payment_status=Completed&mc_currency=GBP&'
+        'txn_id=%s%06d&receiver_email=seller%%40example.com&'
+        'txn_type=express_checkout&test_ipn=1&'
+        'verify_sign=AtkOfCXbDm2hu0ZELryHFjY-Vb7PAUvS6nMXgysbElEn9v' % (
+            run_id, index))
+
+
+def percentile(timings, pct):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+
+def run_in_threads(func, items, num_threads):
+    from django.db import connection
+
+    def call(item):
+        try:
+            return func(item)
+        finally:
+            connection.close()
+
+    pool = ThreadPool(num_threads)
+    try:
+        return pool.map(call, items, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--messages', type=int, default=500,
+                        help="Number of distinct messages (default: "
+                             "%(default)s)")
+    parser.add_argument('--deliveries', type=int, default=10,
+                        help="Deliveries of each message (default: "
+                             "%(default)s)")
+    parser.add_argument('--threads', type=int, default=16,
+                        help="Number of threads (default: %(default)s)")
+    options = parser.parse_args(argv)
+
+    conf.setup(threads=True)
+    from django.db.models import Sum
+
+    from paypal.ipn import receiver, signals
+    from paypal.ipn.models import PaymentMessage
+
+    # Keeps the messages apart from those of other runs
+    run_id = uuid.uuid4().hex[:10].upper()
+    deliveries = [raw_message(run_id, index)
+                  for index in range(options.messages)
+                  for __ in range(options.deliveries)]
+    random.shuffle(deliveries)
+
+    def store(raw):
+        start = time.time()
+        receiver.store(raw)
+        return (time.time() - start) * 1000.0
+
+    start = time.time()
+    timings = run_in_threads(store, deliveries, options.threads)
+    elapsed = time.time() - start
+    print("Stored %d deliveries of %d messages from %d threads in %.2fs "
+          "(%.0f deliveries/s)" % (
+              len(deliveries), options.messages, options.threads, elapsed,
+              len(deliveries) / elapsed))
+    print("    p50 %.3fms  p99 %.3fms" % (
+        percentile(timings, 50), percentile(timings, 99)))
+
+    messages = PaymentMessage.objects.filter(transaction_id__startswith=run_id)
+    num_rows = messages.count()
+    num_deliveries = messages.aggregate(
+        total=Sum('delivery_count'))['total'] or 0
+
+    # Process every delivery, as if each had been verified separately
+    messages.update(verification_status=PaymentMessage.VERIFIED)
+    ids = list(messages.values_list('id', flat=True)) * options.deliveries
+    random.shuffle(ids)
+    handled = []
+    lock = threading.Lock()
+
+    def handler(sender, message, **kwargs):
+        with lock:
+            handled.append(message.id)
+
+    signals.payment_message_verified.connect(handler)
+    try:
+        run_in_threads(receiver.process, ids, options.threads)
+    finally:
+        signals.payment_message_verified.disconnect(handler)
+
+    failures = 0
+    for name, expected, actual in (
+            ("rows", options.messages, num_rows),
+            ("deliveries counted", len(deliveries), num_deliveries),
+            ("handler calls", options.messages, len(handled))):
+        ok = expected == actual
+        if not ok:
+            failures += 1
+        print("%s: %d (expected %d)  %s" % (
+            name, actual, expected, "OK" if ok else "MISMATCH"))
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Latency of the transaction lookups made by the Express and Payflow facades
+against large audit tables.
+
+Seeds the ``ExpressTransaction`` and ``PayflowTransaction`` tables, prints the
+query plan for each lookup and fails if its 99th percentile latency exceeds the
+budget.  Run with::
+
+    python -m benchmarks.lookups --orders 1000000 --max-ms 5
+
+The tables are seeded with three Express transactions per token and two Payflow
+transactions per order number.
+"""
+from __future__ import print_function
+import argparse
+from decimal import Decimal as D
+import random
+import sys
+import time
+
+from benchmarks import conf
+
+
+def seed(num_orders, batch_size=5000):
+    from paypal.express.models import ExpressTransaction
+    from paypal.payflow import codes
+    from paypal.payflow.models import PayflowTransaction
+
+    for start in range(0, num_orders, batch_size):
+        express_txns, payflow_txns = [], []
+        for index in range(start, min(start + batch_size, num_orders)):
+            token = 'EC-%017d' % index
+            for method in ('SetExpressCheckout', 'GetExpressCheckoutDetails',
+                           'DoExpressCheckoutPayment'):
+                express_txns.append(ExpressTransaction(
+                    method=method, version='88.0', ack='Success',
+                    token=token, amount=D('12.99'), currency='GBP',
+                    raw_request='METHOD=%s' % method,
+                    raw_response='TOKEN=%s&ACK=Success' % token,
+                    response_time=100))
+            order_number = '%d' % (100000 + index)
+            for trxtype in (codes.AUTHORIZATION, codes.DELAYED_CAPTURE):
+                payflow_txns.append(PayflowTransaction(
+                    comment1=order_number, trxtype=trxtype, tender='C',
+                    amount=D('12.99'), pnref='V%s%s' % (trxtype, index),
+                    result='0', respmsg='Approved',
+                    raw_request='TRXTYPE=%s' % trxtype,
+                    raw_response='RESULT=0&RESPMSG=Approved',
+                    response_time=100))
+        ExpressTransaction.objects.bulk_create(express_txns)
+        PayflowTransaction.objects.bulk_create(payflow_txns)
+
+
+def lookups(num_orders):
+    """
+    Return (name, queryset factory, lookup function) triples for the lookups
+    made by the facades
+    """
+    from paypal.express import facade as express_facade
+    from paypal.payflow import codes
+    from paypal.payflow.models import PayflowTransaction
+
+    def random_token():
+        return 'EC-%017d' % random.randrange(num_orders)
+
+    def random_order_number():
+        return '%d' % (100000 + random.randrange(num_orders))
+
+    return [
+        ("express: token + method",
+         lambda: express_facade.Transaction.objects.filter(
+             token=random_token(), method=express_facade.DO_EXPRESS_CHECKOUT),
+         lambda: express_facade._get_payment_txn(random_token())),
+        ("payflow: comment1 + trxtype",
+         lambda: PayflowTransaction.objects.filter(
+             comment1=random_order_number(), trxtype=codes.AUTHORIZATION),
+         lambda: PayflowTransaction.objects.get(
+             comment1=random_order_number(), trxtype=codes.AUTHORIZATION)),
+        ("payflow: comment1 + trxtype__in",
+         lambda: PayflowTransaction.objects.filter(
+             comment1=random_order_number(),
+             trxtype__in=(codes.AUTHORIZATION, codes.SALE)),
+         lambda: PayflowTransaction.objects.get(
+             comment1=random_order_number(),
+             trxtype__in=(codes.AUTHORIZATION, codes.SALE))),
+    ]
+
+
+def explain(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    if connection.vendor == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    cursor = connection.cursor()
+    cursor.execute(prefix + sql, params)
+    return [' '.join('%s' % col for col in row) for row in cursor.fetchall()]
+
+
+def percentile(timings, pct):
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--orders', type=int, default=200000,
+                        help="Number of orders to seed (default: %(default)s)")
+    parser.add_argument('--samples', type=int, default=2000,
+                        help="Lookups per query (default: %(default)s)")
+    parser.add_argument('--max-ms', type=float, default=5.0,
+                        help="Budget for the p99 latency "
+                             "(default: %(default)s)")
+    parser.add_argument('--no-seed', action='store_true',
+                        help="Use the existing rows rather than seeding")
+    options = parser.parse_args(argv)
+
+    created = conf.setup()
+    if created or not options.no_seed:
+        start = time.time()
+        seed(options.orders)
+        print("Seeded %d orders in %.1fs\n" % (
+            options.orders, time.time() - start))
+
+    failures = 0
+    for name, queryset, lookup in lookups(options.orders):
+        print(name)
+        for line in explain(queryset()):
+            print("    plan: %s" % line)
+        timings = []
+        for __ in range(options.samples):
+            start = time.time()
+            lookup()
+            timings.append((time.time() - start) * 1000.0)
+        p50, p99 = percentile(timings, 50), percentile(timings, 99)
+        ok = p99 <= options.max_ms
+        if not ok:
+            failures += 1
+        print("    p50 %.3fms  p99 %.3fms  %s\n" % (
+            p50, p99, "OK" if ok else "OVER BUDGET (%.1fms)" % options.max_ms))
+    return failures
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Microbenchmarks for the NVP codec against the stdlib path it replaced.
+
+Uses a realistic SetExpressCheckout request and GetExpressCheckoutDetails
+response for a basket with 100 lines.  Run with::
+
+    python -m benchmarks.nvp
+"""
+from __future__ import print_function
+from collections import OrderedDict
+from decimal import Decimal as D
+import timeit
+
+from django.utils.encoding import force_text
+from django.utils.http import urlencode
+from django.utils.six.moves.urllib.parse import parse_qs
+
+from paypal import nvp
+
+NUM_LINES = 100
+
+
+def set_express_checkout_params(num_lines=NUM_LINES):
+    params = OrderedDict([
+        ('METHOD', 'SetExpressCheckout'),
+        ('VERSION', '88.0'),
+        ('USER', 'test_1332777813_biz_api1.gmail.com'),
+        ('PWD', '1332777837'),
+        ('SIGNATURE',
+         'A22DCxaCv-WeMRC6ke.fAabwPrYNAH6IkVF8xxY9XZI3Qtl0q-2XLULA'),
+        ('RETURNURL', 'https://example.com/checkout/paypal/preview/1234/'),
+        ('CANCELURL', 'https://example.com/checkout/paypal/cancel/1234/'),
+        ('CALLBACK',
+         'https://example.com/checkout/paypal/shipping-options/1234/'),
+        ('CALLBACKTIMEOUT', 3),
+        ('ALLOWNOTE', 1),
+        ('PAYMENTREQUEST_0_PAYMENTACTION', 'Sale'),
+        ('PAYMENTREQUEST_0_CURRENCYCODE', 'GBP'),
+    ])
+    for index in range(num_lines):
+        params['L_PAYMENTREQUEST_0_NAME%d' % index] = (
+            u'Product № %d - The Complete Works' % index)
+        params['L_PAYMENTREQUEST_0_NUMBER%d' % index] = '978014%07d' % index
+        params['L_PAYMENTREQUEST_0_DESC%d' % index] = (
+            'A hardback edition with illustrations, notes & an index '
+            'of characters ...')
+        params['L_PAYMENTREQUEST_0_AMT%d' % index] = D('12.99')
+        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
+    params['PAYMENTREQUEST_0_ITEMAMT'] = D('12.99') * num_lines
+    params['PAYMENTREQUEST_0_AMT'] = D('12.99') * num_lines
+    params['PAYMENTREQUEST_0_SHIPPINGAMT'] = D('0.00')
+    params['PAYMENTREQUEST_0_TAXAMT'] = D('0.00')
+    params['PAYMENTREQUEST_0_HANDLINGAMT'] = D('0.00')
+    return params
+
+
+def get_express_checkout_response(num_lines=NUM_LINES):
+    params = OrderedDict([
+        ('TOKEN', 'EC-6WY34243AN3588740'),
+        ('CHECKOUTSTATUS', 'PaymentActionNotInitiated'),
+        ('TIMESTAMP', '2012-04-19T10:07:46Z'),
+        ('CORRELATIONID', '7e9c5efbda3c0'),
+        ('ACK', 'Success'),
+        ('VERSION', '88.0'),
+        ('BUILD', '2808426'),
+        ('EMAIL', 'david._1332854868_per@gmail.com'),
+        ('PAYERID', '7ZTRBDFYYA47W'),
+        ('PAYERSTATUS', 'verified'),
+        ('FIRSTNAME', 'David'),
+        ('LASTNAME', 'Winterbottom'),
+        ('COUNTRYCODE', 'GB'),
+        ('PAYMENTREQUEST_0_SHIPTONAME', 'David Winterbottom'),
+        ('PAYMENTREQUEST_0_SHIPTOSTREET', '1 Main Terrace'),
+        ('PAYMENTREQUEST_0_SHIPTOCITY', 'Wolverhampton'),
+        ('PAYMENTREQUEST_0_SHIPTOSTATE', 'West Midlands'),
+        ('PAYMENTREQUEST_0_SHIPTOZIP', 'W12 4LQ'),
+        ('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE', 'GB'),
+        ('PAYMENTREQUEST_0_CURRENCYCODE', 'GBP'),
+        ('PAYMENTREQUEST_0_AMT', '1299.00'),
+    ])
+    for index in range(num_lines):
+        params['L_PAYMENTREQUEST_0_NAME%d' % index] = (
+            'Product %d - The Complete Works' % index)
+        params['L_PAYMENTREQUEST_0_NUMBER%d' % index] = '978014%07d' % index
+        params['L_PAYMENTREQUEST_0_QTY%d' % index] = '1'
+        params['L_PAYMENTREQUEST_0_TAXAMT%d' % index] = '0.00'
+        params['L_PAYMENTREQUEST_0_AMT%d' % index] = '12.99'
+        params['L_PAYMENTREQUEST_0_DESC%d' % index] = (
+            'A hardback edition with illustrations, notes & an index '
+            'of characters ...')
+    return urlencode(params).encode('utf-8')
+
+
+def stdlib_decode(content):
+    # This is how paypal.gateway.post used to decode responses
+    pairs = {}
+    for key, values in parse_qs(content).items():
+        pairs[force_text(key)] = force_text(values[0])
+    return pairs
+
+
+def report(name, func, number=200):
+    best = min(timeit.repeat(func, number=number, repeat=5))
+    per_call = best / number * 1000000.0
+    print("%-40s %10.1f usec/call" % (name, per_call))
+    return per_call
+
+
+def main():
+    params = set_express_checkout_params()
+    content = get_express_checkout_response()
+    print("NVP codec - %d line items (%d request params, %d response bytes)\n"
+          % (NUM_LINES, len(params), len(content)))
+
+    assert urlencode(params) == nvp.encode(params)
+    assert stdlib_decode(content) == dict(nvp.decode(content))
+
+    old = report("encode: django.utils.http.urlencode",
+                 lambda: urlencode(params))
+    new = report("encode: paypal.nvp.encode", lambda: nvp.encode(params))
+    print("%-40s %10.2fx\n" % ("speed-up", old / new))
+
+    old = report("decode: parse_qs + force_text",
+                 lambda: stdlib_decode(content))
+    new = report("decode: paypal.nvp.decode", lambda: nvp.decode(content))
+    print("%-40s %10.2fx\n" % ("speed-up", old / new))
+
+    # Transaction models parse the raw response text loaded from the database
+    text = force_text(content)
+    old = report("model value(): parse_qs", lambda: parse_qs(text)['ACK'][0])
+    new = report("model value(): paypal.nvp.decode_multi",
+                 lambda: nvp.decode_multi(text)['ACK'][0])
+    print("%-40s %10.2fx" % ("speed-up", old / new))
+
+
+if __name__ == '__main__':
+    main()
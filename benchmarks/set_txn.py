@@ -0,0 +1,98 @@
+"""
+CPU time spent by ``paypal.express.gateway.set_txn`` building the
+SetExpressCheckout request for baskets of different sizes.
+
+The call to PayPal is replaced so only parameter building is measured.  Run
+with::
+
+    python -m benchmarks.set_txn
+"""
+from __future__ import print_function
+from decimal import Decimal as D
+import time
+import timeit
+
+from benchmarks import conf
+
+BASKET_SIZES = (1, 50, 500)
+
+
+class Product(object):
+
+    def __init__(self, index):
+        self.pk = index
+        self.upc = '978014%07d' % index
+        self.title = 'Product %d - The Complete Works' % index
+        self.description = (
+            '<p>A hardback edition with <em>illustrations</em>, notes and an '
+            'index of characters.  Part %d of the collected works.</p>'
+            % index)
+
+    def get_title(self):
+        return self.title
+
+
+class Line(object):
+
+    def __init__(self, index):
+        self.product = Product(index)
+        self.unit_price_incl_tax = D('12.99')
+        self.quantity = 1
+
+
+class Basket(object):
+    """
+    Just enough of Oscar's basket for set_txn
+    """
+    id = 1
+    voucher_discounts = ()
+    shipping_discounts = ()
+
+    def __init__(self, num_lines):
+        self.lines = [Line(index) for index in range(num_lines)]
+        self.total_incl_tax = D('12.99') * num_lines - D('1.00')
+        self.offer_discounts = [{'name': '1 off', 'discount': D('1.00')}]
+
+    def all_lines(self):
+        return self.lines
+
+
+class ShippingMethod(object):
+    name = 'Royal Mail'
+    charge_incl_tax = D('2.50')
+
+
+def process_time():
+    # time.process_time is Python 3.3+
+    return getattr(time, 'process_time', time.clock)()
+
+
+def main():
+    conf.setup()
+    from paypal.express import gateway
+
+    def fetch_response(method, params):
+        return gateway.models.ExpressTransaction(token='EC-8P797793UC466090M')
+
+    gateway._fetch_response = fetch_response
+    methods = [ShippingMethod()]
+
+    print("set_txn CPU time\n")
+    for num_lines in BASKET_SIZES:
+        basket = Basket(num_lines)
+
+        def call():
+            gateway.set_txn(basket, methods, 'GBP',
+                            'https://example.com/return/1/',
+                            'https://example.com/cancel/1/',
+                            update_url='https://example.com/shipping/1/')
+
+        number = max(10, 2000 // num_lines)
+        best = min(timeit.repeat(call, timer=process_time, number=number,
+                                 repeat=5))
+        print("%4d lines %12.1f usec/call" % (
+            num_lines, best / number * 1000000.0))
+
+
+if __name__ == '__main__':
+    main()
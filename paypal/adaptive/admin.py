@@ -19,6 +19,12 @@ class TxnAdmin(admin.ModelAdmin):
         'raw_request',
         'raw_response',
         'response_time',
+        'encode_time',
+        'connect_time',
+        'connection_reused',
+        'ttfb',
+        'read_time',
+        'decode_time',
         'payment_exec_status',
         'date_created',
     ]
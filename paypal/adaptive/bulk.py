@@ -0,0 +1,150 @@
+"""
+Paying the secondary receivers of delayed chained payments in bulk.
+
+With ``PAY_PRIMARY`` chained payments, the secondary receivers are only paid
+once ExecutePayment is called for the pay key.  ``BulkExecutor`` finds the pay
+keys whose payment is still ``INCOMPLETE`` - reading them in batches of
+increasing ID so that the ``(payment_exec_status, id)`` index serves every
+query - and executes them on a bounded pool of threads, at no more than a
+given rate.
+
+After each batch, the ID reached is written to an optional checkpoint file, so
+an interrupted run can carry on where it left off.  Pay keys that already have
+a successful ExecutePayment are skipped, so at most the batch that was in
+flight is looked at again.
+"""
+import json
+import logging
+from multiprocessing.pool import ThreadPool
+import os
+import time
+
+from paypal.adaptive import facade
+from paypal.adaptive.models import AdaptiveTransaction
+from paypal.exceptions import PayPalError
+from paypal.workers import RateLimiter
+
+logger = logging.getLogger('paypal.adaptive')
+
+EXECUTED, FAILED, SKIPPED = 'executed', 'failed', 'skipped'
+
+
+class Checkpoint(object):
+    """
+    The progress of a run, saved to a JSON file
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.last_id = 0
+        self.counts = {EXECUTED: 0, FAILED: 0, SKIPPED: 0}
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            self.last_id = data['last_id']
+            self.counts.update(data['counts'])
+
+    def save(self):
+        if not self.path:
+            return
+        # Write to a temporary file first, so a crash can't leave a truncated
+        # checkpoint behind
+        temp_path = '%s.tmp' % self.path
+        with open(temp_path, 'w') as f:
+            json.dump({'last_id': self.last_id, 'counts': self.counts}, f)
+        os.rename(temp_path, self.path)
+
+
+def iter_batches(start_id=0, batch_size=500):
+    """
+    Yield ``(last_id, pay_keys)`` for the pay keys of incomplete payments, in
+    batches ordered by transaction ID.  A pay key is only yielded once per
+    batch.
+    """
+    last_id = start_id
+    while True:
+        rows = list(AdaptiveTransaction.objects.filter(
+            payment_exec_status=AdaptiveTransaction.INCOMPLETE,
+            id__gt=last_id).order_by('id').values_list(
+                'id', 'pay_key')[:batch_size])
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        pay_keys = []
+        for __, pay_key in rows:
+            if pay_key and pay_key not in pay_keys:
+                pay_keys.append(pay_key)
+        yield last_id, pay_keys
+
+
+def executed_pay_keys(pay_keys):
+    """
+    Return the pay keys, out of those given, whose payment has already been
+    executed
+    """
+    return set(AdaptiveTransaction.objects.filter(
+        pay_key__in=pay_keys, action='ExecutePayment',
+        ack__in=(AdaptiveTransaction.SUCCESS,
+                 AdaptiveTransaction.SUCCESS_WITH_WARNING)).values_list(
+                     'pay_key', flat=True))
+
+
+class BulkExecutor(object):
+    """
+    Calls ExecutePayment for every incomplete chained payment
+    """
+
+    def __init__(self, workers=4, rate=None, batch_size=500, limit=None,
+                 checkpoint=None, progress=None):
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate)
+        self.batch_size = batch_size
+        self.limit = limit
+        self.checkpoint = checkpoint or Checkpoint()
+        # Called with the checkpoint and the number of seconds elapsed after
+        # each batch
+        self.progress = progress
+
+    def execute(self, pay_key):
+        self.rate_limiter.wait()
+        try:
+            facade.pay_secondary_receivers(pay_key)
+        except PayPalError as e:
+            logger.error("Unable to execute payment %s: %s", pay_key, e)
+            return FAILED
+        return EXECUTED
+
+    def run(self):
+        """
+        Execute the payments and return the checkpoint with the counts
+        """
+        checkpoint = self.checkpoint
+        start_time = time.time()
+        attempted = 0
+        pool = ThreadPool(self.workers)
+        try:
+            for last_id, pay_keys in iter_batches(checkpoint.last_id,
+                                                  self.batch_size):
+                done = executed_pay_keys(pay_keys)
+                pending = [key for key in pay_keys if key not in done]
+                if self.limit is not None:
+                    remaining = self.limit - attempted
+                    if remaining < len(pending):
+                        # Stop part-way through the batch, without moving the
+                        # checkpoint past what hasn't been looked at
+                        pending = pending[:remaining]
+                        last_id = None
+                for result in pool.map(self.execute, pending):
+                    checkpoint.counts[result] += 1
+                attempted += len(pending)
+                if last_id is None:
+                    break
+                checkpoint.counts[SKIPPED] += len(done)
+                checkpoint.last_id = last_id
+                checkpoint.save()
+                if self.progress is not None:
+                    self.progress(checkpoint, time.time() - start_time)
+        finally:
+            pool.close()
+            pool.join()
+        return checkpoint
@@ -1,6 +1,5 @@
 from django.conf import settings
-from django.contrib.sites.models import Site
-from django.core.urlresolvers import reverse
+from paypal import refdata
 from paypal.adaptive.gateway import (
     pay, payment_details, set_payment_option,
     execute_payment, get_account_info, refund_payment
@@ -19,16 +18,14 @@ def get_pay_request_attrs(receivers, basket, action, host=None,
     """
     currency = getattr(settings, 'PAYPAL_CURRENCY', 'GBP')
     if host is None:
-        host = Site.objects.get_current().domain
+        host = refdata.get_domain()
     if scheme is None:
         use_https = getattr(settings, 'PAYPAL_CALLBACK_HTTPS', True)
         scheme = 'https' if use_https else 'http'
     return_url = '%s://%s%s' % (
-        scheme, host, reverse('paypal-success-response', kwargs={
-            'basket_id': basket.id}))
+        scheme, host, refdata.get_path('paypal-success-response', basket.id))
     cancel_url = '%s://%s%s' % (
-        scheme, host, reverse('paypal-cancel-response', kwargs={
-            'basket_id': basket.id}))
+        scheme, host, refdata.get_path('paypal-cancel-response', basket.id))
     #if getattr(settings, 'PAYPAL_SANDBOX_MODE', False):
     #    ipn_url = settings.PAYPAL_SANDBOX_IPN_URL % basket.id
     #else:
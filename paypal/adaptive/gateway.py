@@ -7,7 +7,7 @@ from collections import OrderedDict
 from django.utils.translation import ugettext as _
 from decimal import Decimal as D
 from django.conf import settings
-from paypal import gateway, models
+from paypal import gateway, metrics, models, snapshot
 from paypal import exceptions
 import logging
 
@@ -92,12 +92,12 @@ def set_payment_option(basket, pay_key, shipping_address=None):
             params.append(('senderOptions.shippingAddress.phone.type', 'MOBILE'))
 
     if basket:
+        contents = snapshot.BasketSnapshot(basket)
         index = 0
-        for index, line in enumerate(basket.all_lines()):
-            product = line.product
-            params.append(('receiverOptions[0].invoiceData.item[%d].name' % index, product.get_title()))
-            params.append(('receiverOptions[0].invoiceData.item[%d].identifier' % index, product.upc if
-                                                             product.upc else ''))
+        for index, line in enumerate(contents.lines):
+            params.append(('receiverOptions[0].invoiceData.item[%d].name' % index, line.title))
+            params.append(('receiverOptions[0].invoiceData.item[%d].identifier' % index, line.upc if
+                                                             line.upc else ''))
             # Note, we don't include discounts here - they are handled as separate
             # lines - see below
             params.append(('receiverOptions[0].invoiceData.item[%d].price' % index, _format_currency(
@@ -105,14 +105,14 @@ def set_payment_option(basket, pay_key, shipping_address=None):
             params.append(('receiverOptions[0].invoiceData.item[%d].itemCount' % index, line.quantity))
 
         # Iterate over the 3 types of discount that can occur
-        for discount in basket.offer_discounts:
+        for discount in contents.offer_discounts:
             index += 1
             name = _("Special Offer: %s") % discount['name']
             params.append(('receiverOptions[0].invoiceData.item[%d].name' % index, name))
             params.append(('receiverOptions[0].invoiceData.item[%d].price' % index, _format_currency(
                 -discount['discount'])))
             params.append(('receiverOptions[0].invoiceData.item[%d].itemCount' % index, 1))
-        for discount in basket.voucher_discounts:
+        for discount in contents.voucher_discounts:
             index += 1
             name = "%s (%s)" % (discount['voucher'].name,
                                 discount['voucher'].code)
@@ -120,7 +120,7 @@ def set_payment_option(basket, pay_key, shipping_address=None):
             params.append(('receiverOptions[0].invoiceData.item[%d].price' % index, _format_currency(
                 -discount['discount'])))
             params.append(('receiverOptions[0].invoiceData.item[%d].itemCount' % index, 1))
-        for discount in basket.shipping_discounts:
+        for discount in contents.shipping_discounts:
             index += 1
             name = _("Shipping Offer: %s") % discount['name']
             params.append(('receiverOptions[0].invoiceData.item[%d].name' % index, name))
@@ -217,12 +217,20 @@ def _request(action, params, api=Adaptive_Payments, headers=None, txn_fields=Non
     """
     Make a request to PayPal
     """
-    error = False
-    msg = ''
+    url, param_dict, request_headers, is_sandbox = _build_request(
+        action, params, api, headers)
+    with metrics.track('adaptive', action):
+        pairs = gateway.post(url, param_dict, request_headers)
+    return _record_response(action, param_dict, pairs, is_sandbox, txn_fields)
+
+
+def _build_request(action, params, api=Adaptive_Payments, headers=None):
+    """
+    Return the URL, parameters, headers and sandbox flag for a request to
+    PayPal
+    """
     if headers is None:
         headers = {}
-    if txn_fields is None:
-        txn_fields = {}
     request_headers = {
         'X-PAYPAL-SECURITY-USERID': settings.PAYPAL_API_USERNAME,
         'X-PAYPAL-SECURITY-PASSWORD': settings.PAYPAL_API_PASSWORD,
@@ -241,19 +249,32 @@ def _request(action, params, api=Adaptive_Payments, headers=None, txn_fields=Non
     params.extend(common_params)
 
     if getattr(settings, 'PAYPAL_SANDBOX_MODE', False):
-        url = 'https://svcs.sandbox.paypal.com/%s/%s'
+        url = 'https://svcs.sandbox.paypal.com'
         is_sandbox = True
     else:
-        url = 'https://svcs.paypal.com/%s/%s'
+        url = 'https://svcs.paypal.com'
         is_sandbox = False
+    url = getattr(settings, 'PAYPAL_ADAPTIVE_API_URL', url)
 
-    url = url % (api, action)
+    url = '%s/%s/%s' % (url, api, action)
 
     # We use an OrderedDict as the key-value pairs have to be in the correct
     # order(!).  Otherwise, PayPal returns error 'Invalid request: {0}'
     # with errorId 580001.  All very silly.
     param_dict = OrderedDict(params)
-    pairs = gateway.post(url, param_dict, request_headers)
+    return url, param_dict, request_headers, is_sandbox
+
+
+def _record_response(action, param_dict, pairs, is_sandbox, txn_fields=None):
+    """
+    Record the response from PayPal and return the transaction object.  An
+    exception is raised if the transaction wasn't successful.
+    """
+    error = False
+    msg = ''
+    fields = metrics.model_fields(pairs)
+    if txn_fields is not None:
+        fields.update(txn_fields)
 
     # Record transaction data - we save this model whether the txn
     # was successful or not
@@ -270,9 +291,9 @@ def _request(action, params, api=Adaptive_Payments, headers=None, txn_fields=Non
         payment_exec_status=pairs.get('paymentExecStatus', None),
         error_code=pairs.get('error(0).errorId', None),
         error_message=pairs.get('error(0).message', None),
-        **txn_fields)
+        **fields)
 
-    txn.save()
+    metrics.save(txn, 'adaptive', action, pairs)
 
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
@@ -295,5 +316,3 @@ def _request(action, params, api=Adaptive_Payments, headers=None, txn_fields=Non
         raise exceptions.PayPalError(msg)
 
     return txn
-
-
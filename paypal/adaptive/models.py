@@ -38,6 +38,9 @@ class AdaptiveTransaction(base.ResponseModel):
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        # Incomplete payments are read in batches of increasing ID when paying
+        # secondary receivers in bulk
+        index_together = [('payment_exec_status', 'id')]
 
     def __unicode__(self):
         return self.correlation_id
@@ -0,0 +1,178 @@
+"""
+Persistence of the transaction models that audit each call to PayPal.
+
+By default each transaction is saved as soon as the response is received.  With
+``PAYPAL_AUDIT_WRITE_BEHIND`` enabled, transactions for methods that don't move
+money are instead buffered in a bounded in-process queue and written by a
+background thread using ``bulk_create``, either when a batch fills up or when
+the flush interval passes.  Transactions for the methods listed in
+``PAYPAL_AUDIT_DURABLE_METHODS`` are always written synchronously.
+"""
+import atexit
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.test.signals import setting_changed
+from django.utils.six.moves import queue
+
+logger = logging.getLogger('paypal.audit')
+
+# Express and Adaptive methods, plus all Payflow TRXTYPEs (sale,
+# authorization, delayed capture, credit and void).
+DEFAULT_DURABLE_METHODS = (
+    'DoExpressCheckoutPayment', 'DoCapture', 'DoVoid', 'RefundTransaction',
+    'Pay', 'ExecutePayment', 'Refund',
+    'S', 'A', 'D', 'C', 'V',
+)
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+class AuditWriter(object):
+    """
+    Buffers transactions and writes them in batches from a background thread
+    """
+
+    def __init__(self, max_size, batch_size, interval):
+        self.queue = queue.Queue(max_size)
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pid = os.getpid()
+        self.thread = threading.Thread(target=self.run,
+                                       name='paypal-audit-writer')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+
+    def put(self, txn):
+        try:
+            self.queue.put_nowait(txn)
+        except queue.Full:
+            # Never drop an audit record - write it ourselves instead
+            logger.warning(
+                "Audit queue is full - saving %s synchronously", txn)
+            txn.save()
+
+    def run(self):
+        while True:
+            txn = self.queue.get()
+            if txn is None:
+                return
+            batch = [txn]
+            deadline = time.time() + self.interval
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    txn = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if txn is None:
+                    self.write(batch)
+                    return
+                batch.append(txn)
+            self.write(batch)
+
+    def flush(self):
+        """
+        Write everything that is currently buffered, in the calling thread
+        """
+        batch = []
+        while True:
+            try:
+                txn = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if txn is None:
+                # Leave the stop marker for the background thread
+                self.queue.put(None)
+                break
+            batch.append(txn)
+        if batch:
+            self.write(batch)
+
+    def write(self, batch):
+        by_model = OrderedDict()
+        for txn in batch:
+            by_model.setdefault(type(txn), []).append(txn)
+        for model, txns in by_model.items():
+            try:
+                model.objects.bulk_create(txns)
+            except Exception:
+                # Most likely a dropped database connection - reconnect and
+                # fall back to saving each transaction on its own.
+                logger.exception("Unable to bulk-write %d %s records",
+                                 len(txns), model.__name__)
+                connection.close()
+                for txn in txns:
+                    try:
+                        txn.save()
+                    except Exception:
+                        logger.exception("Unable to write audit record %s",
+                                         txn)
+
+
+def _get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None or _writer.pid != os.getpid():
+            _writer = AuditWriter(
+                max_size=getattr(settings, 'PAYPAL_AUDIT_QUEUE_SIZE', 1000),
+                batch_size=getattr(settings, 'PAYPAL_AUDIT_BATCH_SIZE', 100),
+                interval=getattr(settings, 'PAYPAL_AUDIT_FLUSH_INTERVAL', 1.0))
+            _writer.start()
+        return _writer
+
+
+def is_durable(method):
+    return method in getattr(settings, 'PAYPAL_AUDIT_DURABLE_METHODS',
+                             DEFAULT_DURABLE_METHODS)
+
+
+def save(txn, method):
+    """
+    Persist a transaction model for a call to the given PayPal method (or
+    Payflow TRXTYPE).
+    """
+    if not getattr(settings, 'PAYPAL_AUDIT_WRITE_BEHIND', False) \
+            or is_durable(method):
+        txn.save()
+        return
+    # bulk_create doesn't call save() so sensitive data has to be masked here
+    txn.mask_sensitive_data()
+    _get_writer().put(txn)
+
+
+def flush():
+    """
+    Write all buffered transactions now
+    """
+    if _writer is not None and _writer.pid == os.getpid():
+        _writer.flush()
+
+
+atexit.register(flush)
+
+
+def _reset_writer_on_setting_change(setting, **kwargs):
+    global _writer
+    if setting.startswith('PAYPAL_AUDIT_'):
+        with _writer_lock:
+            if _writer is not None:
+                _writer.flush()
+                _writer.stop()
+                _writer = None
+
+
+setting_changed.connect(_reset_writer_on_setting_change)
@@ -1,9 +1,23 @@
-from django.utils.encoding import force_text
-import urlparse
 from django.utils.translation import ugettext_lazy as _
 
 from django.db import models
 
+from paypal import nvp
+from paypal.ipn import fields
+
+
+def _parse_cached(instance, raw, decode, **kwargs):
+    """
+    Return the parsed NVP pairs for the raw text of a model instance, as
+    returned by ``decode(raw, **kwargs)``.
+
+    The parsed mapping is cached on the instance and only recomputed when the
+    raw text changes.  Callers shouldn't modify it.
+    """
+    cached = instance.__dict__.get('_parsed_nvp')
+    if cached is None or cached[0] != raw:
+        cached = instance._parsed_nvp = (raw, decode(raw, **kwargs))
+    return cached[1]
 
 class ResponseModel(models.Model):
 
@@ -13,6 +27,27 @@ class ResponseModel(models.Model):
 
     response_time = models.FloatField(help_text=_("Response time in milliseconds"))
 
+    # Breakdown of the response time (see paypal.metrics)
+    encode_time = models.FloatField(
+        null=True, blank=True,
+        help_text=_("Time spent encoding the request, in milliseconds"))
+    connect_time = models.FloatField(
+        null=True, blank=True,
+        help_text=_("Time spent opening the connection (including the TLS "
+                    "handshake), in milliseconds"))
+    connection_reused = models.NullBooleanField(
+        help_text=_("Whether a pooled connection was reused"))
+    ttfb = models.FloatField(
+        null=True, blank=True,
+        help_text=_("Time to the first byte of the response, in "
+                    "milliseconds"))
+    read_time = models.FloatField(
+        null=True, blank=True,
+        help_text=_("Time spent reading the response, in milliseconds"))
+    decode_time = models.FloatField(
+        null=True, blank=True,
+        help_text=_("Time spent decoding the response, in milliseconds"))
+
     date_created = models.DateTimeField(auto_now_add=True)
 
     class Meta:
@@ -20,8 +55,21 @@ class ResponseModel(models.Model):
         ordering = ('-date_created',)
         app_label = 'paypal'
 
+    # Whether responses can contain Payflow length-tagged values
+    nvp_length_tagged = False
+
+    def save(self, *args, **kwargs):
+        self.mask_sensitive_data()
+        return super(ResponseModel, self).save(*args, **kwargs)
+
+    def mask_sensitive_data(self):
+        """
+        Remove credentials and card details from the raw request before it is
+        stored
+        """
+
     def request(self):
-        request_params = urlparse.parse_qs(self.raw_request)
+        request_params = nvp.decode_multi(self.raw_request)
         return self._as_dl(request_params)
     request.allow_tags = True
 
@@ -43,11 +91,12 @@ class ResponseModel(models.Model):
 
     @property
     def context(self):
-        return urlparse.parse_qs(self.raw_response)
+        return _parse_cached(self, self.raw_response, nvp.decode_multi,
+                             length_tagged=self.nvp_length_tagged)
 
     def value(self, key, default=None):
         ctx = self.context
-        return force_text(ctx[key][0]) if key in ctx else default
+        return ctx[key][0] if key in ctx else default
 
 class IPNMessageModel(models.Model):
 
@@ -80,8 +129,9 @@ class IPNMessageModel(models.Model):
 
     @property
     def context(self):
-        return urlparse.parse_qs(self.raw_message)
+        # Decoded using the charset named in the message
+        return _parse_cached(self, self.raw_message, fields.decode, multi=True)
 
     def value(self, key, default=None):
         ctx = self.context
-        return force_text(ctx[key][0]) if key in ctx else default
\ No newline at end of file
+        return ctx[key][0] if key in ctx else default
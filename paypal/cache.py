@@ -0,0 +1,107 @@
+"""
+Small caches used to avoid repeated calls to PayPal and repeated queries.
+
+``LRUCache`` is a thread-safe, in-process cache that supports the subset of
+Django's cache API that we use (``get``, ``set``, ``delete`` and ``clear``), so
+callers can use either interchangeably.
+"""
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.test.signals import setting_changed
+
+try:
+    from django.core.cache import caches
+except ImportError:
+    # Django < 1.7
+    from django.core.cache import get_cache as _get_django_cache
+else:
+    def _get_django_cache(alias):
+        return caches[alias]
+
+# The setting value that selects the in-process cache
+LOCAL = 'local'
+
+_local_caches = {}
+_local_caches_lock = threading.Lock()
+
+
+class LRUCache(object):
+    """
+    A bounded mapping that evicts the least recently used entry when full.
+    Entries can also expire.
+    """
+
+    def __init__(self, max_size=1000, timeout=None):
+        self.max_size = max_size
+        self.timeout = timeout
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                return default
+            if expires is not None and expires < time.time():
+                return default
+            # Re-insert to mark as most recently used
+            self._data[key] = (value, expires)
+            return value
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.timeout
+        expires = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+def get_cache(setting, default=None, max_size=1000):
+    """
+    Return the cache selected by a setting, or ``None`` if it is disabled.
+
+    The setting can be ``None`` (disabled), ``'local'`` for a process-wide
+    ``LRUCache`` (whose size can be set with ``<setting>_SIZE``) or the alias
+    of one of the project's Django caches.
+    """
+    alias = getattr(settings, setting, default)
+    if alias is None:
+        return None
+    if alias != LOCAL:
+        return _get_django_cache(alias)
+    cache = _local_caches.get(setting)
+    if cache is None:
+        with _local_caches_lock:
+            cache = _local_caches.get(setting)
+            if cache is None:
+                cache = _local_caches[setting] = LRUCache(
+                    getattr(settings, setting + '_SIZE', max_size))
+    return cache
+
+
+def _reset_local_caches_on_setting_change(setting, **kwargs):
+    with _local_caches_lock:
+        for name in list(_local_caches):
+            if setting.startswith(name):
+                del _local_caches[name]
+
+
+setting_changed.connect(_reset_local_caches_on_setting_change)
@@ -0,0 +1,21 @@
+from django.conf.urls import patterns, url
+
+from oscar.core.application import Application
+
+from paypal.dashboard import views
+
+
+class MetricsDashboardApplication(Application):
+    name = None
+    metrics_view = views.MetricsView
+
+    def get_urls(self):
+        # The view checks access itself, so that scrapers can use a token
+        urlpatterns = patterns('',
+            url(r'^metrics/$', self.metrics_view.as_view(),
+                name='paypal-metrics'),
+        )
+        return self.post_process_urls(urlpatterns)
+
+
+application = MetricsDashboardApplication()
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.crypto import constant_time_compare
+from django.views import generic
+
+from paypal import metrics
+
+
+class MetricsView(generic.View):
+    """
+    The PayPal metrics of this process in the Prometheus text format.
+
+    Staff can always see them.  Scrapers can authenticate by sending
+    ``PAYPAL_METRICS_TOKEN`` as a bearer token.
+    """
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def get(self, request, *args, **kwargs):
+        if not self.is_allowed(request):
+            return HttpResponseForbidden()
+        return HttpResponse(metrics.REGISTRY.render(),
+                            content_type=self.content_type)
+
+    def is_allowed(self, request):
+        user = request.user
+        if user.is_authenticated() and user.is_active and user.is_staff:
+            return True
+        token = getattr(settings, 'PAYPAL_METRICS_TOKEN', None)
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(token) and constant_time_compare(
+            header, 'Bearer %s' % token)
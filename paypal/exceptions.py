@@ -11,3 +11,30 @@ class PayPalError(PaymentError):
 
 class PayPalError(PaymentError):
     pass
+
+
+class PayPalUnavailable(PayPalError):
+    """
+    PayPal can't be reached at the moment.  It's worth trying again later.
+    """
+
+
+class CommunicationError(PayPalUnavailable):
+    """
+    A request failed before a response was received (eg a connection error or
+    a timeout).  PayPal may or may not have processed it.
+    """
+
+
+class CircuitOpen(PayPalUnavailable):
+    """
+    A request wasn't sent because recent requests to the same endpoint have
+    failed
+    """
+
+
+class DeadlineExceeded(PayPalUnavailable):
+    """
+    A request wasn't sent (or was abandoned) because the time allowed for it
+    ran out
+    """
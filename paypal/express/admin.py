@@ -18,9 +18,26 @@ class ExpressTransactionAdmin(admin.ModelAdmin):
         'raw_request',
         'raw_response',
         'response_time',
+        'encode_time',
+        'connect_time',
+        'connection_reused',
+        'ttfb',
+        'read_time',
+        'decode_time',
         'date_created',
         'request',
         'response']
 
 
 admin.site.register(models.ExpressTransaction, ExpressTransactionAdmin)
+
+
+class ExpressConfirmationAdmin(admin.ModelAdmin):
+    list_display = ['order_number', 'status', 'amount', 'currency',
+                    'attempts', 'error_message', 'date_created',
+                    'date_updated']
+    list_filter = ['status']
+    readonly_fields = ['txn']
+
+
+admin.site.register(models.ExpressConfirmation, ExpressConfirmationAdmin)
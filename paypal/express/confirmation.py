@@ -0,0 +1,278 @@
+"""
+Background confirmation of Express Checkout payments.
+
+With ``PAYPAL_EXPRESS_ASYNC_CONFIRMATION`` enabled, ``SuccessResponseView``
+places the order in the ``PAYPAL_EXPRESS_PENDING_ORDER_STATUS`` status and
+records an ``ExpressConfirmation`` instead of calling DoExpressCheckoutPayment
+itself.  The confirmation is handed to a pool of worker threads, which make the
+call (retrying with exponential backoff while PayPal is unavailable), record
+the payment against the order and move it on to
+``PAYPAL_EXPRESS_CONFIRMED_ORDER_STATUS`` or
+``PAYPAL_EXPRESS_FAILED_ORDER_STATUS``.  Meanwhile the customer is shown a
+status page that polls for the result.  A payment that is taken but can't be
+recorded against the order is marked as needing attention, so it is never
+processed again.
+
+The confirmation is queued before the request that placed the order has
+committed its transaction, so a worker may not be able to see it yet.  Workers
+queue such confirmations again, with a short backoff, until it can be seen.
+
+Confirmations that are left pending or processing when a process exits are
+picked up by the ``paypal_confirm_orders`` management command.
+"""
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db.models import F, get_model
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from paypal import workers
+from paypal.exceptions import PayPalError, PayPalUnavailable
+from paypal.express import facade
+from paypal.express.models import ExpressConfirmation
+
+logger = logging.getLogger('paypal.express')
+
+Order = get_model('order', 'Order')
+PaymentEvent = get_model('order', 'PaymentEvent')
+PaymentEventQuantity = get_model('order', 'PaymentEventQuantity')
+PaymentEventType = get_model('order', 'PaymentEventType')
+Source = get_model('payment', 'Source')
+SourceType = get_model('payment', 'SourceType')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+# How many times, and how soon, a worker looks again for a confirmation that
+# it can't see yet.  The delay doubles each time, so a confirmation is looked
+# for over about 25 seconds.
+_VISIBILITY_ATTEMPTS = 8
+_VISIBILITY_RETRY_DELAY = 0.1
+
+
+def is_enabled():
+    return getattr(settings, 'PAYPAL_EXPRESS_ASYNC_CONFIRMATION', False)
+
+
+def get_pending_order_status():
+    return getattr(settings, 'PAYPAL_EXPRESS_PENDING_ORDER_STATUS',
+                   'Pending payment')
+
+
+def get_confirmed_order_status():
+    return getattr(settings, 'PAYPAL_EXPRESS_CONFIRMED_ORDER_STATUS',
+                   getattr(settings, 'OSCAR_INITIAL_ORDER_STATUS', ''))
+
+
+def get_failed_order_status():
+    return getattr(settings, 'PAYPAL_EXPRESS_FAILED_ORDER_STATUS',
+                   'Payment failed')
+
+
+def confirm(item):
+    """
+    Process a confirmation, queueing it again if it needs to be retried or
+    can't be seen yet
+    """
+    confirmation_id, attempt = item
+    if not ExpressConfirmation.objects.filter(id=confirmation_id).exists():
+        # The request that queued it hasn't committed yet, or has rolled back
+        if attempt >= _VISIBILITY_ATTEMPTS:
+            logger.warning("Confirmation #%s not found after %d attempts - "
+                           "leaving it for paypal_confirm_orders",
+                           confirmation_id, attempt)
+            return
+        delay = _VISIBILITY_RETRY_DELAY * 2 ** (attempt - 1)
+        logger.info("Confirmation #%s not found - looking again in %.1fs",
+                    confirmation_id, delay)
+        _get_pool().put_later((confirmation_id, attempt + 1), delay)
+        return
+    delay = process(confirmation_id)
+    if delay is not None:
+        _get_pool().put_later((confirmation_id, 1), delay)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = workers.WorkerPool(
+                'paypal-confirmation', confirm,
+                num_workers=getattr(
+                    settings, 'PAYPAL_EXPRESS_CONFIRMATION_WORKERS', 4),
+                max_size=getattr(
+                    settings, 'PAYPAL_EXPRESS_CONFIRMATION_QUEUE_SIZE', 1000))
+            _pool.start()
+        return _pool
+
+
+def submit(confirmation):
+    """
+    Queue a confirmation to be processed in the background
+    """
+    if not _get_pool().put((confirmation.id, 1)):
+        # Never leave a customer waiting on a confirmation that won't be
+        # processed - confirm it ourselves instead
+        logger.warning("Confirmation queue is full - confirming #%s "
+                       "synchronously", confirmation.id)
+        try:
+            confirm((confirmation.id, 1))
+        except Exception:
+            logger.exception("Unable to confirm payment #%s",
+                             confirmation.id)
+
+
+def _reset_pool_on_setting_change(setting, **kwargs):
+    global _pool
+    if setting.startswith('PAYPAL_EXPRESS_CONFIRMATION_'):
+        with _pool_lock:
+            if _pool is not None:
+                _pool.stop()
+                _pool = None
+
+
+setting_changed.connect(_reset_pool_on_setting_change)
+
+
+def process(confirmation_id):
+    """
+    Confirm the payment for a pending order.
+
+    Returns the number of seconds to wait before trying again if the attempt
+    failed but can be retried, or ``None``.  A confirmation that isn't pending
+    (eg it is already being processed elsewhere) is left alone.
+    """
+    # Claim the confirmation, so it is only processed once even if it has been
+    # queued more than once.  Queryset updates don't touch ``date_updated``,
+    # which records when processing started for ``reclaim``.
+    claimed = ExpressConfirmation.objects.filter(
+        id=confirmation_id, status=ExpressConfirmation.PENDING).update(
+            status=ExpressConfirmation.PROCESSING, attempts=F('attempts') + 1,
+            date_updated=timezone.now())
+    if not claimed:
+        logger.debug("Confirmation #%s isn't pending - skipping it",
+                     confirmation_id)
+        return None
+    confirmation = ExpressConfirmation.objects.get(id=confirmation_id)
+
+    try:
+        order = Order._default_manager.get(number=confirmation.order_number)
+    except Order.DoesNotExist:
+        # The request that placed it may not have finished yet
+        return _retry(confirmation, None, "Order not found")
+
+    try:
+        txn = facade.confirm_transaction(
+            confirmation.payer_id, confirmation.token, confirmation.amount,
+            confirmation.currency)
+    except PayPalUnavailable as e:
+        return _retry(confirmation, order, e)
+    except PayPalError as e:
+        _fail(confirmation, order, e)
+        return None
+    if not txn.is_successful:
+        _fail(confirmation, order, txn.error_message)
+        return None
+
+    try:
+        with atomic():
+            _record_payment(order, txn)
+            _set_order_status(order, get_confirmed_order_status())
+            confirmation.status = ExpressConfirmation.COMPLETE
+            confirmation.txn = txn
+            confirmation.error_message = ''
+            confirmation.save()
+    except Exception as e:
+        # The payment has been taken, so the confirmation mustn't be left to
+        # be reclaimed and processed again
+        logger.exception("Order #%s - payment confirmed but couldn't be "
+                         "recorded", order.number)
+        ExpressConfirmation.objects.filter(id=confirmation.id).update(
+            status=ExpressConfirmation.NEEDS_ATTENTION, txn=txn,
+            error_message=('%s' % e)[:256], date_updated=timezone.now())
+        return None
+    logger.info("Order #%s - payment confirmed", order.number)
+    return None
+
+
+def reclaim(cutoff):
+    """
+    Put confirmations that have been processing since before ``cutoff`` back
+    to pending, eg because the process confirming them exited.  Returns the
+    number of confirmations reclaimed.
+    """
+    reclaimed = ExpressConfirmation.objects.filter(
+        status=ExpressConfirmation.PROCESSING,
+        date_updated__lt=cutoff).update(status=ExpressConfirmation.PENDING)
+    if reclaimed:
+        logger.warning("Reclaimed %d confirmations left processing",
+                       reclaimed)
+    return reclaimed
+
+
+def _retry(confirmation, order, error):
+    attempts = getattr(settings, 'PAYPAL_EXPRESS_CONFIRMATION_ATTEMPTS', 5)
+    if confirmation.attempts >= attempts:
+        _fail(confirmation, order, error)
+        return None
+    backoff = getattr(settings, 'PAYPAL_EXPRESS_CONFIRMATION_RETRY_BACKOFF',
+                      2.0)
+    delay = backoff * 2 ** (confirmation.attempts - 1)
+    logger.warning("Unable to confirm payment for order #%s (%s) - retrying "
+                   "in %.1fs", confirmation.order_number, error, delay)
+    confirmation.status = ExpressConfirmation.PENDING
+    confirmation.error_message = ('%s' % error)[:256]
+    confirmation.save()
+    return delay
+
+
+def _fail(confirmation, order, error):
+    logger.error("Unable to confirm payment for order #%s: %s",
+                 confirmation.order_number, error)
+    if order is not None:
+        _set_order_status(order, get_failed_order_status())
+    confirmation.status = ExpressConfirmation.FAILED
+    confirmation.error_message = ('%s' % error)[:256]
+    confirmation.save()
+
+
+def _record_payment(order, txn):
+    """
+    Record the payment source and event, as ``SuccessResponseView`` does when
+    confirming the payment itself.  Nothing is recorded if the order already
+    has a PayPal source or an event for the transaction.
+    """
+    if (order.sources.filter(source_type__name='PayPal').exists() or
+            order.payment_events.filter(
+                reference=txn.correlation_id).exists()):
+        logger.info("Order #%s - payment already recorded", order.number)
+        return
+    source_type, __ = SourceType.objects.get_or_create(name='PayPal')
+    Source.objects.create(
+        order=order, source_type=source_type, currency=txn.currency,
+        amount_allocated=txn.amount, amount_debited=txn.amount)
+    event_type, __ = PaymentEventType.objects.get_or_create(name='Settled')
+    event = PaymentEvent.objects.create(
+        order=order, event_type=event_type, amount=txn.amount,
+        reference=txn.correlation_id)
+    for line in order.lines.all():
+        PaymentEventQuantity.objects.create(
+            event=event, line=line, quantity=line.quantity)
+
+
+def _set_order_status(order, status):
+    if not status:
+        return
+    if order.pipeline:
+        order.set_status(status)
+    else:
+        # Without a pipeline, Oscar doesn't allow any status changes
+        order.status = status
+        order.save()
@@ -1,11 +1,10 @@
 """
 Responsible for briding between Oscar and the PayPal gateway
 """
-from django.core.urlresolvers import reverse
-from django.contrib.sites.models import Site
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
 
+from paypal import cache, refdata
 from paypal.express.models import ExpressTransaction as Transaction
 from paypal.express.gateway import (
     set_txn, get_txn, do_txn, SALE, AUTHORIZATION, ORDER,
@@ -34,16 +33,14 @@ def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
     """
     currency = getattr(settings, 'PAYPAL_CURRENCY', 'GBP')
     if host is None:
-        host = Site.objects.get_current().domain
+        host = refdata.get_domain()
     if scheme is None:
         use_https = getattr(settings, 'PAYPAL_CALLBACK_HTTPS', True)
         scheme = 'https' if use_https else 'http'
     return_url = '%s://%s%s' % (
-        scheme, host, reverse('paypal-success-response', kwargs={
-            'basket_id': basket.id}))
+        scheme, host, refdata.get_path('paypal-success-response', basket.id))
     cancel_url = '%s://%s%s' % (
-        scheme, host, reverse('paypal-cancel-response', kwargs={
-            'basket_id': basket.id}))
+        scheme, host, refdata.get_path('paypal-cancel-response', basket.id))
 
     # URL for updating shipping methods - we only use this if we have a set of
     # shipping methods to choose between.
@@ -51,8 +48,7 @@ def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
     if shipping_methods:
         update_url = '%s://%s%s' % (
             scheme, host,
-            reverse('paypal-shipping-options',
-                    kwargs={'basket_id': basket.id}))
+            refdata.get_path('paypal-shipping-options', basket.id))
 
     # Determine whether a shipping address is required
     no_shipping = False
@@ -82,44 +78,88 @@ def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
                    paypal_params=paypal_params)
 
 
-def fetch_transaction_details(token):
+def _get_details_cache():
+    return cache.get_cache('PAYPAL_EXPRESS_DETAILS_CACHE')
+
+
+def _details_cache_key(token):
+    return 'paypal:express:details:%s' % token
+
+
+def fetch_transaction_details(token, refresh=False):
     """
     Fetch the completed details about the PayPal transaction.
+
+    If ``PAYPAL_EXPRESS_DETAILS_CACHE`` is set, the details are cached by token
+    until the payment is confirmed.  Pass ``refresh=True`` to fetch them from
+    PayPal regardless.
     """
-    return get_txn(token)
+    details_cache = _get_details_cache()
+    if details_cache is None:
+        return get_txn(token)
+    key = _details_cache_key(token)
+    if not refresh:
+        txn = details_cache.get(key)
+        if txn is not None:
+            return txn
+    txn = get_txn(token)
+    details_cache.set(key, txn, getattr(
+        settings, 'PAYPAL_EXPRESS_DETAILS_CACHE_TIMEOUT', 3 * 60 * 60))
+    return txn
 
 
 def confirm_transaction(payer_id, token, amount, currency):
     """
     Confirm the payment action.
     """
-    return do_txn(payer_id, token, amount, currency,
-                  action=_get_payment_action())
+    details_cache = _get_details_cache()
+    try:
+        return do_txn(payer_id, token, amount, currency,
+                      action=_get_payment_action())
+    finally:
+        # The details (eg CHECKOUTSTATUS) change once payment is attempted
+        if details_cache is not None:
+            details_cache.delete(_details_cache_key(token))
 
 
-def refund_transaction(token, amount, currency, note=None):
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
+def _get_payment_txn(token):
+    """
+    Return the successful DoExpressCheckoutPayment transaction for a token.
+    A payment that failed is retried with the same token, so there may be
+    failed transactions too.
+    """
+    return Transaction.objects.filter(
+        token=token, method=DO_EXPRESS_CHECKOUT,
+        ack__in=(Transaction.SUCCESS,
+                 Transaction.SUCCESS_WITH_WARNING)).latest('id')
+
+
+def refund_transaction(token, amount, currency, note=None, msg_sub_id=None):
+    """
+    Refund a payment.  Pass a ``msg_sub_id`` that identifies a partial refund
+    (eg the ID of your refund record) to make retrying it safe.
+    """
+    txn = _get_payment_txn(token)
     is_partial = amount < txn.amount
-    return refund_txn(txn.value('PAYMENTINFO_0_TRANSACTIONID'), is_partial, amount, currency)
+    return refund_txn(txn.value('PAYMENTINFO_0_TRANSACTIONID'), is_partial,
+                      amount, currency, msg_sub_id=msg_sub_id)
 
 
-def capture_authorization(token, note=None):
+def capture_authorization(token, note=None, msg_sub_id=None):
     """
     Capture a previous authorization.
     """
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
+    txn = _get_payment_txn(token)
     return do_capture(txn.value('PAYMENTINFO_0_TRANSACTIONID'),
-                      txn.amount, txn.currency, note=note)
+                      txn.amount, txn.currency, note=note,
+                      msg_sub_id=msg_sub_id)
 
 
 def void_authorization(token, note=None):
     """
     Void a previous authorization.
     """
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
+    txn = _get_payment_txn(token)
     return do_void(txn.value('PAYMENTINFO_0_TRANSACTIONID'), note=note)
 
 
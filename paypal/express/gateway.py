@@ -1,16 +1,17 @@
+import hashlib
 import logging
+import uuid
 from decimal import Decimal as D
 
 from django.conf import settings
 from django.core.exceptions import ImproperlyConfigured
-from django.utils.http import urlencode
 from django.utils import six
+from django.test.signals import setting_changed
 from django.utils.translation import ugettext as _
-from django.template.defaultfilters import truncatewords, striptags
 from django.contrib.localflavor.us import us_states
 
-from . import models, exceptions as express_exceptions
-from paypal import gateway
+from . import models, quotes, exceptions as express_exceptions
+from paypal import gateway, metrics, nvp, snapshot
 from paypal import exceptions
 
 
@@ -33,20 +34,108 @@ API_VERSION = getattr(settings, 'PAYPAL_API_VERSION', '88.0')
 logger = logging.getLogger('paypal.express')
 
 
-def _format_description(description):
-    if description:
-        return truncatewords(striptags(description), 12)
-    return ''
+_format_description = snapshot.format_description
+
+
+_TWO_PLACES = D('0.01')
 
 
 def _format_currency(amt):
-    return amt.quantize(D('0.01'))
+    return amt.quantize(_TWO_PLACES)
 
 
 def _fetch_response(method, extra_params):
     """
     Fetch the response from PayPal and return a transaction object
     """
+    url, params = _build_request(method, extra_params)
+
+    # Make HTTP request
+    with metrics.track('express', method):
+        pairs = gateway.post(url, params)
+
+    return _record_response(method, params, pairs)
+
+
+def message_id(method, key, attempt=1):
+    """
+    Return the message submission ID (MSGSUBID) for a request.  The ID is
+    derived from the method, a key that identifies the operation (eg the
+    token for DoExpressCheckoutPayment) and the attempt, so repeating an
+    attempt always sends the same ID.
+    """
+    value = '%s:%s' % (method, key)
+    if attempt > 1:
+        value = '%s:%d' % (value, attempt)
+    return hashlib.sha1(value.encode('utf8')).hexdigest()[:38]
+
+
+def _next_message_id(method, key):
+    """
+    Return the message submission ID for the next attempt at an operation.
+
+    PayPal answers a repeated ID with its original response, failures
+    included, so an attempt that PayPal answered with a failure (eg 10486,
+    a funding failure) gets a new ID when the operation is retried.  An
+    attempt that succeeded, or whose response was never recorded, keeps its
+    ID so that it can't be processed twice.
+    """
+    failed_acks = (models.ExpressTransaction.FAILURE,
+                   models.ExpressTransaction.FAILURE_WITH_WARNING)
+    attempt = 1
+    while True:
+        msg_sub_id = message_id(method, key, attempt)
+        acks = set(models.ExpressTransaction.objects.filter(
+            method=method, msg_sub_id=msg_sub_id).values_list(
+                'ack', flat=True))
+        if not acks or not acks.issubset(failed_acks):
+            return msg_sub_id
+        attempt += 1
+
+
+def _get_completed_txn(method, msg_sub_id):
+    """
+    Return the successful transaction recorded for a message submission ID, if
+    there is one
+    """
+    txns = list(models.ExpressTransaction.objects.filter(
+        method=method, msg_sub_id=msg_sub_id,
+        ack__in=(models.ExpressTransaction.SUCCESS,
+                 models.ExpressTransaction.SUCCESS_WITH_WARNING))[:1])
+    return txns[0] if txns else None
+
+
+def _fetch_idempotent_response(method, extra_params, msg_sub_id=None):
+    """
+    Fetch the response for a request that moves money.
+
+    The request is sent with a message submission ID, which PayPal uses to
+    recognise a repeated request and return the original response rather than
+    processing it again.  This makes it safe to retry the request when it fails
+    in transit, and if the ID has already been used successfully the recorded
+    transaction is returned without contacting PayPal at all.
+    """
+    if msg_sub_id is None:
+        msg_sub_id = uuid.uuid4().hex
+    else:
+        txn = _get_completed_txn(method, msg_sub_id)
+        if txn is not None:
+            logger.info("%s with MSGSUBID %s has already been completed",
+                        method, msg_sub_id)
+            return txn
+    params = dict(extra_params, MSGSUBID=msg_sub_id)
+    try:
+        return gateway.call_with_retries(_fetch_response, method, params)
+    except exceptions.PayPalUnavailable as e:
+        logger.error("Unable to complete %s with MSGSUBID %s: %s", method,
+                     msg_sub_id, e)
+        raise
+
+
+def _build_request(method, extra_params):
+    """
+    Return the URL and parameters for a request to PayPal
+    """
     # Build parameter string
     params = {
         'METHOD': method,
@@ -57,19 +146,25 @@ def _fetch_response(method, extra_params):
     }
     params.update(extra_params)
 
-    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
-        url = 'https://api-3t.sandbox.paypal.com/nvp'
-    else:
-        url = 'https://api-3t.paypal.com/nvp'
+    url = getattr(settings, 'PAYPAL_EXPRESS_API_URL', None)
+    if url is None:
+        if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
+            url = 'https://api-3t.sandbox.paypal.com/nvp'
+        else:
+            url = 'https://api-3t.paypal.com/nvp'
 
     # Print easy-to-read version of params for debugging
     param_str = "\n".join(["%s: %s" % x for x in sorted(params.items())])
     logger.debug("Making %s request to %s with params:\n%s", method, url,
                  param_str)
+    return url, params
 
-    # Make HTTP request
-    pairs = gateway.post(url, params)
 
+def _record_response(method, params, pairs):
+    """
+    Record the response from PayPal and return the transaction object.  An
+    exception is raised if the transaction wasn't successful.
+    """
     pairs_str = "\n".join(["%s: %s" % x for x in sorted(pairs.items())
                            if not x[0].startswith('_')])
     logger.debug("Response with params:\n%s", pairs_str)
@@ -83,7 +178,13 @@ def _fetch_response(method, extra_params):
         raw_request=pairs['_raw_request'],
         raw_response=pairs['_raw_response'],
         response_time=pairs['_response_time'],
+        msg_sub_id=params.get('MSGSUBID'),
+        **metrics.model_fields(pairs)
     )
+    if method in (GET_EXPRESS_CHECKOUT, DO_EXPRESS_CHECKOUT):
+        # Recorded for failures too, so that every attempt for a token can be
+        # found
+        txn.token = params.get('TOKEN')
     if txn.is_successful:
         txn.correlation_id = pairs['CORRELATIONID']
         if method == SET_EXPRESS_CHECKOUT:
@@ -91,11 +192,9 @@ def _fetch_response(method, extra_params):
             txn.currency = params['PAYMENTREQUEST_0_CURRENCYCODE']
             txn.token = pairs['TOKEN']
         elif method == GET_EXPRESS_CHECKOUT:
-            txn.token = params['TOKEN']
             txn.amount = D(pairs['PAYMENTREQUEST_0_AMT'])
             txn.currency = pairs['PAYMENTREQUEST_0_CURRENCYCODE']
         elif method == DO_EXPRESS_CHECKOUT:
-            txn.token = params['TOKEN']
             txn.amount = D(pairs['PAYMENTINFO_0_AMT'])
             txn.currency = pairs['PAYMENTINFO_0_CURRENCYCODE']
     else:
@@ -104,7 +203,7 @@ def _fetch_response(method, extra_params):
             txn.error_code = pairs['L_ERRORCODE0']
         if 'L_LONGMESSAGE0' in pairs:
             txn.error_message = pairs['L_LONGMESSAGE0']
-    txn.save()
+    metrics.save(txn, 'express', method, pairs)
 
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
@@ -114,6 +213,99 @@ def _fetch_response(method, extra_params):
     return txn
 
 
+# Keys of the line item fields, by index.  Rebuilt when a bigger basket is
+# seen.
+_ITEM_FIELDS = ('NAME', 'NUMBER', 'DESC', 'AMT', 'QTY')
+_item_keys = ()
+
+# Request parameters derived from settings - see _get_default_params
+_default_params = None
+
+
+def _clean_params(params):
+    """
+    Validate the locale and convert booleans to integers in a dict of
+    SetExpressCheckout params
+    """
+    locale = params.get('LOCALECODE', None)
+    if locale:
+        valid_choices = ('AU', 'DE', 'FR', 'GB', 'IT', 'ES', 'JP', 'US')
+        if locale not in valid_choices:
+            raise ImproperlyConfigured(
+                "'%s' is not a valid locale code" % locale)
+    # Boolean values become integers
+    return dict((k, int(v) if isinstance(v, bool) else v)
+                for k, v in params.items())
+
+
+def _get_default_params():
+    """
+    Return a copy of the SetExpressCheckout parameters that come from
+    settings.  These are only read (and validated) once.
+    """
+    global _default_params
+    if _default_params is None:
+        defaults = {
+            'CUSTOMERSERVICENUMBER': getattr(
+                settings, 'PAYPAL_CUSTOMER_SERVICES_NUMBER', None),
+            'SOLUTIONTYPE': getattr(settings, 'PAYPAL_SOLUTION_TYPE', None),
+            'LANDINGPAGE': getattr(settings, 'PAYPAL_LANDING_PAGE', None),
+            'BRANDNAME': getattr(settings, 'PAYPAL_BRAND_NAME', None),
+
+            # Display settings
+            'PAGESTYLE': getattr(settings, 'PAYPAL_PAGESTYLE', None),
+            'HDRIMG': getattr(settings, 'PAYPAL_HEADER_IMG', None),
+            'PAYFLOWCOLOR': getattr(settings, 'PAYPAL_PAYFLOW_COLOR', None),
+
+            # Think these settings maybe deprecated in latest version of
+            # PayPal's API
+            'HDRBACKCOLOR': getattr(
+                settings, 'PAYPAL_HEADER_BACK_COLOR', None),
+            'HDRBORDERCOLOR': getattr(
+                settings, 'PAYPAL_HEADER_BORDER_COLOR', None),
+
+            'LOCALECODE': getattr(settings, 'PAYPAL_LOCALE', None),
+
+            'ALLOWNOTE': getattr(settings, 'PAYPAL_ALLOW_NOTE', True),
+            'CALLBACKTIMEOUT': getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
+        }
+        if getattr(settings, 'PAYPAL_CONFIRM_SHIPPING', None):
+            defaults['REQCONFIRMSHIPPING'] = 1
+        # Remove None values
+        _default_params = dict(
+            (k, v) for k, v in _clean_params(defaults).items()
+            if v is not None)
+    return _default_params.copy()
+
+
+def _reset_default_params_on_setting_change(setting, **kwargs):
+    global _default_params
+    if setting.startswith('PAYPAL_'):
+        _default_params = None
+
+
+setting_changed.connect(_reset_default_params_on_setting_change)
+
+
+def _add_items(params, items):
+    """
+    Add the line item params for a list of (name, number, description,
+    amount, quantity) tuples.  Items without a number (discounts) don't get
+    a NUMBER param.
+    """
+    global _item_keys
+    item_keys = _item_keys
+    if len(item_keys) < len(items):
+        item_keys = _item_keys = tuple(
+            tuple('L_PAYMENTREQUEST_0_%s%d' % (field, index)
+                  for field in _ITEM_FIELDS)
+            for index in range(len(items)))
+    for keys, item in zip(item_keys, items):
+        params.update(zip(keys, item))
+        if item[1] is None:
+            del params[keys[1]]
+
+
 def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_url=None,
             action=SALE, user=None, user_address=None, shipping_method=None,
             shipping_address=None, no_shipping=False, paypal_params=None):
@@ -124,49 +316,19 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     There are quite a few options that can be passed to PayPal to configure
     this request - most are controlled by PAYPAL_* settings.
     """
-    # Default parameters (taken from global settings).  These can be overridden
-    # and customised using the paypal_params parameter.
-    _params = {
-        'CUSTOMERSERVICENUMBER': getattr(
-            settings, 'PAYPAL_CUSTOMER_SERVICES_NUMBER', None),
-        'SOLUTIONTYPE': getattr(settings, 'PAYPAL_SOLUTION_TYPE', None),
-        'LANDINGPAGE': getattr(settings, 'PAYPAL_LANDING_PAGE', None),
-        'BRANDNAME': getattr(settings, 'PAYPAL_BRAND_NAME', None),
-
-        # Display settings
-        'PAGESTYLE': getattr(settings, 'PAYPAL_PAGESTYLE', None),
-        'HDRIMG': getattr(settings, 'PAYPAL_HEADER_IMG', None),
-        'PAYFLOWCOLOR': getattr(settings, 'PAYPAL_PAYFLOW_COLOR', None),
-
-        # Think these settings maybe deprecated in latest version of PayPal's
-        # API
-        'HDRBACKCOLOR': getattr(settings, 'PAYPAL_HEADER_BACK_COLOR', None),
-        'HDRBORDERCOLOR': getattr(
-            settings, 'PAYPAL_HEADER_BORDER_COLOR', None),
-
-        'LOCALECODE': getattr(settings, 'PAYPAL_LOCALE', None),
-
-        'ALLOWNOTE': getattr(settings, 'PAYPAL_ALLOW_NOTE', True),
-        'CALLBACKTIMEOUT': getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
-    }
-    confirm_shipping_addr = getattr(settings, 'PAYPAL_CONFIRM_SHIPPING', None)
-    if confirm_shipping_addr and not no_shipping:
-        _params['REQCONFIRMSHIPPING'] = 1
+    params = _get_default_params()
+    if no_shipping:
+        params.pop('REQCONFIRMSHIPPING', None)
     if paypal_params:
-        _params.update(paypal_params)
+        for key, value in _clean_params(paypal_params).items():
+            if value is None:
+                params.pop(key, None)
+            else:
+                params[key] = value
 
-    locale = _params.get('LOCALECODE', None)
-    if locale:
-        valid_choices = ('AU', 'DE', 'FR', 'GB', 'IT', 'ES', 'JP', 'US')
-        if locale not in valid_choices:
-            raise ImproperlyConfigured(
-                "'%s' is not a valid locale code" % locale)
-
-    # Boolean values become integers
-    _params.update((k, int(v)) for k, v in _params.items() if isinstance(v, bool))
-
-    # Remove None values
-    params = dict((k, v) for k, v in _params.items() if v is not None)
+    # Load the lines and everything they refer to up front so the totals below
+    # don't query for them one line at a time
+    contents = snapshot.BasketSnapshot(basket)
 
     # PayPal have an upper limit on transactions.  It's in dollars which is a
     # fiddly to work with.  Lazy solution - only check when dollars are used as
@@ -192,21 +354,14 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     })
 
     # Add item details
-    index = 0
-    for index, line in enumerate(basket.all_lines()):
-        product = line.product
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = product.get_title()
-        params['L_PAYMENTREQUEST_0_NUMBER%d' % index] = (product.upc if
-                                                         product.upc else '')
-        desc = ''
-        if product.description:
-            desc = _format_description(product.description)
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = desc
+    items = []
+    for line in contents.lines:
         # Note, we don't include discounts here - they are handled as separate
         # lines - see below
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            line.unit_price_incl_tax)
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = line.quantity
+        items.append((line.title, line.upc if line.upc else '',
+                      line.description,
+                      _format_currency(line.unit_price_incl_tax),
+                      line.quantity))
 
     # If the order has discounts associated with it, the way PayPal suggests
     # using the API is to add a separate item for the discount with the value
@@ -215,31 +370,20 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     # https://cms.paypal.com/us/cgi-bin/?cmd=_render-content&content_ID=developer/e_howto_api_ECCustomizing
 
     # Iterate over the 3 types of discount that can occur
-    for discount in basket.offer_discounts:
-        index += 1
+    for discount in contents.offer_discounts:
         name = _("Special Offer: %s") % discount['name']
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-    for discount in basket.voucher_discounts:
-        index += 1
+        items.append((name, None, _format_description(name),
+                      _format_currency(-discount['discount']), 1))
+    for discount in contents.voucher_discounts:
         name = "%s (%s)" % (discount['voucher'].name,
                             discount['voucher'].code)
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-    for discount in basket.shipping_discounts:
-        index += 1
+        items.append((name, None, _format_description(name),
+                      _format_currency(-discount['discount']), 1))
+    for discount in contents.shipping_discounts:
         name = _("Shipping Offer: %s") % discount['name']
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
+        items.append((name, None, _format_description(name),
+                      _format_currency(-discount['discount']), 1))
+    _add_items(params, items)
 
     # We include tax in the prices rather than separately as that's how it's
     # done on most British/Australian sites.  Will need to refactor in the
@@ -306,6 +450,7 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     # Shipping charges
     params['PAYMENTREQUEST_0_SHIPPINGAMT'] = _format_currency(D('0.00'))
     max_charge = D('0.00')
+    shipping_quotes = []
     for index, method in enumerate(shipping_methods):
         is_default = index == 0
         params['L_SHIPPINGOPTIONISDEFAULT%d' % index] = 'true' if is_default else 'false'
@@ -322,6 +467,7 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
             params['PAYMENTREQUEST_0_AMT'] += charge
         params['L_SHIPPINGOPTIONNAME%d' % index] = six.text_type(method.name)
         params['L_SHIPPINGOPTIONAMOUNT%d' % index] = _format_currency(charge)
+        shipping_quotes.append((six.text_type(method.name), charge))
 
     # Set shipping charge explicitly if it has been passed
     if shipping_method:
@@ -344,14 +490,20 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
 
     txn = _fetch_response(SET_EXPRESS_CHECKOUT, params)
 
+    # Store the shipping charges so the instant update callback can use them
+    if update_url:
+        quotes.store_for_request(basket.id, params, shipping_quotes)
+
     # Construct return URL
-    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
-        url = 'https://www.sandbox.paypal.com/webscr'
-    else:
-        url = 'https://www.paypal.com/webscr'
+    url = getattr(settings, 'PAYPAL_EXPRESS_REDIRECT_URL', None)
+    if url is None:
+        if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
+            url = 'https://www.sandbox.paypal.com/webscr'
+        else:
+            url = 'https://www.paypal.com/webscr'
     params = (('cmd', '_express-checkout'),
               ('token', txn.token),)
-    return '%s?%s' % (url, urlencode(params))
+    return '%s?%s' % (url, nvp.encode(params))
 
 
 def get_txn(token):
@@ -365,6 +517,9 @@ def get_txn(token):
 def do_txn(payer_id, token, amount, currency, action=SALE):
     """
     DoExpressCheckoutPayment
+
+    This is idempotent: a token can only be paid once, so repeating the call
+    for a token that has been paid returns the original transaction.
     """
     params = {
         'PAYERID': payer_id,
@@ -373,16 +528,24 @@ def do_txn(payer_id, token, amount, currency, action=SALE):
         'PAYMENTREQUEST_0_CURRENCYCODE': currency,
         'PAYMENTREQUEST_0_PAYMENTACTION': action,
     }
-    return _fetch_response(DO_EXPRESS_CHECKOUT, params)
+    return _fetch_idempotent_response(
+        DO_EXPRESS_CHECKOUT, params,
+        _next_message_id(DO_EXPRESS_CHECKOUT, token))
 
 
 def do_capture(txn_id, amount, currency, complete_type='Complete',
-               note=None):
+               note=None, msg_sub_id=None):
     """
     Capture payment from a previous transaction
 
     See https://cms.paypal.com/uk/cgi-bin/?&cmd=_render-content&content_ID=developer/e_howto_api_soap_r_DoCapture
+
+    Pass the same ``msg_sub_id`` when repeating a capture to make sure it only
+    happens once.  Otherwise, a final (``Complete``) capture is identified by
+    the authorization.
     """
+    if msg_sub_id is None and complete_type == 'Complete':
+        msg_sub_id = _next_message_id(DO_CAPTURE, txn_id)
     params = {
         'AUTHORIZATIONID': txn_id,
         'AMT': amount,
@@ -391,7 +554,7 @@ def do_capture(txn_id, amount, currency, complete_type='Complete',
     }
     if note:
         params['NOTE'] = note
-    return _fetch_response(DO_CAPTURE, params)
+    return _fetch_idempotent_response(DO_CAPTURE, params, msg_sub_id)
 
 
 def do_void(txn_id, note=None):
@@ -405,7 +568,16 @@ def do_void(txn_id, note=None):
 
 FULL_REFUND = 'Full'
 PARTIAL_REFUND = 'Partial'
-def refund_txn(txn_id, is_partial=False, amount=None, currency=None):
+def refund_txn(txn_id, is_partial=False, amount=None, currency=None,
+               msg_sub_id=None):
+    """
+    RefundTransaction
+
+    Pass the same ``msg_sub_id`` when repeating a partial refund to make sure
+    it only happens once.  A full refund is identified by the transaction.
+    """
+    if msg_sub_id is None and not is_partial:
+        msg_sub_id = _next_message_id(REFUND_TRANSACTION, txn_id)
     params = {
         'TRANSACTIONID': txn_id,
         'REFUNDTYPE': PARTIAL_REFUND if is_partial else FULL_REFUND,
@@ -413,7 +585,7 @@ def refund_txn(txn_id, is_partial=False, amount=None, currency=None):
     if is_partial:
         params['AMT'] = amount
         params['CURRENCYCODE'] = currency
-    return _fetch_response(REFUND_TRANSACTION, params)
+    return _fetch_idempotent_response(REFUND_TRANSACTION, params, msg_sub_id)
 
 def address_txn(email, street, postcode):
     params = {
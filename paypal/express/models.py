@@ -20,6 +20,7 @@ class ExpressTransaction(base.ResponseModel):
 
     # Response params
     SUCCESS, SUCCESS_WITH_WARNING, FAILURE = 'Success', 'SuccessWithWarning', 'Failure'
+    FAILURE_WITH_WARNING = 'FailureWithWarning'
     ack = models.CharField(max_length=32)
 
     correlation_id = models.CharField(max_length=32, null=True, blank=True)
@@ -28,13 +29,19 @@ class ExpressTransaction(base.ResponseModel):
     error_code = models.CharField(max_length=32, null=True, blank=True)
     error_message = models.CharField(max_length=256, null=True, blank=True)
 
+    # The message submission ID (MSGSUBID) sent with requests that move money,
+    # so that retried requests are only processed once
+    msg_sub_id = models.CharField(max_length=38, null=True, blank=True,
+                                  db_index=True)
+
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        # The facade looks up the DoExpressCheckoutPayment txn for a token
+        index_together = [('token', 'method')]
 
-    def save(self, *args, **kwargs):
+    def mask_sensitive_data(self):
         self.raw_request = re.sub(r'PWD=\d+&', 'PWD=XXXXXX&', self.raw_request)
-        return super(ExpressTransaction, self).save(*args, **kwargs)
 
     @property
     def is_successful(self):
@@ -44,3 +51,48 @@ class ExpressTransaction(base.ResponseModel):
         return 'method: %s: token: %s' % (
             self.method, self.token)
 
+
+@python_2_unicode_compatible
+class ExpressConfirmation(models.Model):
+    """
+    An order whose payment is being confirmed (with
+    DoExpressCheckoutPayment) in the background.  See
+    ``paypal.express.confirmation``.
+    """
+    PENDING, PROCESSING, COMPLETE, FAILED = (
+        'Pending', 'Processing', 'Complete', 'Failed')
+    # The payment was taken but couldn't be recorded against the order
+    NEEDS_ATTENTION = 'Needs attention'
+
+    order_number = models.CharField(max_length=128, unique=True)
+    payer_id = models.CharField(max_length=32)
+    token = models.CharField(max_length=32)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = models.CharField(max_length=8)
+
+    status = models.CharField(max_length=16, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    error_message = models.CharField(max_length=256, blank=True)
+
+    # The DoExpressCheckoutPayment transaction, once successful
+    txn = models.ForeignKey(ExpressTransaction, null=True, blank=True,
+                            related_name='+')
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('-date_created',)
+        app_label = 'paypal'
+
+    @property
+    def is_finished(self):
+        return self.status in (self.COMPLETE, self.FAILED,
+                               self.NEEDS_ATTENTION)
+
+    @property
+    def is_paid(self):
+        return self.status in (self.COMPLETE, self.NEEDS_ATTENTION)
+
+    def __str__(self):
+        return 'order: %s: status: %s' % (self.order_number, self.status)
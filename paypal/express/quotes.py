@@ -0,0 +1,117 @@
+"""
+Precomputed shipping quotes for the Instant Update callback.
+
+PayPal calls ``ShippingOptionsView`` whenever the customer picks a shipping
+address and gives up if we don't answer within ``PAYPAL_CALLBACK_TIMEOUT``
+seconds.  The shipping charges have usually already been calculated by
+``set_txn`` so we store them, keyed by basket ID, basket contents and
+destination, and the callback serves them without touching the database.
+When the charges depend on the destination, ``set_txn`` can only store them
+if it sent PayPal a shipping address: the callback always names the address
+the customer chose, and charges calculated without one don't apply to it.
+
+The basket contents are identified by a hash of the line items sent to PayPal
+in ``SetExpressCheckout`` - PayPal posts the same items back to the callback.
+"""
+from decimal import Decimal as D, InvalidOperation
+import hashlib
+
+from django.conf import settings
+from django.utils.encoding import force_bytes, force_text
+
+from paypal import cache
+
+# Prefixes of the line item fields in SetExpressCheckout and in the callback
+REQUEST_ITEM_PREFIX = 'L_PAYMENTREQUEST_0_'
+CALLBACK_ITEM_PREFIX = 'L_'
+
+
+def get_cache():
+    return cache.get_cache('PAYPAL_SHIPPING_QUOTE_CACHE')
+
+
+def _normalise_amount(value):
+    try:
+        return '%s' % D(force_text(value)).quantize(D('0.01'))
+    except InvalidOperation:
+        return force_text(value)
+
+
+def _content_hash(params, prefix):
+    """
+    Return a hash of the line items (number, amount and quantity) in a set of
+    request or callback params.
+    """
+    digest = hashlib.md5()
+    index = 0
+    while (prefix + 'AMT%d' % index) in params:
+        digest.update(force_bytes('%s|%s|%s\n' % (
+            force_text(params.get(prefix + 'NUMBER%d' % index, '')),
+            _normalise_amount(params[prefix + 'AMT%d' % index]),
+            force_text(params.get(prefix + 'QTY%d' % index, '')).strip())))
+        index += 1
+    return digest.hexdigest()
+
+
+def _by_destination():
+    return getattr(settings, 'PAYPAL_SHIPPING_QUOTES_BY_DESTINATION', True)
+
+
+def _key(basket_id, content_hash, country, state, postcode):
+    if _by_destination():
+        destination = '%s|%s|%s' % tuple(
+            force_text(value or '').strip().upper()
+            for value in (country, state, postcode))
+    else:
+        destination = '*'
+    return 'paypal:express:quotes:%s:%s:%s' % (
+        basket_id, content_hash,
+        hashlib.md5(force_bytes(destination)).hexdigest())
+
+
+def request_key(basket_id, params):
+    """
+    Return the cache key for the quotes of a SetExpressCheckout request
+    """
+    return _key(basket_id, _content_hash(params, REQUEST_ITEM_PREFIX),
+                params.get('SHIPTOCOUNTRYCODE'), params.get('SHIPTOSTATE'),
+                params.get('SHIPTOZIP'))
+
+
+def callback_key(basket_id, data):
+    """
+    Return the cache key for the quotes of an Instant Update callback
+    """
+    return _key(basket_id, _content_hash(data, CALLBACK_ITEM_PREFIX),
+                data.get('PAYMENTREQUEST_0_SHIPTOCOUNTRY'),
+                data.get('PAYMENTREQUEST_0_SHIPTOSTATE'),
+                data.get('PAYMENTREQUEST_0_SHIPTOZIP'))
+
+
+def store_for_request(basket_id, params, shipping_quotes):
+    """
+    Store the quotes calculated by ``set_txn`` for a SetExpressCheckout
+    request, if the callback will be able to use them
+    """
+    if get_cache() is None or not shipping_quotes:
+        return
+    if _by_destination() and not params.get('SHIPTOCOUNTRYCODE'):
+        return
+    store(request_key(basket_id, params), shipping_quotes)
+
+
+def get(key):
+    """
+    Return the stored list of (name, charge) quotes, or None
+    """
+    quote_cache = get_cache()
+    if quote_cache is None:
+        return None
+    return quote_cache.get(key)
+
+
+def store(key, quotes):
+    quote_cache = get_cache()
+    if quote_cache is not None:
+        quote_cache.set(key, list(quotes), getattr(
+            settings, 'PAYPAL_SHIPPING_QUOTE_CACHE_TIMEOUT', 3 * 60 * 60))
@@ -14,6 +14,10 @@ urlpatterns = patterns('',
         name='paypal-cancel-response'),
     url(r'^place-order/(?P<basket_id>\d+)/$', views.SuccessResponseView.as_view(),
         name='paypal-place-order'),
+    # Status of a payment that is being confirmed in the background
+    url(r'^confirmation/(?P<order_number>[\w-]+)/$',
+        views.ConfirmationStatusView.as_view(),
+        name='paypal-confirmation-status'),
     # Callback for getting shipping options for a specific basket
     url(r'^shipping-options/(?P<basket_id>\d+)/',
         csrf_exempt(views.ShippingOptionsView.as_view()),
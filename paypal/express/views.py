@@ -1,16 +1,16 @@
 from decimal import Decimal as D
+import json
 import logging
 
 from django.views.generic import RedirectView, View
 from django.conf import settings
-from django.http import HttpResponse
-from django.shortcuts import get_object_or_404
+from django.http import HttpResponse, Http404
+from django.shortcuts import get_object_or_404, render
 from django.contrib import messages
 from django.contrib.auth.models import AnonymousUser
 from django.core.urlresolvers import reverse
 from django.http import HttpResponseRedirect
 from django.db.models import get_model
-from django.utils.http import urlencode
 from django.utils import six
 from django.utils.translation import ugettext_lazy as _
 
@@ -24,7 +24,10 @@ from paypal.express.facade import (
 from paypal.express.exceptions import (
     EmptyBasketException, MissingShippingAddressException,
     MissingShippingMethodException, InvalidBasket)
-from paypal.exceptions import PayPalError
+from paypal.exceptions import PayPalError, PayPalUnavailable
+from paypal.express import confirmation, quotes
+from paypal.express.models import ExpressConfirmation
+from paypal import gateway, nvp, refdata
 
 # Load views dynamically
 PaymentDetailsView = get_class('checkout.views', 'PaymentDetailsView')
@@ -33,6 +36,7 @@ CheckoutSessionMixin = get_class('checkout.session', 'CheckoutSessionMixin')
 ShippingAddress = get_model('order', 'ShippingAddress')
 Country = get_model('address', 'Country')
 Basket = get_model('basket', 'Basket')
+Order = get_model('order', 'Order')
 Repository = get_class('shipping.repository', 'Repository')
 Applicator = get_class('offer.utils', 'Applicator')
 Selector = get_class('partner.strategy', 'Selector')
@@ -57,7 +61,19 @@ class RedirectView(CheckoutSessionMixin, RedirectView):
     def get_redirect_url(self, **kwargs):
         try:
             basket = self.request.basket
-            url = self._get_redirect_url(basket, **kwargs)
+            with gateway.deadline(
+                    getattr(settings, 'PAYPAL_REDIRECT_DEADLINE', None)):
+                url = self._get_redirect_url(basket, **kwargs)
+        except PayPalUnavailable:
+            messages.error(
+                self.request,
+                _("PayPal is not responding at the moment - please try again "
+                  "in a few minutes"))
+            if self.as_payment_method:
+                url = reverse('checkout:payment-details')
+            else:
+                url = reverse('basket:summary')
+            return url
         except PayPalError:
             messages.error(
                 self.request, _("An error occurred communicating with PayPal"))
@@ -289,6 +305,10 @@ class SuccessResponseView(PaymentDetailsView):
         submission['payment_kwargs']['payer_id'] = self.payer_id
         submission['payment_kwargs']['token'] = self.token
         submission['payment_kwargs']['txn'] = self.txn
+        if confirmation.is_enabled():
+            # The payment is confirmed in the background
+            submission['order_kwargs']['status'] = \
+                confirmation.get_pending_order_status()
         return submission
 
     # Warning: This method can be removed when we drop support for Oscar 0.6
@@ -301,7 +321,18 @@ class SuccessResponseView(PaymentDetailsView):
         """
         Complete payment with PayPal - this calls the 'DoExpressCheckout'
         method to capture the money from the initial transaction.
+
+        With asynchronous confirmation, the call is instead left to the
+        confirmation workers once the order has been placed.
         """
+        if confirmation.is_enabled():
+            self.confirmation = ExpressConfirmation.objects.create(
+                order_number=six.text_type(order_number),
+                payer_id=kwargs['payer_id'],
+                token=kwargs['token'], amount=kwargs['txn'].amount,
+                currency=kwargs['txn'].currency)
+            return
+
         try:
             confirm_txn = confirm_transaction(
                 kwargs['payer_id'], kwargs['token'], kwargs['txn'].amount,
@@ -322,6 +353,19 @@ class SuccessResponseView(PaymentDetailsView):
         self.add_payment_event('Settled', confirm_txn.amount,
                                reference=confirm_txn.correlation_id)
 
+    def handle_successful_order(self, order):
+        response = super(SuccessResponseView, self).handle_successful_order(
+            order)
+        if getattr(self, 'confirmation', None) is not None:
+            confirmation.submit(self.confirmation)
+        return response
+
+    def get_success_url(self):
+        if getattr(self, 'confirmation', None) is not None:
+            return reverse('paypal-confirmation-status', kwargs={
+                'order_number': self.confirmation.order_number})
+        return super(SuccessResponseView, self).get_success_url()
+
     def get_shipping_address(self, basket):
         """
         Return a created shipping address instance, created using
@@ -347,7 +391,8 @@ class SuccessResponseView(PaymentDetailsView):
             line4=self.txn.value('PAYMENTREQUEST_0_SHIPTOCITY', default=""),
             state=self.txn.value('PAYMENTREQUEST_0_SHIPTOSTATE', default=""),
             postcode=self.txn.value('PAYMENTREQUEST_0_SHIPTOZIP'),
-            country=Country.objects.get(iso_3166_1_a2=self.txn.value('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE'))
+            country=refdata.get_country(
+                self.txn.value('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE'))
         )
 
     def get_shipping_method(self, basket, shipping_address=None, **kwargs):
@@ -386,7 +431,19 @@ class ShippingOptionsView(View):
         # pass back details of the basket contents but it would be royal pain to
         # reconstitute the basket based on those - easier to just to piggy-back
         # the basket ID in the callback URL.
+        #
+        # We can skip all that if set_txn (or an earlier callback) has already
+        # calculated the charges for this basket and destination.
+        quote_key = quotes.callback_key(kwargs['basket_id'], self.request.POST)
+        shipping_quotes = quotes.get(quote_key)
+        if shipping_quotes is not None:
+            return self.render_quotes(shipping_quotes)
+
         basket = get_object_or_404(Basket, id=kwargs['basket_id'])
+        if Selector:
+            # PayPal's request has no session so the basket middleware can't
+            # have assigned a strategy
+            basket.strategy = Selector().strategy(self.request)
         user = basket.owner
         if not user:
             user = AnonymousUser()
@@ -395,7 +452,7 @@ class ShippingOptionsView(View):
         country_code = self.request.POST.get(
             'PAYMENTREQUEST_0_SHIPTOCOUNTRY', None)
         try:
-            country = Country.objects.get(iso_3166_1_a2=country_code)
+            country = refdata.get_country(country_code)
         except Country.DoesNotExist:
             country = Country()
 
@@ -408,14 +465,19 @@ class ShippingOptionsView(View):
             country=country
         )
         methods = self.get_shipping_methods(user, basket, shipping_address)
-        return self.render_to_response(methods, basket)
+        shipping_quotes = self.get_quotes(methods, basket)
+        quotes.store(quote_key, shipping_quotes)
+        return self.render_quotes(shipping_quotes)
 
     def render_to_response(self, methods, basket):
-        pairs = [
-            ('METHOD', 'CallbackResponse'),
-            ('CURRENCYCODE', self.request.POST.get('CURRENCYCODE', 'GBP')),
-        ]
-        for index, method in enumerate(methods):
+        return self.render_quotes(self.get_quotes(methods, basket))
+
+    def get_quotes(self, methods, basket):
+        """
+        Return a list of (name, charge) pairs for the shipping methods
+        """
+        shipping_quotes = []
+        for method in methods:
             if hasattr(method, 'set_basket'):
                 # Oscar < 0.8
                 method.set_basket(basket)
@@ -423,11 +485,17 @@ class ShippingOptionsView(View):
             else:
                 cost = method.calculate(basket)
                 charge = cost.incl_tax
+            shipping_quotes.append((six.text_type(method.name), charge))
+        return shipping_quotes
 
-            pairs.append(('L_SHIPPINGOPTIONNAME%d' % index,
-                          six.text_type(method.name)))
-            pairs.append(('L_SHIPPINGOPTIONLABEL%d' % index,
-                          six.text_type(method.name)))
+    def render_quotes(self, shipping_quotes):
+        pairs = [
+            ('METHOD', 'CallbackResponse'),
+            ('CURRENCYCODE', self.request.POST.get('CURRENCYCODE', 'GBP')),
+        ]
+        for index, (name, charge) in enumerate(shipping_quotes):
+            pairs.append(('L_SHIPPINGOPTIONNAME%d' % index, name))
+            pairs.append(('L_SHIPPINGOPTIONLABEL%d' % index, name))
             pairs.append(('L_SHIPPINGOPTIONAMOUNT%d' % index, charge))
             # For now, we assume tax and insurance to be zero
             pairs.append(('L_TAXAMT%d' % index, D('0.00')))
@@ -438,10 +506,49 @@ class ShippingOptionsView(View):
             # No shipping methods available - we flag this up to PayPal indicating that we
             # do not ship to the shipping address.
             pairs.append(('NO_SHIPPING_OPTION_DETAILS', 1))
-        payload = urlencode(pairs)
+        payload = nvp.encode(pairs)
         return HttpResponse(payload)
 
     def get_shipping_methods(self, user, basket, shipping_address):
         repo = Repository()
         return repo.get_shipping_methods(
             user, basket, shipping_addr=shipping_address)
+
+
+class ConfirmationStatusView(View):
+    """
+    Shows the progress of a payment that is being confirmed in the background.
+
+    The page refreshes itself until the confirmation is finished, and AJAX
+    requests get the status as JSON.  Once the payment is confirmed, the
+    customer is sent on to the thank-you page.
+    """
+    template_name = 'paypal/express/confirmation_status.html'
+
+    def get(self, request, *args, **kwargs):
+        order = get_object_or_404(Order, number=kwargs['order_number'])
+        # Only the customer who placed the order can see its status
+        if request.session.get('checkout_order_id') != order.id:
+            raise Http404
+        pending = get_object_or_404(ExpressConfirmation,
+                                    order_number=order.number)
+        if pending.is_paid:
+            redirect_url = reverse('checkout:thank-you')
+        elif pending.status == ExpressConfirmation.FAILED:
+            redirect_url = reverse('basket:summary')
+        else:
+            redirect_url = None
+
+        if request.is_ajax():
+            return HttpResponse(json.dumps({
+                'status': pending.status,
+                'redirect_url': redirect_url,
+            }), content_type='application/json')
+        if pending.is_paid:
+            return HttpResponseRedirect(redirect_url)
+        return render(request, self.template_name, {
+            'order': order,
+            'confirmation': pending,
+            'poll_interval': getattr(
+                settings, 'PAYPAL_EXPRESS_CONFIRMATION_POLL_INTERVAL', 2),
+        })
@@ -1,42 +1,414 @@
-import requests
+from contextlib import contextmanager
+import logging
+import os
+import threading
 import time
 
-from django.utils.encoding import force_text
-from django.utils.http import urlencode
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3 import connectionpool
+from django.conf import settings
+from django.test.signals import setting_changed
 import urlparse
 
-from paypal import exceptions
+from paypal import exceptions, nvp
+
+logger = logging.getLogger('paypal.gateway')
+
+# Pooled sessions, keyed by (scheme, host).  They are thrown away whenever we
+# notice that we are running in a different process to the one that created
+# them, so forked workers never share sockets with their parent.
+_sessions = {}
+_sessions_pid = None
+_sessions_lock = threading.Lock()
+
+
+_local = threading.local()
+
+
+class _TimedHTTPConnection(connectionpool.HTTPConnectionPool.ConnectionCls):
+
+    def connect(self):
+        start_time = time.time()
+        super(_TimedHTTPConnection, self).connect()
+        _local.connect_time = (time.time() - start_time) * 1000.0
+
+
+class _TimedHTTPSConnection(connectionpool.HTTPSConnectionPool.ConnectionCls):
+
+    def connect(self):
+        # Includes the TLS handshake
+        start_time = time.time()
+        super(_TimedHTTPSConnection, self).connect()
+        _local.connect_time = (time.time() - start_time) * 1000.0
+
+
+class _TimedHTTPConnectionPool(connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+
+class _TimedHTTPSConnectionPool(connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+
+class _TimedAdapter(HTTPAdapter):
+    """
+    An adapter that records how long it takes to open each new connection, so
+    ``post`` can tell connecting apart from waiting for PayPal
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super(_TimedAdapter, self).init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _TimedHTTPConnectionPool,
+            'https': _TimedHTTPSConnectionPool,
+        }
+
+
+def _build_session():
+    """
+    Create a session whose connection pool keeps connections to a single host
+    alive between requests.
+    """
+    session = requests.Session()
+    adapter = _TimedAdapter(
+        pool_connections=1,
+        pool_maxsize=getattr(settings, 'PAYPAL_HTTP_POOL_SIZE', 10),
+        pool_block=getattr(settings, 'PAYPAL_HTTP_POOL_BLOCK', False))
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    if not getattr(settings, 'PAYPAL_HTTP_KEEP_ALIVE', True):
+        session.headers['Connection'] = 'close'
+    return session
+
+
+def get_session(url):
+    """
+    Return the pooled session to use for requests to the URL's host.
+
+    Sessions are created lazily (one per endpoint host) and are safe to share
+    between threads.
+    """
+    global _sessions_pid
+    parts = urlparse.urlsplit(url)
+    key = (parts.scheme, parts.netloc)
+    pid = os.getpid()
+    if _sessions_pid == pid:
+        session = _sessions.get(key)
+        if session is not None:
+            return session
+    with _sessions_lock:
+        if _sessions_pid != pid:
+            # We've been forked - drop (but don't close) the parent's
+            # sessions as closing them would tear down its connections.
+            _sessions.clear()
+            _sessions_pid = pid
+        session = _sessions.get(key)
+        if session is None:
+            session = _sessions[key] = _build_session()
+    return session
+
+
+def reset_sessions():
+    """
+    Close all pooled sessions.  New ones are created on the next request.
+    """
+    with _sessions_lock:
+        for session in _sessions.values():
+            session.close()
+        _sessions.clear()
+
+
+def _reset_sessions_on_setting_change(setting, **kwargs):
+    if setting.startswith('PAYPAL_HTTP_'):
+        reset_sessions()
+
+
+setting_changed.connect(_reset_sessions_on_setting_change)
+
+
+class CircuitBreaker(object):
+    """
+    Tracks failed requests to an endpoint.
+
+    The breaker starts closed.  After ``threshold`` consecutive failures it
+    opens, and requests fail straight away for ``reset_timeout`` seconds.  It
+    is then half-open: a single trial request is let through, which closes the
+    breaker if it succeeds and opens it again if it fails.
+    """
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, threshold, reset_timeout):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        """
+        Return whether a request can be sent
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    time.time() - self.opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            # Open, or half-open with the trial request still in flight
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.threshold):
+                self.state = self.OPEN
+                self.opened_at = time.time()
+
+
+# Circuit breakers, keyed by URL
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(url):
+    """
+    Return the circuit breaker for an endpoint, or ``None`` if circuit
+    breaking is disabled
+    """
+    breaker = _breakers.get(url)
+    if breaker is None:
+        threshold = getattr(settings, 'PAYPAL_CIRCUIT_BREAKER_THRESHOLD', 5)
+        if not threshold:
+            return None
+        with _breakers_lock:
+            breaker = _breakers.get(url)
+            if breaker is None:
+                breaker = _breakers[url] = CircuitBreaker(
+                    threshold, getattr(
+                        settings, 'PAYPAL_CIRCUIT_BREAKER_RESET_TIMEOUT', 30))
+    return breaker
+
+
+def reset_circuit_breakers():
+    """
+    Close all circuit breakers
+    """
+    with _breakers_lock:
+        _breakers.clear()
+
+
+def _reset_breakers_on_setting_change(setting, **kwargs):
+    if setting.startswith('PAYPAL_CIRCUIT_BREAKER_'):
+        reset_circuit_breakers()
+
+
+setting_changed.connect(_reset_breakers_on_setting_change)
+
+
+@contextmanager
+def deadline(seconds):
+    """
+    Limit the time spent on requests to PayPal made in this thread within the
+    block.  Requests are given a timeout of whatever time is left, and
+    requests that would start after the deadline fail straight away with
+    ``DeadlineExceeded``.  A nested deadline can only shorten an outer one.
+
+    ``None`` means no deadline.
+    """
+    previous = getattr(_local, 'deadline', None)
+    if seconds is not None:
+        expires = time.time() + seconds
+        if previous is None or expires < previous:
+            _local.deadline = expires
+    try:
+        yield
+    finally:
+        _local.deadline = previous
 
 
-def post(url, params, headers=None):
+def get_remaining_time():
+    """
+    Return the number of seconds left before the current deadline, or ``None``
+    if there isn't one
+    """
+    expires = getattr(_local, 'deadline', None)
+    if expires is None:
+        return None
+    return expires - time.time()
+
+
+def _get_timeout(timeout=None):
+    """
+    Return the timeout for a request, taking the current deadline into account
+    """
+    if timeout is None:
+        timeout = getattr(settings, 'PAYPAL_HTTP_TIMEOUT', 30)
+    remaining = get_remaining_time()
+    if remaining is None:
+        return timeout
+    if remaining <= 0:
+        raise exceptions.DeadlineExceeded(
+            "No time left to make a request to PayPal")
+    if timeout is None:
+        return remaining
+    if isinstance(timeout, tuple):
+        return tuple(min(part, remaining) for part in timeout)
+    return min(timeout, remaining)
+
+
+def post(url, params, headers=None, length_tagged=False, timeout=None):
     """
     Make a POST request to the URL using the key-value pairs.  Return
     a set of key-value pairs.
 
+    Raises ``CircuitOpen`` without making the request if the endpoint is
+    failing, ``DeadlineExceeded`` if the current deadline has passed and
+    ``CommunicationError`` if the request fails in transit.
+
+    The time spent in each phase of the call is returned under ``_timings``
+    (see ``paypal.metrics``).
+
     :url: URL to post to
     :params: Dict of parameters to include in post payload
     :headers: Dict of headers
+    :length_tagged: Whether the response can contain Payflow length-tagged
+                    values
+    :timeout: The timeout for the request, rather than ``PAYPAL_HTTP_TIMEOUT``
+    """
+    encode_start_time = time.time()
+    payload, headers = _encode_request(params, headers)
+    encode_time = (time.time() - encode_start_time) * 1000.0
+    content, start_time, timings = _send(url, payload, headers, timeout)
+    timings['encode_time'] = encode_time
+    return _decode_response(payload, content, start_time, length_tagged,
+                            timings)
+
+
+def post_raw(url, payload, headers=None):
+    """
+    Make a POST request to the URL with an already encoded payload and return
+    the response content, for PayPal endpoints that don't reply with key-value
+    pairs.  Requests share the pooled sessions, circuit breakers and deadlines
+    of ``post``, and raise the same exceptions.
+    """
+    content, __, __ = _send(url, payload, headers or {})
+    return content
+
+
+def _send(url, payload, headers, timeout=None):
+    """
+    Post the payload and return the response content, the time the request
+    was started and the timings of the phases of the call
+    """
+    timeout = _get_timeout(timeout)
+    breaker = get_circuit_breaker(url)
+    if breaker is not None and not breaker.allow_request():
+        raise exceptions.CircuitOpen(
+            "Requests to %s are failing - not trying again yet" % url)
+    _local.connect_time = None
+    start_time = time.time()
+    try:
+        # Streaming returns as soon as the headers are in, so reading the
+        # body can be timed separately
+        response = get_session(url).post(
+            url, payload,
+            headers=headers, timeout=timeout, stream=True)
+        first_byte_time = time.time()
+        content = response.content
+    except requests.RequestException as e:
+        if breaker is not None:
+            breaker.record_failure()
+        raise exceptions.CommunicationError(
+            "Unable to communicate with PayPal: %s" % e)
+    except BaseException:
+        # Any other error (including timeouts from gevent or eventlet, which
+        # aren't Exceptions) still has to be recorded, or a half-open breaker
+        # would wait forever for its trial request
+        if breaker is not None:
+            breaker.record_failure()
+        raise
+    if response.status_code != requests.codes.ok:
+        if breaker is not None:
+            breaker.record_failure()
+        raise exceptions.PayPalError("Unable to communicate with PayPal")
+    if breaker is not None:
+        breaker.record_success()
+    connect_time = _local.connect_time
+    timings = {
+        'connect_time': connect_time,
+        'connection_reused': connect_time is None,
+        'ttfb': ((first_byte_time - start_time) * 1000.0 -
+                 (connect_time or 0.0)),
+        'read_time': (time.time() - first_byte_time) * 1000.0,
+    }
+    return content, start_time, timings
+
+
+def call_with_retries(func, *args, **kwargs):
+    """
+    Call a function that makes a request to PayPal, retrying with exponential
+    backoff if the request fails before a response is received (eg a
+    connection error or a timeout).  The last error is re-raised once
+    ``PAYPAL_RETRIES`` retries have failed, or when waiting for the next
+    retry would pass the current deadline.
+
+    Only use this for requests that are safe to repeat.
+    """
+    retries = getattr(settings, 'PAYPAL_RETRIES', 2)
+    backoff = getattr(settings, 'PAYPAL_RETRY_BACKOFF', 0.5)
+    attempt = 0
+    while True:
+        try:
+            return func(*args, **kwargs)
+        except exceptions.CommunicationError as e:
+            if attempt >= retries:
+                raise
+            delay = backoff * 2 ** attempt
+            remaining = get_remaining_time()
+            if remaining is not None and delay >= remaining:
+                raise
+            attempt += 1
+            logger.warning("Request to PayPal failed (%s) - retrying in %.2fs",
+                           e, delay)
+            time.sleep(delay)
+
+
+def _encode_request(params, headers=None):
+    """
+    Return the payload and headers to post for a set of key-value pairs
     """
     if headers is None:
         headers = {}
     if 'Content-type' not in headers:
         headers['Content-type'] = 'text/namevalue; charset=utf-8'
-    payload = urlencode(params)
-    start_time = time.time()
-    response = requests.post(
-        url, payload,
-        headers=headers)
-    if response.status_code != requests.codes.ok:
-        raise exceptions.PayPalError("Unable to communicate with PayPal")
+    return nvp.encode(params), headers
 
-    # Convert response into a simple key-value format
-    pairs = {}
-    for key, values in urlparse.parse_qs(response.content).items():
-        pairs[force_text(key)] = force_text(values[0])
+
+def _decode_response(payload, content, start_time, length_tagged=False,
+                     timings=None):
+    """
+    Convert the response content into a simple key-value format and add the
+    audit information
+    """
+    decode_start_time = time.time()
+    pairs = nvp.decode(content, length_tagged=length_tagged)
+    end_time = time.time()
 
     # Add audit information
     pairs['_raw_request'] = payload
-    pairs['_raw_response'] = response.content
-    pairs['_response_time'] = (time.time() - start_time) * 1000.0
+    pairs['_raw_response'] = content
+    pairs['_response_time'] = (end_time - start_time) * 1000.0
+    timings = dict(timings or {})
+    timings['decode_time'] = (end_time - decode_start_time) * 1000.0
+    pairs['_timings'] = timings
 
     return pairs
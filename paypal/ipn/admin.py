@@ -3,13 +3,31 @@ from . import models
 
 
 class PaymentMessageAdmin(admin.ModelAdmin):
-    list_display = ['transaction_id', 'payment_status', 'date_created']
-    list_filter = ['payment_status']
+    list_display = ['transaction_id', 'txn_type', 'payment_status',
+                    'mc_gross', 'mc_currency', 'verification_status',
+                    'processing_status', 'delivery_count', 'date_created']
+    list_filter = ['payment_status', 'txn_type', 'verification_status',
+                   'processing_status']
+    search_fields = ['transaction_id', 'parent_txn_id', 'pay_key',
+                     'receiver_email']
     readonly_fields = [
         'is_sandbox',
         'transaction_id',
         'raw_message',
         'payment_status',
+        'txn_type',
+        'mc_gross',
+        'mc_currency',
+        'receiver_email',
+        'pay_key',
+        'parent_txn_id',
+        'payment_date',
+        'verification_status',
+        'date_verified',
+        'delivery_count',
+        'processing_status',
+        'processing_error',
+        'date_processed',
         'date_created',
     ]
 
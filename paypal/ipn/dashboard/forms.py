@@ -0,0 +1,23 @@
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+
+class SearchForm(forms.Form):
+    """
+    Filters for the list of IPN messages.  Each field is an indexed column of
+    ``PaymentMessage``.
+    """
+    transaction_id = forms.CharField(
+        required=False, label=_("Transaction ID"))
+    parent_txn_id = forms.CharField(
+        required=False, label=_("Parent transaction ID"))
+    pay_key = forms.CharField(required=False, label=_("Pay key"))
+    txn_type = forms.CharField(required=False, label=_("Transaction type"))
+    payment_status = forms.CharField(
+        required=False, label=_("Payment status"))
+    receiver_email = forms.CharField(
+        required=False, label=_("Receiver email"))
+
+    def get_filters(self):
+        return dict((name, value) for name, value in self.cleaned_data.items()
+                    if value)
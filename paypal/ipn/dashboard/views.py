@@ -1,5 +1,6 @@
 from django.views import generic
 from paypal.ipn import models
+from paypal.ipn.dashboard import forms
 
 
 class PaymentsListView(generic.ListView):
@@ -7,9 +8,23 @@ class PaymentsListView(generic.ListView):
     template_name = 'paypal/ipn/dashboard/payment/messages_list.html'
     context_object_name = 'payment_messages'
 
+    def get_queryset(self):
+        # The list only shows the extracted fields, so there's no need to
+        # load the raw messages
+        queryset = super(PaymentsListView, self).get_queryset().defer(
+            'raw_message')
+        self.form = forms.SearchForm(self.request.GET)
+        if self.form.is_valid():
+            queryset = queryset.filter(**self.form.get_filters())
+        return queryset
+
+    def get_context_data(self, **kwargs):
+        ctx = super(PaymentsListView, self).get_context_data(**kwargs)
+        ctx['form'] = self.form
+        return ctx
+
 
 class PaymentDetailView(generic.DetailView):
     model = models.PaymentMessage
     template_name = 'paypal/ipn/dashboard/payment/message_detail.html'
     context_object_name = 'payment_message'
-
@@ -0,0 +1,104 @@
+"""
+The IPN fields that are stored in columns of their own, so that messages can
+be filtered without parsing ``raw_message``.
+"""
+import codecs
+import datetime
+from decimal import Decimal as D, InvalidOperation
+import re
+
+from django.conf import settings
+from django.utils import timezone
+
+from paypal import nvp
+
+# PayPal gives payment dates in its own timezone, eg
+# '20:12:59 Jan 13, 2009 PST'
+PAYMENT_DATE_FORMAT = '%H:%M:%S %b %d, %Y'
+TIMEZONE_OFFSETS = {
+    'PST': datetime.timedelta(hours=-8),
+    'PDT': datetime.timedelta(hours=-7),
+}
+
+# Values are percent-encoded in the charset named by the message, which is
+# windows-1252 unless the seller has changed it
+DEFAULT_CHARSET = 'windows-1252'
+CHARSET_RE = re.compile(r'(?:^|&)charset=([-\w.:]+)')
+
+
+def get_charset(raw_message):
+    """
+    Return the name of the charset that a raw message is encoded in
+    """
+    match = CHARSET_RE.search(raw_message)
+    if match:
+        try:
+            return codecs.lookup(match.group(1)).name
+        except LookupError:
+            pass
+    return DEFAULT_CHARSET
+
+
+def decode(raw_message, multi=False):
+    """
+    Decode the key-value pairs of a raw message, using its charset.  Values
+    that aren't valid in that charset are decoded as latin-1 rather than
+    losing the whole message.
+    """
+    decode_pairs = nvp.decode_multi if multi else nvp.decode
+    try:
+        return decode_pairs(raw_message, encoding=get_charset(raw_message))
+    except ValueError:
+        return decode_pairs(raw_message, encoding='latin-1')
+
+
+def extract(pairs):
+    """
+    Return the values of the indexed fields of a ``PaymentMessage`` from the
+    decoded key-value pairs of a message.  Adaptive Payments messages name
+    some of them differently, and describe their transactions in a list.
+    """
+    def get(*keys):
+        for key in keys:
+            if pairs.get(key):
+                return pairs[key]
+        return ''
+
+    return {
+        'transaction_id': get('txn_id', 'transaction[0].id')[:32],
+        'payment_status': get('payment_status', 'status')[:32],
+        'pay_key': get('pay_key') or None,
+        'txn_type': get('txn_type', 'transaction_type')[:64],
+        'mc_gross': parse_amount(get('mc_gross')),
+        'mc_currency': get('mc_currency')[:8],
+        'receiver_email': get('receiver_email',
+                              'transaction[0].receiver')[:127],
+        'parent_txn_id': get('parent_txn_id')[:32],
+        'payment_date': parse_payment_date(get('payment_date')),
+    }
+
+
+def parse_amount(value):
+    if not value:
+        return None
+    try:
+        return D(value)
+    except InvalidOperation:
+        return None
+
+
+def parse_payment_date(value):
+    """
+    Return the datetime for a PayPal payment date, or ``None`` if it can't be
+    parsed
+    """
+    try:
+        date_string, zone = value.rsplit(' ', 1)
+        offset = TIMEZONE_OFFSETS[zone]
+        date = datetime.datetime.strptime(date_string, PAYMENT_DATE_FORMAT)
+    except (ValueError, KeyError):
+        return None
+    date = (date - offset).replace(tzinfo=timezone.utc)
+    if not settings.USE_TZ:
+        date = timezone.make_naive(date, timezone.get_default_timezone())
+    return date
@@ -1,8 +1,38 @@
+import hashlib
+
 from django.db import models
+from django.utils.encoding import force_bytes
 from paypal import base
 from django.utils.translation import ugettext_lazy as _
 
+
+def hash_message(raw_message):
+    """
+    Return the hash that identifies repeated deliveries of a message
+    """
+    return hashlib.sha1(force_bytes(raw_message)).hexdigest()
+
+
 class PaymentMessage(base.IPNMessageModel):
+    # Whether PayPal has confirmed that it sent the message
+    PENDING, VERIFIED, INVALID = 'Pending', 'Verified', 'Invalid'
+    VERIFICATION_STATUSES = (
+        (PENDING, _('Pending')),
+        (VERIFIED, _('Verified')),
+        (INVALID, _('Invalid')),
+    )
+
+    # Whether the handlers of the payment_message_verified signal have been
+    # run for the message
+    UNPROCESSED, PROCESSING, PROCESSED, FAILED = (
+        'Unprocessed', 'Processing', 'Processed', 'Failed')
+    PROCESSING_STATUSES = (
+        (UNPROCESSED, _('Unprocessed')),
+        (PROCESSING, _('Processing')),
+        (PROCESSED, _('Processed')),
+        (FAILED, _('Failed')),
+    )
+
     pay_key = models.CharField(
         max_length=64, null=True, blank=True,
         db_index=True)
@@ -11,12 +41,46 @@ class PaymentMessage(base.IPNMessageModel):
     fraud_management_filters = models.CharField(
         max_length=512, blank=True, null=True)
 
+    # Fields of the message, extracted when it is received (see
+    # paypal.ipn.fields).  A txn_type of None means that the message was
+    # stored before these were added and hasn't been backfilled yet.
+    txn_type = models.CharField(
+        max_length=64, null=True, blank=True, db_index=True)
+    mc_gross = models.DecimalField(
+        max_digits=12, decimal_places=2, null=True, blank=True)
+    mc_currency = models.CharField(max_length=8, blank=True)
+    receiver_email = models.CharField(
+        max_length=127, blank=True, db_index=True)
+    parent_txn_id = models.CharField(
+        max_length=32, blank=True, db_index=True)
+    payment_date = models.DateTimeField(null=True, blank=True, db_index=True)
+    verification_status = models.CharField(
+        max_length=16, choices=VERIFICATION_STATUSES, default=PENDING,
+        db_index=True)
+    date_verified = models.DateTimeField(null=True, blank=True)
+
+    # Repeated deliveries of a message are counted against the first rather
+    # than stored again
+    message_hash = models.CharField(max_length=40, editable=False)
+    delivery_count = models.PositiveIntegerField(default=1)
+
+    processing_status = models.CharField(
+        max_length=16, choices=PROCESSING_STATUSES, default=UNPROCESSED,
+        db_index=True)
+    processing_error = models.CharField(max_length=256, blank=True)
+    date_processed = models.DateTimeField(null=True, blank=True)
+
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        unique_together = (
+            ('transaction_id', 'payment_status', 'message_hash'),)
         verbose_name = _('IPN payment message')
         verbose_name_plural = _('IPN payment messages')
 
     def __unicode__(self):
         return self.transaction_id
 
+    @property
+    def is_verified(self):
+        return self.verification_status == self.VERIFIED
@@ -0,0 +1,240 @@
+"""
+Receiving and verifying IPN messages.
+
+``IPNView`` stores each message as it arrives and replies straight away, as
+PayPal keeps re-sending a message until it gets a 200 response.  Verifying the
+message - posting it back to PayPal with ``cmd=_notify-validate`` - happens
+afterwards on a bounded pool of worker threads, which share the gateway's
+pooled connections to PayPal.  Once a message is verified, the
+``payment_message_verified`` signal is sent.
+
+Because of the re-sending, a message can arrive many times over.  Repeats are
+counted against the stored message rather than stored again, and the signal is
+only sent once for each message.
+
+Messages that are left pending, because the queue was full or PayPal couldn't
+be reached, are picked up by the ``paypal_verify_ipn`` management command.
+"""
+import logging
+import os
+import threading
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db.models import F
+from django.test.signals import setting_changed
+from django.utils import timezone
+
+from paypal import gateway, workers
+from paypal.exceptions import PayPalError, PayPalUnavailable
+from paypal.ipn import fields, signals
+from paypal.ipn.models import PaymentMessage, hash_message
+
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+logger = logging.getLogger('paypal.ipn')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_verify_url():
+    """
+    Return the URL to post messages back to.  This follows
+    ``PAYPAL_SANDBOX_MODE`` rather than the ``test_ipn`` flag of the message,
+    which anyone could set.
+    """
+    url = getattr(settings, 'PAYPAL_IPN_VERIFY_URL', None)
+    if url:
+        return url
+    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
+        return 'https://ipnpb.sandbox.paypal.com/cgi-bin/webscr'
+    return 'https://ipnpb.paypal.com/cgi-bin/webscr'
+
+
+def store(raw_message):
+    """
+    Store an IPN message unless it has been stored already.  Returns the
+    message and whether it was created.
+
+    Repeated deliveries of a message - the same transaction, payment status
+    and content - only increment the ``delivery_count`` of the stored one.
+    This is safe when duplicates arrive at the same time: the unique key
+    decides which insert wins.
+
+    :raw_message: The body of the request, exactly as PayPal sent it
+    """
+    pairs = fields.decode(raw_message)
+    values = fields.extract(pairs)
+    key = {
+        'transaction_id': values.pop('transaction_id'),
+        'payment_status': values.pop('payment_status'),
+        'message_hash': hash_message(raw_message),
+    }
+    # Most duplicates are caught here, without a failed insert
+    if _count_delivery(key):
+        return PaymentMessage.objects.get(**key), False
+    try:
+        with atomic():
+            message = PaymentMessage.objects.create(
+                raw_message=raw_message,
+                is_sandbox=pairs.get('test_ipn') == '1',
+                **dict(values, **key))
+    except IntegrityError:
+        # Another request stored the same message first
+        _count_delivery(key)
+        return PaymentMessage.objects.get(**key), False
+    return message, True
+
+
+def _count_delivery(key):
+    return PaymentMessage.objects.filter(**key).update(
+        delivery_count=F('delivery_count') + 1)
+
+
+def receive(raw_message):
+    """
+    Store an IPN message and queue it to be verified, unless it is a repeat of
+    one that has been received already.  Returns the stored message.
+
+    :raw_message: The body of the request, exactly as PayPal sent it
+    """
+    message, created = store(raw_message)
+    if created:
+        submit(message)
+    return message
+
+
+def verify(message_id, attempt=1):
+    """
+    Post a message back to PayPal and record whether PayPal sent it.
+
+    Returns the number of seconds to wait before trying again if PayPal
+    couldn't be reached and the attempt can be retried, or ``None``.
+    """
+    message = PaymentMessage.objects.get(id=message_id)
+    if message.verification_status != PaymentMessage.PENDING:
+        return None
+    payload = 'cmd=_notify-validate'
+    if message.raw_message:
+        payload = '%s&%s' % (payload, message.raw_message)
+    try:
+        content = gateway.call_with_retries(
+            gateway.post_raw, get_verify_url(), payload.encode('latin-1'),
+            {'Content-type': 'application/x-www-form-urlencoded'})
+    except PayPalUnavailable as e:
+        attempts = getattr(settings, 'PAYPAL_IPN_VERIFICATION_ATTEMPTS', 3)
+        if attempt >= attempts:
+            logger.error("Unable to verify IPN message #%s: %s - leaving it "
+                         "pending", message_id, e)
+            return None
+        backoff = getattr(settings, 'PAYPAL_IPN_VERIFICATION_RETRY_BACKOFF',
+                          5.0)
+        delay = backoff * 2 ** (attempt - 1)
+        logger.warning("Unable to verify IPN message #%s (%s) - retrying in "
+                       "%.1fs", message_id, e, delay)
+        return delay
+    except PayPalError as e:
+        logger.error("Unable to verify IPN message #%s: %s", message_id, e)
+        return None
+
+    content = content.strip()
+    if content == b'VERIFIED':
+        status = PaymentMessage.VERIFIED
+    elif content == b'INVALID':
+        status = PaymentMessage.INVALID
+    else:
+        logger.error("Unexpected response verifying IPN message #%s: %r",
+                     message_id, content[:64])
+        return None
+    # Only the first verification counts, if the message was verified more
+    # than once
+    updated = PaymentMessage.objects.filter(
+        id=message_id, verification_status=PaymentMessage.PENDING).update(
+            verification_status=status, date_verified=timezone.now())
+    if not updated:
+        return None
+    if status == PaymentMessage.VERIFIED:
+        process(message_id)
+    else:
+        logger.warning("IPN message #%s is invalid", message_id)
+    return None
+
+
+def process(message_id):
+    """
+    Send the ``payment_message_verified`` signal for a verified message.
+    Returns whether the handlers were run.
+
+    A message moves from ``UNPROCESSED`` to ``PROCESSING`` - which only one
+    caller can do - and then to ``PROCESSED``, or to ``FAILED`` if a handler
+    raises an exception.  So the handlers are run once for each message,
+    however many times it is delivered or verified.
+    """
+    claimed = PaymentMessage.objects.filter(
+        id=message_id, verification_status=PaymentMessage.VERIFIED,
+        processing_status=PaymentMessage.UNPROCESSED).update(
+            processing_status=PaymentMessage.PROCESSING)
+    if not claimed:
+        return False
+    message = PaymentMessage.objects.get(id=message_id)
+    try:
+        signals.payment_message_verified.send(
+            sender=PaymentMessage, message=message)
+    except Exception as e:
+        logger.exception("Unable to process IPN message #%s", message_id)
+        status, error = PaymentMessage.FAILED, ('%s' % e)[:256]
+    else:
+        status, error = PaymentMessage.PROCESSED, ''
+    PaymentMessage.objects.filter(id=message_id).update(
+        processing_status=status, processing_error=error,
+        date_processed=timezone.now())
+    return True
+
+
+def _verify(item):
+    message_id, attempt = item
+    delay = verify(message_id, attempt)
+    if delay is not None:
+        _get_pool().put_later((message_id, attempt + 1), delay)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None or _pool.pid != os.getpid():
+            _pool = workers.WorkerPool(
+                'paypal-ipn', _verify,
+                num_workers=getattr(
+                    settings, 'PAYPAL_IPN_VERIFICATION_WORKERS', 4),
+                max_size=getattr(
+                    settings, 'PAYPAL_IPN_VERIFICATION_QUEUE_SIZE', 10000))
+            _pool.start()
+        return _pool
+
+
+def submit(message):
+    """
+    Queue a message to be verified in the background
+    """
+    if not _get_pool().put((message.id, 1)):
+        # PayPal is waiting on us, so leave the message for
+        # paypal_verify_ipn rather than verifying it here
+        logger.warning("IPN verification queue is full - leaving message #%s "
+                       "pending", message.id)
+
+
+def _reset_pool_on_setting_change(setting, **kwargs):
+    global _pool
+    if setting.startswith('PAYPAL_IPN_VERIFICATION_'):
+        with _pool_lock:
+            if _pool is not None:
+                _pool.stop()
+                _pool = None
+
+
+setting_changed.connect(_reset_pool_on_setting_change)
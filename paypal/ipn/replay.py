@@ -0,0 +1,157 @@
+"""
+Replaying IPN traffic against a receiver, to size it for PayPal's bursts of
+retries.
+
+Messages are read from stored ``PaymentMessage`` rows or from a JSONL file and
+posted to the receiver from a pool of threads, at no more than a given rate.
+Each message can be delivered several times over, as PayPal does when it
+retries.  The receiver should post back to a stand-in for PayPal (eg
+``benchmarks.fakepaypal``) rather than to PayPal itself.
+
+The receiver is expected to use the same database, so the messages it stored
+and the deliveries it suppressed as duplicates can be counted.
+"""
+import json
+from multiprocessing.pool import ThreadPool
+import time
+
+from django.db.models import Max, Sum
+import requests
+from requests.adapters import HTTPAdapter
+
+from paypal.ipn.models import PaymentMessage
+from paypal.workers import RateLimiter
+
+
+def iter_stored_messages(batch_size=500, limit=None):
+    """
+    Yield the raw text of stored messages, oldest first
+    """
+    last_id, count = 0, 0
+    while limit is None or count < limit:
+        size = batch_size if limit is None else min(batch_size, limit - count)
+        rows = list(PaymentMessage.objects.filter(id__gt=last_id).order_by(
+            'id').values_list('id', 'raw_message')[:size])
+        if not rows:
+            return
+        for __, raw_message in rows:
+            yield raw_message
+        last_id = rows[-1][0]
+        count += len(rows)
+
+
+def iter_file_messages(path, limit=None):
+    """
+    Yield the raw text of the messages in a JSONL file.  Each line is either
+    a JSON string or an object with a ``raw_message`` key.
+    """
+    count = 0
+    with open(path) as f:
+        for line in f:
+            if limit is not None and count >= limit:
+                return
+            line = line.strip()
+            if not line:
+                continue
+            message = json.loads(line)
+            if isinstance(message, dict):
+                message = message['raw_message']
+            yield message
+            count += 1
+
+
+def percentile(timings, pct):
+    if not timings:
+        return 0.0
+    timings = sorted(timings)
+    return timings[min(len(timings) - 1, int(len(timings) * pct / 100.0))]
+
+
+class Snapshot(object):
+    """
+    The number of stored messages and the deliveries counted against them
+    """
+
+    def __init__(self):
+        totals = PaymentMessage.objects.aggregate(
+            last_id=Max('id'), deliveries=Sum('delivery_count'))
+        self.last_id = totals['last_id'] or 0
+        self.deliveries = totals['deliveries'] or 0
+
+    def new_messages(self):
+        return PaymentMessage.objects.filter(id__gt=self.last_id)
+
+
+class Result(object):
+
+    def __init__(self):
+        self.num_messages = 0
+        self.acknowledged = 0
+        self.failed = 0
+        self.timings = []
+        self.elapsed = 0.0
+
+    @property
+    def num_deliveries(self):
+        return self.acknowledged + self.failed
+
+    @property
+    def throughput(self):
+        return self.num_deliveries / self.elapsed if self.elapsed else 0.0
+
+
+class Replayer(object):
+    """
+    Posts messages to an IPN receiver
+    """
+
+    def __init__(self, url, concurrency=8, rate=None, repeat=1, timeout=30):
+        self.url = url
+        self.concurrency = concurrency
+        self.rate_limiter = RateLimiter(rate)
+        self.repeat = repeat
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.mount(url, HTTPAdapter(pool_connections=1,
+                                            pool_maxsize=concurrency))
+
+    def deliver(self, raw_message):
+        """
+        Post a message and return whether it was acknowledged, and how long
+        that took in milliseconds
+        """
+        self.rate_limiter.wait()
+        start_time = time.time()
+        try:
+            response = self.session.post(
+                self.url, raw_message.encode('latin-1'), timeout=self.timeout,
+                headers={'Content-Type': 'application/x-www-form-urlencoded'})
+        except requests.RequestException:
+            return False, (time.time() - start_time) * 1000.0
+        return (response.status_code == requests.codes.ok,
+                (time.time() - start_time) * 1000.0)
+
+    def deliveries(self, messages, result):
+        # Repeats are sent together, so that they arrive at the same time
+        for raw_message in messages:
+            result.num_messages += 1
+            for __ in range(self.repeat):
+                yield raw_message
+
+    def run(self, messages):
+        result = Result()
+        pool = ThreadPool(self.concurrency)
+        start_time = time.time()
+        try:
+            for ok, timing in pool.imap_unordered(
+                    self.deliver, self.deliveries(messages, result)):
+                if ok:
+                    result.acknowledged += 1
+                else:
+                    result.failed += 1
+                result.timings.append(timing)
+        finally:
+            pool.close()
+            pool.join()
+        result.elapsed = time.time() - start_time
+        return result
@@ -0,0 +1,4 @@
+from django.dispatch import Signal
+
+# Sent once PayPal has confirmed that it sent an IPN message
+payment_message_verified = Signal(providing_args=['message'])
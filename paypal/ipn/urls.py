@@ -0,0 +1,10 @@
+from django.conf.urls import patterns, url
+from django.views.decorators.csrf import csrf_exempt
+
+from paypal.ipn import views
+
+
+urlpatterns = patterns(
+    '',
+    url(r'^$', csrf_exempt(views.IPNView.as_view()), name='paypal-ipn'),
+)
@@ -0,0 +1,19 @@
+from django.http import HttpResponse
+from django.views.generic import View
+
+from paypal.ipn import receiver
+
+
+class IPNView(View):
+    """
+    Receives IPN messages from PayPal.
+
+    The message is stored and verified in the background (see
+    ``paypal.ipn.receiver``), so PayPal gets its response straight away.
+    """
+
+    def post(self, request, *args, **kwargs):
+        # Form-encoded bodies are ASCII, but latin-1 maps any stray bytes to
+        # characters one-to-one so the message can be posted back unchanged
+        receiver.receive(request.body.decode('latin-1'))
+        return HttpResponse('OK', content_type='text/plain')
@@ -0,0 +1,57 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from paypal.ipn import fields
+from paypal.ipn.models import PaymentMessage, hash_message
+
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    # Django < 1.6
+    from django.db.transaction import commit_on_success as atomic
+
+
+class Command(BaseCommand):
+    help = ("Fill in the indexed fields and hashes of IPN messages that were "
+            "stored before they were extracted when messages are received")
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', default=1000,
+                    help="Number of messages to read and update at a time "
+                         "(default: 1000)"),
+    )
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        num_updated = 0
+        last_id = 0
+        while True:
+            # Only the ID and raw text are read, in batches of increasing ID,
+            # so memory use doesn't grow with the size of the table
+            rows = list(PaymentMessage.objects.filter(
+                Q(txn_type__isnull=True) | Q(message_hash=''),
+                id__gt=last_id).order_by(
+                    'id').values_list('id', 'raw_message')[
+                        :options['batch_size']])
+            if not rows:
+                break
+            with atomic():
+                for message_id, raw_message in rows:
+                    self.update(message_id, raw_message)
+            last_id = rows[-1][0]
+            num_updated += len(rows)
+            self.stdout.write("Updated %d messages" % num_updated)
+        self.stdout.write("Finished in %.1fs: %d messages updated" % (
+            time.time() - start_time, num_updated))
+
+    def update(self, message_id, raw_message):
+        values = fields.extract(fields.decode(raw_message))
+        # These were set when the message was stored, possibly by other code
+        for name in ('transaction_id', 'payment_status', 'pay_key'):
+            del values[name]
+        # Needed before the unique index on (transaction_id, payment_status,
+        # message_hash) can be created
+        values['message_hash'] = hash_message(raw_message)
+        PaymentMessage.objects.filter(id=message_id).update(**values)
@@ -0,0 +1,51 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from paypal.express import confirmation
+from paypal.express.models import ExpressConfirmation
+
+
+class Command(BaseCommand):
+    help = ("Confirm Express payments that were left pending or processing, "
+            "eg because the process that queued them exited")
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than', type='int', default=60,
+                    help="Only confirm payments that have been pending for "
+                         "this many seconds (default: 60)"),
+        make_option('--processing-timeout', type='int', default=600,
+                    help="Also confirm payments that have been processing "
+                         "for this many seconds (default: 600)"),
+    )
+
+    def handle(self, *args, **options):
+        reclaimed = confirmation.reclaim(
+            timezone.now() - datetime.timedelta(
+                seconds=options['processing_timeout']))
+        if reclaimed:
+            self.stdout.write("Reclaimed %d payments left processing"
+                              % reclaimed)
+        cutoff = timezone.now() - datetime.timedelta(
+            seconds=options['older_than'])
+        ids = list(ExpressConfirmation.objects.filter(
+            status=ExpressConfirmation.PENDING,
+            date_updated__lt=cutoff).values_list('id', flat=True))
+        for confirmation_id in ids:
+            # Retries are left for the next run
+            confirmation.process(confirmation_id)
+        counts = dict(
+            (status, ExpressConfirmation.objects.filter(
+                id__in=ids, status=status).count())
+            for status in (ExpressConfirmation.COMPLETE,
+                           ExpressConfirmation.FAILED,
+                           ExpressConfirmation.NEEDS_ATTENTION,
+                           ExpressConfirmation.PENDING))
+        self.stdout.write(
+            "Processed %d pending payments: %d confirmed, %d failed, %d "
+            "needing attention, %d to retry" % (
+                len(ids), counts[ExpressConfirmation.COMPLETE],
+                counts[ExpressConfirmation.FAILED],
+                counts[ExpressConfirmation.NEEDS_ATTENTION],
+                counts[ExpressConfirmation.PENDING]))
@@ -0,0 +1,59 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from paypal.adaptive import bulk
+
+
+class Command(BaseCommand):
+    help = ("Pay the secondary receivers of delayed chained payments by "
+            "calling ExecutePayment for every incomplete payment")
+    option_list = BaseCommand.option_list + (
+        make_option('--workers', type='int', default=4,
+                    help="Number of concurrent requests to PayPal "
+                         "(default: 4)"),
+        make_option('--rate', type='float', default=10.0,
+                    help="Maximum requests per second, or 0 for no limit "
+                         "(default: 10)"),
+        make_option('--batch-size', type='int', default=500,
+                    help="Transactions read per query (default: 500)"),
+        make_option('--limit', type='int', default=None,
+                    help="Stop after this many payments"),
+        make_option('--checkpoint', default=None,
+                    help="File to save progress to, and resume from"),
+    )
+
+    def handle(self, *args, **options):
+        checkpoint = bulk.Checkpoint(options['checkpoint'])
+        if checkpoint.last_id:
+            self.stdout.write("Resuming after transaction #%d" %
+                              checkpoint.last_id)
+        initial = dict(checkpoint.counts)
+
+        def attempted():
+            return sum(checkpoint.counts[key] - initial[key]
+                       for key in (bulk.EXECUTED, bulk.FAILED))
+
+        def progress(checkpoint, elapsed):
+            self.stdout.write(
+                "Up to transaction #%d: %d executed, %d failed, %d skipped "
+                "(%.1f payments/s)" % (
+                    checkpoint.last_id, checkpoint.counts[bulk.EXECUTED],
+                    checkpoint.counts[bulk.FAILED],
+                    checkpoint.counts[bulk.SKIPPED],
+                    attempted() / elapsed if elapsed else 0.0))
+
+        executor = bulk.BulkExecutor(
+            workers=options['workers'], rate=options['rate'] or None,
+            batch_size=options['batch_size'], limit=options['limit'],
+            checkpoint=checkpoint, progress=progress)
+        start_time = time.time()
+        executor.run()
+        elapsed = time.time() - start_time
+        self.stdout.write(
+            "Finished in %.1fs: %d executed, %d failed (%.1f payments/s)" % (
+                elapsed,
+                checkpoint.counts[bulk.EXECUTED] - initial[bulk.EXECUTED],
+                checkpoint.counts[bulk.FAILED] - initial[bulk.FAILED],
+                attempted() / elapsed if elapsed else 0.0))
@@ -0,0 +1,90 @@
+from optparse import make_option
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paypal.ipn import replay
+from paypal.ipn.models import PaymentMessage
+
+
+class Command(BaseCommand):
+    help = ("Replay stored IPN messages, or those in a JSONL file, against an "
+            "IPN receiver and report how it copes")
+    option_list = BaseCommand.option_list + (
+        make_option('--url', default='http://127.0.0.1:8000/paypal/ipn/',
+                    help="URL of the receiver (default: "
+                         "http://127.0.0.1:8000/paypal/ipn/)"),
+        make_option('--file',
+                    help="JSONL file of messages to replay, rather than the "
+                         "stored messages"),
+        make_option('--limit', type='int',
+                    help="Number of messages to replay"),
+        make_option('--repeat', type='int', default=1,
+                    help="Number of times to deliver each message (default: "
+                         "1)"),
+        make_option('--concurrency', type='int', default=8,
+                    help="Number of deliveries in flight at once (default: "
+                         "8)"),
+        make_option('--rate', type='float', default=0.0,
+                    help="Maximum deliveries per second, or 0 for no limit "
+                         "(default: 0)"),
+        make_option('--wait', type='float', default=0.0,
+                    help="Seconds to wait for the new messages to be "
+                         "verified (default: 0)"),
+    )
+
+    def handle(self, *args, **options):
+        if options['repeat'] < 1 or options['concurrency'] < 1:
+            raise CommandError("--repeat and --concurrency must be at least 1")
+        if options['file']:
+            messages = replay.iter_file_messages(
+                options['file'], options['limit'])
+        else:
+            # Read before anything is delivered, as the receiver adds to the
+            # same table
+            messages = list(replay.iter_stored_messages(
+                limit=options['limit']))
+        replayer = replay.Replayer(
+            options['url'], concurrency=options['concurrency'],
+            rate=options['rate'] or None, repeat=options['repeat'])
+
+        snapshot = replay.Snapshot()
+        result = replayer.run(messages)
+        self.stdout.write(
+            "Replayed %d deliveries of %d messages in %.2fs (%.0f "
+            "deliveries/s): %d acknowledged, %d failed" % (
+                result.num_deliveries, result.num_messages, result.elapsed,
+                result.throughput, result.acknowledged, result.failed))
+        self.stdout.write(
+            "Acknowledgement latency: p50 %.1fms  p99 %.1fms  max %.1fms" % (
+                replay.percentile(result.timings, 50),
+                replay.percentile(result.timings, 99),
+                max(result.timings or [0.0])))
+
+        after = replay.Snapshot()
+        num_stored = snapshot.new_messages().count()
+        num_counted = after.deliveries - snapshot.deliveries
+        self.stdout.write(
+            "Stored %d new messages; suppressed %d duplicate deliveries" % (
+                num_stored, num_counted - num_stored))
+
+        if num_stored:
+            self.report_verification(snapshot, options['wait'])
+
+    def report_verification(self, snapshot, wait):
+        start_time = time.time()
+        while True:
+            pending = snapshot.new_messages().filter(
+                verification_status=PaymentMessage.PENDING).count()
+            elapsed = time.time() - start_time
+            if not pending or elapsed >= wait:
+                break
+            time.sleep(0.5)
+        counts = dict(
+            (status, snapshot.new_messages().filter(
+                verification_status=status).count())
+            for status in (PaymentMessage.VERIFIED, PaymentMessage.INVALID))
+        self.stdout.write(
+            "Verification after %.1fs: %d verified, %d invalid, %d pending" % (
+                elapsed, counts[PaymentMessage.VERIFIED],
+                counts[PaymentMessage.INVALID], pending))
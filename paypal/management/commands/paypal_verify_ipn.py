@@ -0,0 +1,49 @@
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from paypal.ipn import receiver
+from paypal.ipn.models import PaymentMessage
+
+
+class Command(BaseCommand):
+    help = ("Verify IPN messages that were left pending, eg because the "
+            "verification queue was full or PayPal couldn't be reached, and "
+            "process verified messages that were left unprocessed")
+    option_list = BaseCommand.option_list + (
+        make_option('--older-than', type='int', default=60,
+                    help="Only verify messages that have been pending for "
+                         "this many seconds (default: 60)"),
+    )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - datetime.timedelta(
+            seconds=options['older_than'])
+        ids = list(PaymentMessage.objects.filter(
+            verification_status=PaymentMessage.PENDING,
+            date_created__lt=cutoff).values_list('id', flat=True))
+        for message_id in ids:
+            # Messages that can't be verified yet are left for the next run
+            receiver.verify(message_id)
+        # Messages whose handlers weren't run, eg because the process exited
+        # after verifying them
+        unprocessed = PaymentMessage.objects.filter(
+            verification_status=PaymentMessage.VERIFIED,
+            processing_status=PaymentMessage.UNPROCESSED,
+            date_verified__lt=cutoff).values_list('id', flat=True)
+        num_processed = len([
+            message_id for message_id in list(unprocessed)
+            if receiver.process(message_id)])
+        counts = dict(
+            (status, PaymentMessage.objects.filter(
+                id__in=ids, verification_status=status).count())
+            for status in (PaymentMessage.VERIFIED, PaymentMessage.INVALID,
+                           PaymentMessage.PENDING))
+        self.stdout.write(
+            "Checked %d pending messages: %d verified, %d invalid, %d still "
+            "pending; processed %d verified messages" % (
+                len(ids), counts[PaymentMessage.VERIFIED],
+                counts[PaymentMessage.INVALID],
+                counts[PaymentMessage.PENDING], num_processed))
@@ -0,0 +1,362 @@
+"""
+Timings of the calls made to PayPal.
+
+``paypal.gateway.post`` breaks each call down into phases, all in
+milliseconds:
+
+* ``encode_time`` - encoding the request parameters
+* ``connect_time`` - opening the connection, including the TLS handshake.
+  ``None`` when a pooled connection was reused (``connection_reused``).
+* ``ttfb`` - from sending the request to receiving the response headers,
+  which is mostly PayPal's processing time
+* ``read_time`` - reading the response body
+* ``decode_time`` - parsing the response
+
+These are stored on the transaction models.  Once the transaction has been
+saved, the timings are passed to each function listed (by dotted path) in
+``PAYPAL_METRICS_HOOKS`` along with ``response_time`` and ``persist_time``, the
+time spent saving the transaction.  Hooks are called as
+``hook(api, method, txn, timings)`` where ``api`` is ``'express'``,
+``'adaptive'`` or ``'payflow'`` and ``method`` is the Express method, Adaptive
+action or Payflow TRXTYPE.
+
+The timings are also collected in an in-process registry (``REGISTRY``) of
+latency histograms, failure counters and in-flight gauges, which
+``paypal.dashboard`` serves in the Prometheus text format.  The registry is
+per process, so scrape each worker or aggregate them in your monitoring.
+"""
+from contextlib import contextmanager
+import importlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.test.signals import setting_changed
+from django.utils import six
+
+from paypal import audit, exceptions
+
+logger = logging.getLogger('paypal.metrics')
+
+# The timings that are stored on the transaction models
+MODEL_FIELDS = ('encode_time', 'connect_time', 'connection_reused', 'ttfb',
+                'read_time', 'decode_time')
+
+# The timings that are collected per phase, and the names of the phases
+PHASES = (
+    ('encode_time', 'encode'),
+    ('connect_time', 'connect'),
+    ('ttfb', 'ttfb'),
+    ('read_time', 'read'),
+    ('decode_time', 'decode'),
+    ('persist_time', 'persist'),
+)
+
+# Upper bounds of the latency histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0)
+
+_hooks = None
+_hooks_lock = threading.Lock()
+
+
+def _import(path):
+    module_name, __, attr = path.rpartition('.')
+    try:
+        return getattr(importlib.import_module(module_name), attr)
+    except (ImportError, AttributeError, ValueError) as e:
+        raise ImproperlyConfigured(
+            "Unable to import PayPal metrics hook %r: %s" % (path, e))
+
+
+def get_hooks():
+    """
+    Return the functions to call with the timings of each call to PayPal
+    """
+    global _hooks
+    if _hooks is None:
+        with _hooks_lock:
+            if _hooks is None:
+                _hooks = [
+                    _import(hook) if isinstance(hook, six.string_types)
+                    else hook
+                    for hook in getattr(settings, 'PAYPAL_METRICS_HOOKS', ())]
+    return _hooks
+
+
+def _reset_hooks_on_setting_change(setting, **kwargs):
+    global _hooks
+    if setting == 'PAYPAL_METRICS_HOOKS':
+        with _hooks_lock:
+            _hooks = None
+
+
+setting_changed.connect(_reset_hooks_on_setting_change)
+
+
+def _escape(value):
+    return six.text_type(value).replace('\\', '\\\\').replace(
+        '\n', '\\n').replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric(object):
+    """
+    A family of time series, one for each combination of label values
+    """
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError("%s takes the labels %s" % (
+                self.name, ', '.join(self.labels)))
+        return tuple(six.text_type(labels[name]) for name in self.labels)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labels, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, _escape(value)) for name, value in pairs)
+
+    def get(self, **labels):
+        """
+        Return the current value of a time series
+        """
+        return self._values.get(self._key(labels))
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def samples(self):
+        """
+        Return (suffix, label text, value) tuples for every time series
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+        return [('', self._format_labels(key), value)
+                for key, value in values]
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.documentation),
+                 '# TYPE %s %s' % (self.name, self.type)]
+        for suffix, labels, value in self.samples():
+            lines.append('%s%s%s %s' % (self.name, suffix, labels,
+                                        _format_value(value)))
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Counts observations in cumulative buckets, as Prometheus expects
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # A count per bucket, then the sum of all observations
+                counts = self._values[key] = [0] * len(self.buckets) + [0.0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            counts[-1] += value
+
+    def get(self, **labels):
+        """
+        Return the number and sum of the observations for a time series
+        """
+        counts = self._values.get(self._key(labels))
+        if counts is None:
+            return 0, 0.0
+        return sum(counts[:-1]), counts[-1]
+
+    def samples(self):
+        with self._lock:
+            values = sorted((key, list(counts))
+                            for key, counts in self._values.items())
+        samples = []
+        for key, counts in values:
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                samples.append(('_bucket', self._format_labels(
+                    key, [('le', _format_value(bound))]), total))
+            labels = self._format_labels(key)
+            samples.append(('_sum', labels, counts[-1]))
+            samples.append(('_count', labels, total))
+        return samples
+
+
+class Registry(object):
+    """
+    A collection of metrics that can be rendered in the Prometheus text
+    exposition format
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        """
+        Reset every metric
+        """
+        for metric in self.metrics:
+            metric.clear()
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'paypal_request_duration_seconds',
+    "Time taken by calls to PayPal, from sending the request to decoding the "
+    "response",
+    labels=('api', 'method')))
+PHASE_DURATION = REGISTRY.register(Histogram(
+    'paypal_request_phase_duration_seconds',
+    "Time taken by each phase of the calls to PayPal",
+    labels=('api', 'method', 'phase')))
+FAILURES = REGISTRY.register(Counter(
+    'paypal_request_failures_total',
+    "Calls to PayPal that were answered with a failure, by error code",
+    labels=('api', 'method', 'error_code')))
+ERRORS = REGISTRY.register(Counter(
+    'paypal_request_errors_total',
+    "Calls to PayPal that failed without a response",
+    labels=('api', 'method', 'error')))
+IN_FLIGHT = REGISTRY.register(Gauge(
+    'paypal_requests_in_flight',
+    "Calls to PayPal that are waiting for a response",
+    labels=('api', 'method')))
+
+
+@contextmanager
+def track(api, method):
+    """
+    Count a call to PayPal as in flight for the duration of the block, and
+    count the error if it fails
+    """
+    IN_FLIGHT.inc(api=api, method=method)
+    try:
+        yield
+    except exceptions.PayPalError as e:
+        ERRORS.inc(api=api, method=method, error=type(e).__name__)
+        raise
+    finally:
+        IN_FLIGHT.dec(api=api, method=method)
+
+
+def _get_error_code(txn):
+    """
+    Return the error code of a failed transaction, or ``None`` if it was
+    successful
+    """
+    if hasattr(txn, 'is_successful'):
+        # Express and Adaptive
+        if txn.is_successful:
+            return None
+        return txn.error_code or 'unknown'
+    # Payflow
+    if txn.is_approved:
+        return None
+    return txn.result or 'unknown'
+
+
+def observe(api, method, txn, timings):
+    """
+    Add the timings and outcome of a call to the registry
+    """
+    if timings.get('response_time') is not None:
+        REQUEST_DURATION.observe(timings['response_time'] / 1000.0,
+                                 api=api, method=method)
+    for name, phase in PHASES:
+        if timings.get(name) is not None:
+            PHASE_DURATION.observe(timings[name] / 1000.0,
+                                   api=api, method=method, phase=phase)
+    error_code = _get_error_code(txn)
+    if error_code is not None:
+        FAILURES.inc(api=api, method=method, error_code=error_code)
+
+
+def model_fields(pairs):
+    """
+    Return the timings from a gateway response as transaction model fields
+    """
+    timings = pairs.get('_timings', {})
+    return dict((name, timings[name]) for name in MODEL_FIELDS
+                if name in timings)
+
+
+def save(txn, api, method, pairs):
+    """
+    Persist a transaction (see ``paypal.audit.save``) and report the timings of
+    the call that it records to the metrics hooks
+    """
+    start_time = time.time()
+    audit.save(txn, method)
+    persist_time = (time.time() - start_time) * 1000.0
+
+    timings = dict(pairs.get('_timings', {}))
+    timings['response_time'] = pairs.get('_response_time')
+    timings['persist_time'] = persist_time
+    observe(api, method, txn, timings)
+    for hook in get_hooks():
+        try:
+            hook(api, method, txn, timings)
+        except Exception:
+            # Metrics must never get in the way of a payment
+            logger.exception("PayPal metrics hook %r failed", hook)
@@ -0,0 +1,191 @@
+"""
+Encoding and decoding of PayPal's name-value pair (NVP) format.
+
+All three integrations use this module for request payloads and for parsing
+responses (both straight off the wire and from the raw text stored on the
+transaction models).
+
+Decoding splits the content into pairs in a single pass, then unquotes and
+decodes all the keys and values in one go, and preserves the order of the
+pairs.  A few rules worth knowing:
+
+* Pairs are separated by ``&`` only (``;`` is not treated as a separator as
+  PayPal never uses it and it can appear in Payflow messages).
+* Pairs with a blank value are skipped unless ``keep_blank_values`` is set,
+  which matches how ``parse_qs`` behaves.
+* When a key appears more than once, ``decode`` keeps the *first* value and
+  ``decode_multi`` keeps all of them, in order.
+* Percent-encoded values are decoded as UTF-8 unless another ``encoding`` is
+  given (IPN messages use the charset named in the message).
+* Payflow Pro can return length-tagged values (``NAME[len]=value``) where the
+  value is exactly ``len`` characters long and is not URL-encoded - so it may
+  contain ``&`` or ``=``.  These are only recognised when ``length_tagged`` is
+  set.
+"""
+from collections import OrderedDict
+import re
+
+from django.utils import six
+from django.utils.encoding import force_str, force_text
+from django.utils.six.moves.urllib.parse import quote_plus, unquote_plus
+
+
+def encode(params):
+    """
+    Encode a dict (or sequence of key-value pairs) as an NVP payload.
+
+    This produces the same output as ``django.utils.http.urlencode`` for
+    single-valued parameters.
+    """
+    if hasattr(params, 'items'):
+        params = params.items()
+    needs_quoting = _needs_quoting
+    parts = []
+    append = parts.append
+    for pair in params:
+        for item in pair:
+            if not isinstance(item, str):
+                item = force_str(item)
+            # Most keys and values (names, amounts, codes) need no escaping
+            if needs_quoting(item) is not None:
+                item = quote_plus(item)
+            append(item)
+    return '&'.join(['%s=%s' % pair
+                     for pair in zip(parts[::2], parts[1::2])])
+
+
+# Matches a character that ``quote_plus`` would escape
+_needs_quoting = re.compile(r'[^A-Za-z0-9_.-]').search
+
+
+def decode(content, length_tagged=False, keep_blank_values=False,
+           encoding='utf-8'):
+    """
+    Decode NVP content into an ordered dict of text keys and values.  The first
+    value wins for duplicated keys.
+    """
+    pairs = OrderedDict()
+    for key, value in _pairs(content, length_tagged, keep_blank_values,
+                             encoding):
+        if key not in pairs:
+            pairs[key] = value
+    return pairs
+
+
+def decode_multi(content, length_tagged=False, keep_blank_values=False,
+                 encoding='utf-8'):
+    """
+    Decode NVP content into an ordered dict mapping each key to the list of
+    its values (the same shape as ``parse_qs`` returns).
+    """
+    pairs = OrderedDict()
+    for key, value in _pairs(content, length_tagged, keep_blank_values,
+                             encoding):
+        if key in pairs:
+            pairs[key].append(value)
+        else:
+            pairs[key] = [value]
+    return pairs
+
+
+def _pairs(content, length_tagged, keep_blank_values, encoding):
+    if not content:
+        return []
+    if six.PY3:
+        content = force_text(content, encoding)
+    elif isinstance(content, six.text_type):
+        # Percent-decoding has to happen on bytes in Python 2 so multi-byte
+        # characters are decoded correctly.
+        content = content.encode(encoding)
+
+    if length_tagged and '[' in content:
+        return _tagged_pairs(content, keep_blank_values, encoding)
+
+    parts = []
+    append = parts.append
+    for key, __, value in (chunk.partition('=')
+                           for chunk in content.split('&')):
+        if not key:
+            continue
+        if not value:
+            if not keep_blank_values:
+                continue
+            value = ''
+        append(key)
+        append(value)
+    parts = _unquote_all(parts, content, encoding)
+    return list(zip(parts[::2], parts[1::2]))
+
+
+def _unquote_all(parts, content, encoding):
+    """
+    Unquote and decode a list of keys and values.  They are joined with
+    newlines so the whole payload is unquoted and decoded in one go, unless
+    the content contains a newline (escaped or not) that would break the
+    split.
+    """
+    if '\n' in content or '%0A' in content or '%0a' in content:
+        return [_unquote(part, encoding) for part in parts]
+    return _unquote('\n'.join(parts), encoding).split('\n')
+
+
+def _tagged_pairs(content, keep_blank_values, encoding):
+    pairs = []
+    append = pairs.append
+    for key, value, is_tagged in _split_tagged(content):
+        if not key:
+            continue
+        if not value:
+            if not keep_blank_values:
+                continue
+            value = ''
+        if is_tagged:
+            append((_unquote(key, encoding), force_text(value, encoding)))
+        else:
+            append((_unquote(key, encoding), _unquote(value, encoding)))
+    return pairs
+
+
+def _split_tagged(content):
+    """
+    Split content that may contain length-tagged values into
+    (key, value, is_tagged) triples
+    """
+    pos, end = 0, len(content)
+    while pos < end:
+        equals = content.find('=', pos)
+        amp = content.find('&', pos)
+        if equals == -1 or -1 < amp < equals:
+            # A chunk without a value
+            chunk_end = end if amp == -1 else amp
+            yield content[pos:chunk_end], None, False
+            pos = chunk_end + 1
+            continue
+        key = content[pos:equals]
+        if key.endswith(']') and '[' in key:
+            bracket = key.rindex('[')
+            length = key[bracket + 1:-1]
+            if length.isdigit():
+                start = equals + 1
+                stop = start + int(length)
+                yield key[:bracket], content[start:stop], True
+                # Skip the separator following the value
+                pos = stop + 1
+                continue
+        value_end = content.find('&', equals + 1)
+        if value_end == -1:
+            value_end = end
+        yield key, content[equals + 1:value_end], False
+        pos = value_end + 1
+
+
+if six.PY3:
+    def _unquote(value, encoding):
+        if '%' in value or '+' in value:
+            return unquote_plus(value, encoding)
+        return value
+else:
+    def _unquote(value, encoding):
+        if '%' in value or '+' in value:
+            value = unquote_plus(value)
+        return value.decode(encoding)
@@ -20,11 +20,18 @@ class TxnAdmin(admin.ModelAdmin):
         'result',
         'respmsg',
         'authcode',
+        'request_id',
         'request',
         'response',
         'raw_request',
         'raw_response',
         'response_time',
+        'encode_time',
+        'connect_time',
+        'connection_reused',
+        'ttfb',
+        'read_time',
+        'decode_time',
         'date_created',
     ]
 
@@ -3,11 +3,13 @@ Gateway module - this module should be ignorant of Oscar and could be used in a
 non-Oscar project.  All Oscar-related functionality should be in the facade.
 """
 import logging
+from decimal import Decimal as D
 
 from django.conf import settings
 from django.core import exceptions
+from django.utils.crypto import salted_hmac
 
-from paypal import gateway
+from paypal import exceptions as paypal_exceptions, gateway, metrics
 from paypal.payflow import models
 from paypal.payflow import codes
 
@@ -128,12 +130,140 @@ def void(order_number, pnref):
     return _transaction(params)
 
 
-def _transaction(extra_params):
+def _transaction(extra_params, request_id=None):
     """
     Perform a transaction with PayPal.
 
+    Each transaction is sent with a request ID (see ``get_request_id``).
+    PayPal recognises a repeated request ID and returns the original response
+    rather than processing the transaction again, so a request that fails in
+    transit - a connection error or a timeout - is retried with the same ID.
+    If a response has already been recorded for the ID, the recorded
+    transaction is returned without contacting PayPal at all.
+
     :extra_params: Additional parameters to include in the payload other than
     the user credentials.
+    :request_id: The request ID to use, rather than one derived from the
+                 request (see ``get_request_id``)
+    """
+    url, params = _build_request(extra_params)
+    request_id, txn = _prepare_request_id(params, request_id)
+    if txn is not None:
+        return txn
+    headers = {'X-VPS-REQUEST-ID': request_id}
+    try:
+        pairs = gateway.call_with_retries(_post, url, params, headers)
+    except paypal_exceptions.PayPalUnavailable as e:
+        logger.error("Unable to complete %s transaction with request ID %s: "
+                     "%s", params['TRXTYPE'], request_id, e)
+        raise
+    return _handle_response(params, pairs, request_id)
+
+
+def _post(url, params, headers):
+    with metrics.track('payflow', params['TRXTYPE']):
+        return gateway.post(
+            url, params, dict(headers), length_tagged=True,
+            timeout=getattr(settings, 'PAYPAL_PAYFLOW_TIMEOUT', None))
+
+
+# The parameters, besides the order number and TRXTYPE, that identify what is
+# being requested.  Changing any of them (eg paying with another card) makes a
+# new request rather than a repeat of the last one.
+REQUEST_ID_PARAMS = ('AMT', 'CURRENCY', 'TENDER', 'ACCT', 'EXPDATE', 'CVV2',
+                     'ORIGID')
+
+
+def get_request_id(params, attempt):
+    """
+    Return the request ID (X-VPS-REQUEST-ID) for a transaction.  The ID is
+    derived from the order number, TRXTYPE, amount and tender details (the
+    card, or the original transaction) and the attempt, so repeating a request
+    that didn't get a response always sends the same ID.  It is an HMAC, so
+    the card details can't be recovered from it.
+    """
+    value = '|'.join(
+        ['%s' % params.get(key, '')
+         for key in ('COMMENT1', 'TRXTYPE') + REQUEST_ID_PARAMS] +
+        ['%s' % attempt])
+    return salted_hmac('paypal.payflow.request_id', value).hexdigest()[:32]
+
+
+def _get_attempt(order_number, trxtype):
+    """
+    Return the number of the next attempt at a type of transaction for an
+    order: one more than the number of request IDs with a recorded response.
+    A request that never got a response doesn't count, so it is repeated with
+    the same ID.
+    """
+    return models.PayflowTransaction.objects.filter(
+        comment1=order_number, trxtype=trxtype).exclude(
+            request_id=None).values('request_id').distinct().count() + 1
+
+
+def _get_recorded_txn(params, request_id):
+    """
+    Return the transaction recorded for a request ID, if there is one.  Raises
+    ``PayPalError`` if it was recorded for a different order, TRXTYPE or
+    amount, as PayPal would return its response for this request too.
+    """
+    txns = list(models.PayflowTransaction.objects.filter(
+        request_id=request_id).order_by('id')[:1])
+    if not txns:
+        return None
+    txn = txns[0]
+    if (txn.comment1 != params['COMMENT1'] or
+            txn.trxtype != params['TRXTYPE'] or
+            ('AMT' in params and txn.amount != D(params['AMT']))):
+        raise paypal_exceptions.PayPalError(
+            "Request ID %s was used for %s transaction #%s for order %s, "
+            "not this %s transaction for order %s" % (
+                request_id, txn.trxtype, txn.id, txn.comment1,
+                params['TRXTYPE'], params['COMMENT1']))
+    return txn
+
+
+def _prepare_request_id(params, request_id=None):
+    """
+    Return the request ID for a transaction and the transaction already
+    recorded for it, if there is one
+    """
+    if request_id is None:
+        request_id = get_request_id(
+            params, _get_attempt(params['COMMENT1'], params['TRXTYPE']))
+    txn = _get_recorded_txn(params, request_id)
+    if txn is not None:
+        logger.info("%s transaction with request ID %s has already been "
+                    "recorded", params['TRXTYPE'], request_id)
+    return request_id, txn
+
+
+def _handle_response(params, pairs, request_id):
+    """
+    Record the response and return the transaction object.  A response to a
+    repeated request ID is mapped back to the transaction recorded for the
+    original request.
+    """
+    duplicate = pairs.get('DUPLICATE')
+    if duplicate == '1':
+        txn = _get_recorded_txn(params, request_id)
+        if txn is not None:
+            logger.info("%s transaction with request ID %s is a duplicate of "
+                        "transaction #%s", params['TRXTYPE'], request_id,
+                        txn.id)
+            return txn
+        # The response to the original request was lost, so this is the first
+        # we've heard of its result
+    elif duplicate:
+        logger.warning("%s transaction with request ID %s: DUPLICATE=%s",
+                       params['TRXTYPE'], request_id, duplicate)
+    return _record_response(params, pairs, request_id)
+
+
+def _build_request(extra_params):
+    """
+    Validate the transaction parameters and return the URL and full set of
+    parameters (including credentials) to post to PayPal.
     """
     if 'TRXTYPE' not in extra_params:
         raise RuntimeError("All transactions must specify a 'TRXTYPE' paramter")
@@ -179,21 +309,28 @@ def _transaction(extra_params):
                                          'PAYPAL_PAYFLOW_CURRENCY', 'USD')
         params['AMT'] = "%.2f" % params['AMT']
 
-    if getattr(settings, 'PAYPAL_PAYFLOW_PRODUCTION_MODE', False):
-        url = 'https://payflowpro.paypal.com'
-    else:
-        url = 'https://pilot-payflowpro.paypal.com'
+    url = getattr(settings, 'PAYPAL_PAYFLOW_URL', None)
+    if url is None:
+        if getattr(settings, 'PAYPAL_PAYFLOW_PRODUCTION_MODE', False):
+            url = 'https://payflowpro.paypal.com'
+        else:
+            url = 'https://pilot-payflowpro.paypal.com'
 
     logger.info("Performing %s transaction (trxtype=%s)",
                 codes.trxtype_map[trxtype], trxtype)
-    pairs = gateway.post(url, params)
+    return url, params
+
 
+def _record_response(params, pairs, request_id=None):
+    """
+    Record the response from PayPal and return the transaction object.
+    """
     # Beware - this log information will contain the Payflow credentials
     # only use it in development, not production.
     logger.debug("Raw request: %s", pairs['_raw_request'])
     logger.debug("Raw response: %s", pairs['_raw_response'])
 
-    return models.PayflowTransaction.objects.create(
+    txn = models.PayflowTransaction(
         comment1=params['COMMENT1'],
         trxtype=params['TRXTYPE'],
         tender=params.get('TENDER', None),
@@ -206,7 +343,11 @@ def _transaction(extra_params):
         result=pairs.get('RESULT', None),
         respmsg=pairs.get('RESPMSG', None),
         authcode=pairs.get('AUTHCODE', None),
+        request_id=request_id,
         raw_request=pairs['_raw_request'],
         raw_response=pairs['_raw_response'],
-        response_time=pairs['_response_time']
+        response_time=pairs['_response_time'],
+        **metrics.model_fields(pairs)
     )
+    metrics.save(txn, 'payflow', params['TRXTYPE'], pairs)
+    return txn
@@ -13,7 +13,7 @@ from paypal import base
 class PayflowTransaction(base.ResponseModel):
     # This is the linking parameter between the merchant and PayPal.  It is
     # normally set to the order number
-    comment1 = models.CharField(_("Comment 1"), max_length=128, db_index=True)
+    comment1 = models.CharField(_("Comment 1"), max_length=128)
 
     trxtype = models.CharField(_("Transaction type"), max_length=12)
     tender = models.CharField(_("Bankcard or PayPal"), max_length=12, null=True)
@@ -31,6 +31,10 @@ class PayflowTransaction(base.ResponseModel):
     authcode = models.CharField(_("Auth code"), max_length=32, null=True,
                                 blank=True)
 
+    # Sent as X-VPS-REQUEST-ID, so PayPal can recognise a repeated request
+    request_id = models.CharField(_("Request ID"), max_length=32, null=True,
+                                  blank=True, db_index=True)
+
     # Fraud/risk params
     cvv2match = models.CharField(_("CVV2 check"), null=True, blank=True,
                                  max_length=12)
@@ -39,15 +43,19 @@ class PayflowTransaction(base.ResponseModel):
     avszip = models.CharField(_("Zip/Postcode check"), null=True, blank=True,
                                max_length=1)
 
+    nvp_length_tagged = True
+
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
+        # The facade looks up txns by order number and type.  This also serves
+        # lookups by order number alone.
+        index_together = [('comment1', 'trxtype')]
 
-    def save(self, *args, **kwargs):
+    def mask_sensitive_data(self):
         self.raw_request = re.sub(r'PWD=.+?&', 'PWD=XXXXXX&', self.raw_request)
         self.raw_request = re.sub(r'ACCT=\d+(\d{4})&', 'ACCT=XXXXXXXXXXXX\1&', self.raw_request)
         self.raw_request = re.sub(r'CVV2=\d+&', 'CVV2=XXX&', self.raw_request)
-        return super(PayflowTransaction, self).save(*args, **kwargs)
 
     def get_trxtype_display(self):
         return ugettext(codes.trxtype_map.get(self.trxtype, self.trxtype))
@@ -0,0 +1,101 @@
+"""
+In-process cache of the reference data used on every checkout: countries, the
+current site's domain and the paths of our return, cancel and callback URLs.
+
+Everything is loaded lazily.  Countries and the domain are dropped when the
+models are saved or deleted (in this process - other processes only see the
+change once restarted) and URL paths are dropped when ``ROOT_URLCONF`` changes.
+"""
+import threading
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import get_script_prefix, reverse
+from django.db.models import get_model
+from django.db.models.signals import post_delete, post_save
+from django.test.signals import setting_changed
+from django.utils.translation import get_language
+
+_countries = {}
+_domain = {}
+_paths = {}
+_lock = threading.Lock()
+
+# A basket ID used to find where the real one goes in a reversed URL
+_PLACEHOLDER = '1234567890987654321'
+
+
+def _get_country_model():
+    return get_model('address', 'Country')
+
+
+def get_country(code):
+    """
+    Return the Oscar ``Country`` with the given ISO 3166-1 alpha-2 code.
+    Raises ``Country.DoesNotExist`` if there isn't one.
+    """
+    country = _countries.get(code)
+    if country is None:
+        Country = _get_country_model()
+        country = Country._default_manager.get(iso_3166_1_a2=code)
+        with _lock:
+            if not _countries:
+                post_save.connect(_clear_countries, sender=Country,
+                                  dispatch_uid='paypal-refdata-countries')
+                post_delete.connect(_clear_countries, sender=Country,
+                                    dispatch_uid='paypal-refdata-countries')
+            _countries[code] = country
+    return country
+
+
+def get_domain():
+    """
+    Return the domain of the current site
+    """
+    domain = _domain.get(settings.SITE_ID)
+    if domain is None:
+        domain = _domain[settings.SITE_ID] = Site.objects.get_current().domain
+    return domain
+
+
+def get_path(name, basket_id):
+    """
+    Return the path of one of the URLs that take a basket ID (eg
+    ``paypal-success-response``).  Equivalent to ``reverse(name,
+    kwargs={'basket_id': basket_id})`` but only resolves each URL once per
+    language.
+    """
+    key = (name, get_language(), get_script_prefix())
+    parts = _paths.get(key)
+    if parts is None:
+        parts = _paths[key] = reverse(
+            name, kwargs={'basket_id': _PLACEHOLDER}).split(_PLACEHOLDER)
+    return ('%s' % basket_id).join(parts)
+
+
+def clear():
+    with _lock:
+        _countries.clear()
+        _domain.clear()
+        _paths.clear()
+
+
+def _clear_countries(**kwargs):
+    with _lock:
+        _countries.clear()
+
+
+def _clear_domain(**kwargs):
+    _domain.clear()
+
+
+post_save.connect(_clear_domain, sender=Site)
+post_delete.connect(_clear_domain, sender=Site)
+
+
+def _clear_on_setting_change(setting, **kwargs):
+    if setting in ('ROOT_URLCONF', 'SITE_ID'):
+        clear()
+
+
+setting_changed.connect(_clear_on_setting_change)
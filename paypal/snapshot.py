@@ -0,0 +1,153 @@
+"""
+A read-only snapshot of the basket contents that are sent to PayPal.
+
+Reading the title and price of each basket line can trigger queries for the
+line's stock record, its product's class and, for variants, the parent
+product.  ``BasketSnapshot`` loads these for all lines at once, so building a
+request takes the same number of queries whatever the size of the basket.
+
+Formatted product descriptions are memoized per product in a bounded
+in-process cache (``PAYPAL_DESCRIPTION_CACHE_SIZE`` entries, 1000 by default),
+which is dropped for a product when it is saved or deleted.
+"""
+import threading
+
+from django.conf import settings
+from django.db import models
+from django.db.models import get_model
+from django.db.models.fields import FieldDoesNotExist
+from django.db.models.signals import post_delete, post_save
+from django.template.defaultfilters import striptags, truncatewords
+from django.test.signals import setting_changed
+
+from paypal.cache import LRUCache
+
+_descriptions = None
+_descriptions_lock = threading.Lock()
+
+
+def prefetch_related(instances, field_name):
+    """
+    Load the objects referenced by a foreign key for a list of model instances
+    in a single query, and cache them on the instances.  Returns the related
+    objects.
+    """
+    instances = [obj for obj in instances if isinstance(obj, models.Model)]
+    if not instances:
+        return []
+    try:
+        field = instances[0]._meta.get_field(field_name)
+    except FieldDoesNotExist:
+        return []
+    cache_name = field.get_cache_name()
+    ids = set()
+    for obj in instances:
+        value = getattr(obj, field.attname)
+        if value is not None and not hasattr(obj, cache_name):
+            ids.add(value)
+    if ids:
+        related = field.rel.to._default_manager.in_bulk(ids)
+        for obj in instances:
+            value = getattr(obj, field.attname)
+            if value in related and not hasattr(obj, cache_name):
+                setattr(obj, cache_name, related[value])
+    return [getattr(obj, cache_name) for obj in instances
+            if hasattr(obj, cache_name)]
+
+
+def format_description(description):
+    """
+    Return a description as the plain text summary shown by PayPal
+    """
+    if description:
+        return truncatewords(striptags(description), 12)
+    return ''
+
+
+def get_description(product):
+    """
+    Return the formatted description of a product.  The result is memoized
+    per product.
+    """
+    description = product.description
+    if not description:
+        return ''
+    cache = _get_description_cache()
+    cached = cache.get(product.pk)
+    # Comparing the raw description is much cheaper than formatting it, and
+    # catches products changed by another process.
+    if cached is not None and cached[0] == description:
+        return cached[1]
+    summary = format_description(description)
+    if product.pk is not None:
+        cache.set(product.pk, (description, summary))
+    return summary
+
+
+def _get_description_cache():
+    global _descriptions
+    if _descriptions is None:
+        with _descriptions_lock:
+            if _descriptions is None:
+                Product = get_model('catalogue', 'Product')
+                post_save.connect(_forget_description, sender=Product,
+                                  dispatch_uid='paypal-snapshot-descriptions')
+                post_delete.connect(
+                    _forget_description, sender=Product,
+                    dispatch_uid='paypal-snapshot-descriptions')
+                _descriptions = LRUCache(getattr(
+                    settings, 'PAYPAL_DESCRIPTION_CACHE_SIZE', 1000))
+    return _descriptions
+
+
+def _forget_description(instance, **kwargs):
+    if _descriptions is not None:
+        _descriptions.delete(instance.pk)
+
+
+def _reset_descriptions_on_setting_change(setting, **kwargs):
+    global _descriptions
+    if setting == 'PAYPAL_DESCRIPTION_CACHE_SIZE':
+        with _descriptions_lock:
+            _descriptions = None
+
+
+setting_changed.connect(_reset_descriptions_on_setting_change)
+
+
+class LineSnapshot(object):
+    __slots__ = ('product', 'title', 'upc', 'unit_price_incl_tax', 'quantity')
+
+    def __init__(self, line):
+        product = self.product = line.product
+        self.title = product.get_title()
+        self.upc = product.upc
+        self.unit_price_incl_tax = line.unit_price_incl_tax
+        self.quantity = line.quantity
+
+    @property
+    def description(self):
+        """
+        The product's description, formatted for PayPal
+        """
+        return get_description(self.product)
+
+
+class BasketSnapshot(object):
+    """
+    The lines and discounts of a basket
+    """
+
+    def __init__(self, basket):
+        lines = list(basket.all_lines())
+        prefetch_related(lines, 'stockrecord')
+        products = prefetch_related(lines, 'product')
+        parents = prefetch_related(products, 'parent')
+        prefetch_related(products + parents, 'product_class')
+        self.lines = [LineSnapshot(line) for line in lines]
+
+        # Discounts are calculated in memory when offers are applied, so
+        # these (and their vouchers) are already loaded.
+        self.offer_discounts = list(basket.offer_discounts)
+        self.voucher_discounts = list(basket.voucher_discounts)
+        self.shipping_discounts = list(basket.shipping_discounts)
@@ -1,4 +1,4 @@
-from django.contrib.sites.models import Site
+from paypal import refdata
 
 
 def absolute_url(request, path):
@@ -10,5 +10,5 @@ def absolute_url(request, path):
     if 'HTTP_HOST' in request.META:
         domain = request.META['HTTP_HOST']
     else:
-        domain = Site.objects.get_current().domain
+        domain = refdata.get_domain()
     return '%s://%s%s' % (scheme, domain, path)
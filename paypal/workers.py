@@ -0,0 +1,107 @@
+"""
+Helpers for doing work from several threads.
+
+``WorkerPool`` is a pool of background threads that work through a bounded
+queue.  It is used for work that shouldn't hold up the request that causes it,
+like confirming Express payments (``paypal.express.confirmation``) and
+verifying IPN messages (``paypal.ipn.receiver``).  Pools are per process: a
+pool that is used in a forked process is replaced by a new one.
+
+``RateLimiter`` spaces out calls made from several threads, eg when executing
+payments in bulk or replaying IPN messages.
+"""
+import logging
+import os
+import threading
+import time
+
+from django.db import connection
+from django.utils.six.moves import queue
+
+logger = logging.getLogger('paypal.workers')
+
+
+class WorkerPool(object):
+    """
+    Calls ``func`` with each item put in the queue, from ``num_workers``
+    threads
+    """
+
+    def __init__(self, name, func, num_workers, max_size):
+        self.name = name
+        self.func = func
+        self.queue = queue.Queue(max_size)
+        self.pid = os.getpid()
+        self.threads = [
+            threading.Thread(target=self.run, name='%s-%d' % (name, index))
+            for index in range(num_workers)]
+        for thread in self.threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        for __ in self.threads:
+            self.queue.put(None)
+
+    def put(self, item):
+        """
+        Queue an item.  Returns ``False`` if the queue is full.
+        """
+        try:
+            self.queue.put_nowait(item)
+        except queue.Full:
+            return False
+        return True
+
+    def put_later(self, item, delay):
+        """
+        Queue an item once ``delay`` seconds have passed
+        """
+        timer = threading.Timer(delay, self._put_or_drop, [item])
+        timer.daemon = True
+        timer.start()
+
+    def _put_or_drop(self, item):
+        if not self.put(item):
+            logger.warning("%s queue is full - dropping retry of %s",
+                           self.name, item)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            try:
+                self.func(item)
+            except Exception:
+                logger.exception("%s worker failed to handle %s", self.name,
+                                 item)
+            finally:
+                # Each worker thread would otherwise hold a database
+                # connection open
+                connection.close()
+
+
+class RateLimiter(object):
+    """
+    Spaces out calls so that no more than ``rate`` are made each second, across
+    all threads.  A rate of ``None`` means no limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.next_time = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            start_time = max(self.next_time, now)
+            self.next_time = start_time + self.interval
+        if start_time > now:
+            time.sleep(start_time - now)
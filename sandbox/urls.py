@@ -8,6 +8,7 @@ from django.conf.urls.static import static
 from apps.app import application
 from paypal.payflow.dashboard.app import application as payflow
 from paypal.express.dashboard.app import application as express_dashboard
+from paypal.dashboard.app import application as metrics_dashboard
 
 admin.autodiscover()
 
@@ -15,6 +16,8 @@ urlpatterns = patterns(
     '',
     (r'^admin/', include(admin.site.urls)),
     url(r'^i18n/', include('django.conf.urls.i18n')),
+    # PayPal posts IPN messages without a language prefix
+    (r'^paypal/ipn/', include('paypal.ipn.urls')),
 )
 urlpatterns += i18n_patterns('',
     # PayPal Express integration...
@@ -23,6 +26,8 @@ urlpatterns += i18n_patterns('',
     (r'^dashboard/paypal/payflow/', include(payflow.urls)),
     # Dashboard views for Express
     (r'^dashboard/paypal/express/', include(express_dashboard.urls)),
+    # Prometheus metrics
+    (r'^dashboard/paypal/', include(metrics_dashboard.urls)),
     (r'', include(application.urls)),
 )
 if settings.DEBUG:
@@ -17,10 +17,10 @@ setup(
     keywords="Payment, PayPal, Oscar",
     license=open('LICENSE').read(),
     platforms=['linux'],
-    packages=find_packages(exclude=['sandbox*', 'tests*']),
+    packages=find_packages(exclude=['sandbox*', 'tests*', 'benchmarks*']),
     include_package_data=True,
     install_requires=[
-        'requests>=1.0',
+        'requests>=2.10',
         'django-localflavor'],
     extras_require={
         'oscar': ["django-oscar>=0.6"]
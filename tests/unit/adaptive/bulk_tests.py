@@ -0,0 +1,112 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+import mock
+
+from paypal.adaptive import bulk
+from paypal.adaptive.models import AdaptiveTransaction
+from paypal.exceptions import PayPalError
+
+
+def create_txn(pay_key, action='PaymentDetails', status='INCOMPLETE',
+               ack='Success'):
+    return AdaptiveTransaction.objects.create(
+        action=action, pay_key=pay_key, payment_exec_status=status, ack=ack,
+        correlation_id='5d6b2c8c4e8b8', raw_request='', raw_response='',
+        response_time=100)
+
+
+@mock.patch('paypal.adaptive.facade.pay_secondary_receivers')
+class TestBulkExecutor(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def executed(self, pay_secondary_receivers):
+        return sorted(call[0][0] for call in
+                      pay_secondary_receivers.call_args_list)
+
+    def test_executes_incomplete_payments_once(self, pay_secondary_receivers):
+        create_txn('AP-1')
+        create_txn('AP-1')
+        create_txn('AP-2')
+        create_txn('AP-3', status='COMPLETED')
+        checkpoint = bulk.BulkExecutor(batch_size=2).run()
+        self.assertEqual(['AP-1', 'AP-2'],
+                         self.executed(pay_secondary_receivers))
+        self.assertEqual(2, checkpoint.counts[bulk.EXECUTED])
+
+    def test_skips_payments_that_have_been_executed(self,
+                                                    pay_secondary_receivers):
+        create_txn('AP-1')
+        create_txn('AP-1', action='ExecutePayment', status='COMPLETED')
+        checkpoint = bulk.BulkExecutor().run()
+        self.assertFalse(pay_secondary_receivers.called)
+        self.assertEqual(1, checkpoint.counts[bulk.SKIPPED])
+
+    def test_counts_failures(self, pay_secondary_receivers):
+        create_txn('AP-1')
+        pay_secondary_receivers.side_effect = PayPalError("Error 580022")
+        checkpoint = bulk.BulkExecutor().run()
+        self.assertEqual(1, checkpoint.counts[bulk.FAILED])
+
+    def test_resumes_from_checkpoint(self, pay_secondary_receivers):
+        first = create_txn('AP-1')
+        create_txn('AP-2')
+        with open(self.checkpoint_path, 'w') as f:
+            json.dump({'last_id': first.id, 'counts': {'executed': 1}}, f)
+        checkpoint = bulk.BulkExecutor(
+            checkpoint=bulk.Checkpoint(self.checkpoint_path)).run()
+        self.assertEqual(['AP-2'], self.executed(pay_secondary_receivers))
+        self.assertEqual(2, checkpoint.counts[bulk.EXECUTED])
+
+    def test_saves_checkpoint_after_each_batch(self, pay_secondary_receivers):
+        create_txn('AP-1')
+        last = create_txn('AP-2')
+        bulk.BulkExecutor(
+            batch_size=1,
+            checkpoint=bulk.Checkpoint(self.checkpoint_path)).run()
+        with open(self.checkpoint_path) as f:
+            self.assertEqual(last.id, json.load(f)['last_id'])
+
+    def test_stops_at_limit_without_passing_unprocessed_rows(
+            self, pay_secondary_receivers):
+        create_txn('AP-1')
+        create_txn('AP-2')
+        checkpoint = bulk.BulkExecutor(limit=1).run()
+        self.assertEqual(['AP-1'], self.executed(pay_secondary_receivers))
+        self.assertEqual(0, checkpoint.last_id)
+
+    def test_command_reports_throughput(self, pay_secondary_receivers):
+        create_txn('AP-1')
+        stdout = StringIO()
+        call_command('paypal_execute_payments', rate=0, stdout=stdout)
+        self.assertIn('1 executed', stdout.getvalue())
+        self.assertIn('payments/s', stdout.getvalue())
+
+
+class TestRateLimiter(TestCase):
+
+    @mock.patch('paypal.workers.time')
+    def test_spaces_out_calls(self, time):
+        time.time.return_value = 100.0
+        limiter = bulk.RateLimiter(4)
+        for __ in range(3):
+            limiter.wait()
+        self.assertEqual([mock.call(0.25), mock.call(0.5)],
+                         time.sleep.call_args_list)
+
+    @mock.patch('paypal.workers.time')
+    def test_can_be_unlimited(self, time):
+        limiter = bulk.RateLimiter(None)
+        limiter.wait()
+        self.assertFalse(time.sleep.called)
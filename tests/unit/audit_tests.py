@@ -0,0 +1,55 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+import mock
+
+from paypal import audit
+from paypal.express.models import ExpressTransaction
+
+
+def create_txn(method):
+    return ExpressTransaction(
+        method=method, version='88.0', ack='Success',
+        raw_request='METHOD=%s&PWD=1432777837&USER=test' % method,
+        raw_response='ACK=Success', response_time=100)
+
+
+@mock.patch('paypal.audit.AuditWriter.start', mock.Mock())
+class TestSynchronousAudit(TestCase):
+
+    def test_saves_immediately(self):
+        audit.save(create_txn('GetExpressCheckoutDetails'),
+                   'GetExpressCheckoutDetails')
+        self.assertEqual(1, ExpressTransaction.objects.count())
+
+
+@mock.patch('paypal.audit.AuditWriter.start', mock.Mock())
+@override_settings(PAYPAL_AUDIT_WRITE_BEHIND=True)
+class TestWriteBehindAudit(TestCase):
+
+    def test_buffers_non_durable_methods(self):
+        audit.save(create_txn('GetExpressCheckoutDetails'),
+                   'GetExpressCheckoutDetails')
+        self.assertEqual(0, ExpressTransaction.objects.count())
+        audit.flush()
+        self.assertEqual(1, ExpressTransaction.objects.count())
+
+    def test_masks_password_of_buffered_records(self):
+        audit.save(create_txn('GetExpressCheckoutDetails'),
+                   'GetExpressCheckoutDetails')
+        audit.flush()
+        txn = ExpressTransaction.objects.get()
+        self.assertTrue('1432777837' not in txn.raw_request)
+
+    def test_saves_money_moving_methods_immediately(self):
+        audit.save(create_txn('DoExpressCheckoutPayment'),
+                   'DoExpressCheckoutPayment')
+        self.assertEqual(1, ExpressTransaction.objects.count())
+
+    def test_saves_synchronously_when_queue_is_full(self):
+        with override_settings(PAYPAL_AUDIT_QUEUE_SIZE=1):
+            for __ in range(2):
+                audit.save(create_txn('GetExpressCheckoutDetails'),
+                           'GetExpressCheckoutDetails')
+            self.assertEqual(1, ExpressTransaction.objects.count())
+            audit.flush()
+            self.assertEqual(2, ExpressTransaction.objects.count())
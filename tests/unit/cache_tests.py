@@ -0,0 +1,48 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+import mock
+
+from paypal.cache import LRUCache, get_cache
+
+
+class TestLRUCache(TestCase):
+
+    def test_returns_default_for_missing_keys(self):
+        cache = LRUCache()
+        self.assertEqual('x', cache.get('missing', 'x'))
+
+    def test_evicts_least_recently_used_entry(self):
+        cache = LRUCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(2, len(cache))
+
+    def test_expires_entries(self):
+        cache = LRUCache()
+        with mock.patch('time.time', return_value=1000):
+            cache.set('a', 1, timeout=10)
+        with mock.patch('time.time', return_value=1011):
+            self.assertIsNone(cache.get('a'))
+
+    def test_delete(self):
+        cache = LRUCache()
+        cache.set('a', 1)
+        cache.delete('a')
+        cache.delete('a')
+        self.assertIsNone(cache.get('a'))
+
+
+class TestGetCache(TestCase):
+
+    def test_is_disabled_by_default(self):
+        self.assertIsNone(get_cache('PAYPAL_TEST_CACHE'))
+
+    @override_settings(PAYPAL_TEST_CACHE='local', PAYPAL_TEST_CACHE_SIZE=5)
+    def test_local_cache_is_shared(self):
+        cache = get_cache('PAYPAL_TEST_CACHE')
+        self.assertIs(cache, get_cache('PAYPAL_TEST_CACHE'))
+        self.assertEqual(5, cache.max_size)
@@ -1,10 +1,13 @@
 from decimal import Decimal as D
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.test.utils import override_settings
 from mock import patch, Mock
+import requests
 
 from oscar.apps.shipping.methods import Free, FixedPrice
 
-from paypal.express import gateway
+from paypal.express import facade, gateway
 from paypal import exceptions
 from paypal.express.exceptions import InvalidBasket
 from paypal.express.models import ExpressTransaction as Transaction
@@ -42,7 +45,7 @@ class ErrorResponseTests(MockedResponseTestCase):
         response_body = 'TIMESTAMP=2012%2d03%2d26T16%3a33%3a09Z&CORRELATIONID=3bea2076bb9c3&ACK=Failure&VERSION=0%2e000000&BUILD=2649250&L_ERRORCODE0=10002&L_SHORTMESSAGE0=Security%20error&L_LONGMESSAGE0=Security%20header%20is%20not%20valid&L_SEVERITYCODE0=Error'
         response = self.create_mock_response(response_body)
 
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             with self.assertRaises(exceptions.PayPalError):
                 gateway.set_txn(self.basket, self.methods, 'GBP', 'http://localhost:8000/success',
@@ -51,7 +54,7 @@ class ErrorResponseTests(MockedResponseTestCase):
     def test_non_200_response_raises_exception(self):
         response = self.create_mock_response(body='', status_code=500)
 
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             with self.assertRaises(exceptions.PayPalError):
                 gateway.set_txn(self.basket, self.methods, 'GBP', 'http://localhost:8000/success',
@@ -65,7 +68,7 @@ class SuccessResponseTests(MockedResponseTestCase):
         response_body = 'TOKEN=EC%2d6469953681606921P&TIMESTAMP=2012%2d03%2d26T17%3a19%3a38Z&CORRELATIONID=50a8d895e928f&ACK=Success&VERSION=60%2e0&BUILD=2649250'
         response = self.create_mock_response(response_body)
 
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             self.url = gateway.set_txn(self.basket, self.methods, 'GBP',
                                        'http://localhost:8000/success',
@@ -105,3 +108,158 @@ class TestOrderTotal(TestCase):
             with self.assertRaises(InvalidBasket):
                 gateway.set_txn(basket, shipping_methods, 'GBP',
                                 'http://example.com', 'http://example.com')
+
+
+class TestRequestParams(TestCase):
+
+    def set_txn(self, basket=None, **kwargs):
+        if basket is None:
+            basket = create_mock_basket(D('10.00'))
+        with patch('paypal.express.gateway._fetch_response') as mock_fetch:
+            gateway.set_txn(basket, [FixedPrice(D('2.50'), D('2.50'))], 'GBP',
+                            'http://example.com', 'http://example.com',
+                            **kwargs)
+            args, __ = mock_fetch.call_args
+        return args[1]
+
+    def test_settings_are_reread_when_changed(self):
+        self.assertFalse('BRANDNAME' in self.set_txn())
+        with override_settings(PAYPAL_BRAND_NAME='My shop'):
+            self.assertEqual('My shop', self.set_txn()['BRANDNAME'])
+        self.assertFalse('BRANDNAME' in self.set_txn())
+
+    @override_settings(PAYPAL_EXPRESS_API_URL='http://127.0.0.1:8765/nvp',
+                       PAYPAL_EXPRESS_REDIRECT_URL='http://127.0.0.1:8765/webscr')
+    def test_urls_can_be_set_in_settings(self):
+        url, __ = gateway._build_request(gateway.GET_EXPRESS_CHECKOUT, {})
+        self.assertEqual('http://127.0.0.1:8765/nvp', url)
+        with patch('paypal.express.gateway._fetch_response') as fetch:
+            fetch.return_value = Transaction(token='EC-8P797793UC466090M')
+            redirect_url = gateway.set_txn(
+                create_mock_basket(), [], 'GBP', 'http://example.com/success',
+                'http://example.com/cancel')
+        self.assertTrue(
+            redirect_url.startswith('http://127.0.0.1:8765/webscr?'))
+
+    def test_booleans_become_integers(self):
+        params = self.set_txn(paypal_params={'ALLOWNOTE': False})
+        self.assertEqual(0, params['ALLOWNOTE'])
+
+    def test_paypal_params_can_remove_defaults(self):
+        params = self.set_txn(paypal_params={'CALLBACKTIMEOUT': None})
+        self.assertFalse('CALLBACKTIMEOUT' in params)
+
+    def test_invalid_locale_raises(self):
+        with self.assertRaises(ImproperlyConfigured):
+            self.set_txn(paypal_params={'LOCALECODE': 'XX'})
+
+    @override_settings(PAYPAL_CONFIRM_SHIPPING=True)
+    def test_shipping_confirmation_is_not_requested_without_shipping(self):
+        self.assertEqual(1, self.set_txn()['REQCONFIRMSHIPPING'])
+        params = self.set_txn(no_shipping=True)
+        self.assertFalse('REQCONFIRMSHIPPING' in params)
+
+    def test_line_items_and_discounts(self):
+        basket = create_mock_basket(D('15.00'))
+        line = Mock()
+        line.product.get_title.return_value = 'A book'
+        line.product.upc = '1234'
+        line.product.description = '<p>A <em>good</em> book</p>'
+        line.unit_price_incl_tax = D('8')
+        line.quantity = 2
+        basket.all_lines.return_value = [line]
+        basket.offer_discounts = [{'name': 'Sale', 'discount': D('1.00')}]
+
+        params = self.set_txn(basket)
+        self.assertEqual('A book', params['L_PAYMENTREQUEST_0_NAME0'])
+        self.assertEqual('1234', params['L_PAYMENTREQUEST_0_NUMBER0'])
+        self.assertEqual('A good book', params['L_PAYMENTREQUEST_0_DESC0'])
+        self.assertEqual(D('8.00'), params['L_PAYMENTREQUEST_0_AMT0'])
+        self.assertEqual(2, params['L_PAYMENTREQUEST_0_QTY0'])
+        self.assertEqual('Special Offer: Sale',
+                         params['L_PAYMENTREQUEST_0_NAME1'])
+        self.assertEqual(D('-1.00'), params['L_PAYMENTREQUEST_0_AMT1'])
+        self.assertFalse('L_PAYMENTREQUEST_0_NUMBER1' in params)
+
+
+DO_EXPRESS_CHECKOUT_RESPONSE = 'TOKEN=EC%2d6469953681606921P&TIMESTAMP=2012%2d03%2d26T17%3a19%3a38Z&CORRELATIONID=50a8d895e928f&ACK=Success&VERSION=88%2e0&BUILD=2649250&PAYMENTINFO_0_TRANSACTIONID=1TY05887FT327632J&PAYMENTINFO_0_AMT=10%2e00&PAYMENTINFO_0_CURRENCYCODE=GBP'
+
+DO_EXPRESS_CHECKOUT_FAILURE = 'TOKEN=EC%2d6469953681606921P&TIMESTAMP=2012%2d03%2d26T17%3a19%3a38Z&CORRELATIONID=50a8d895e928f&ACK=Failure&VERSION=88%2e0&BUILD=2649250&L_ERRORCODE0=10486&L_SHORTMESSAGE0=This%20transaction%20couldn%27t%20be%20completed%2e&L_LONGMESSAGE0=This%20transaction%20couldn%27t%20be%20completed%2e%20Please%20redirect%20your%20customer%20to%20PayPal%2e&L_SEVERITYCODE0=Error'
+
+
+@override_settings(PAYPAL_RETRIES=2, PAYPAL_RETRY_BACKOFF=0)
+class TestIdempotentRequests(MockedResponseTestCase):
+
+    def do_txn(self):
+        return gateway.do_txn('PAYER1', 'EC-6469953681606921P', D('10.00'),
+                              'GBP')
+
+    def test_message_id_is_sent_and_recorded(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                DO_EXPRESS_CHECKOUT_RESPONSE)
+            txn = self.do_txn()
+        msg_sub_id = gateway.message_id(gateway.DO_EXPRESS_CHECKOUT,
+                                        'EC-6469953681606921P')
+        self.assertTrue(('MSGSUBID=%s' % msg_sub_id) in post.call_args[0][1])
+        self.assertEqual(msg_sub_id, txn.msg_sub_id)
+
+    def test_transport_errors_are_retried_with_the_same_message_id(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                requests.Timeout(),
+                self.create_mock_response(DO_EXPRESS_CHECKOUT_RESPONSE)]
+            self.assertTrue(self.do_txn().is_successful)
+        first, second = [c[0][1] for c in post.call_args_list]
+        self.assertEqual(first, second)
+
+    def test_transport_errors_become_paypal_errors(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = requests.ConnectionError()
+            with self.assertRaises(exceptions.PayPalError):
+                self.do_txn()
+        self.assertEqual(3, post.call_count)
+
+    def test_completed_payment_is_not_repeated(self):
+        with patch('requests.Session.post') as post:
+            post.return_value = self.create_mock_response(
+                DO_EXPRESS_CHECKOUT_RESPONSE)
+            txn = self.do_txn()
+            self.assertEqual(txn.id, self.do_txn().id)
+        self.assertEqual(1, post.call_count)
+
+    def test_payment_is_retried_with_a_new_message_id_after_a_failure(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                self.create_mock_response(DO_EXPRESS_CHECKOUT_FAILURE),
+                self.create_mock_response(DO_EXPRESS_CHECKOUT_RESPONSE)]
+            with self.assertRaises(exceptions.PayPalError):
+                self.do_txn()
+            txn = self.do_txn()
+        self.assertTrue(txn.is_successful)
+        self.assertEqual(gateway.message_id(gateway.DO_EXPRESS_CHECKOUT,
+                                            'EC-6469953681606921P', 2),
+                         txn.msg_sub_id)
+        first, second = [c[0][1] for c in post.call_args_list]
+        self.assertNotEqual(first, second)
+
+    def test_payment_retried_after_a_failure_can_be_refunded(self):
+        with patch('requests.Session.post') as post:
+            post.side_effect = [
+                self.create_mock_response(DO_EXPRESS_CHECKOUT_FAILURE),
+                self.create_mock_response(DO_EXPRESS_CHECKOUT_RESPONSE)]
+            with self.assertRaises(exceptions.PayPalError):
+                self.do_txn()
+            self.do_txn()
+        with patch('paypal.express.facade.refund_txn') as refund_txn:
+            facade.refund_transaction('EC-6469953681606921P', D('10.00'),
+                                      'GBP')
+        refund_txn.assert_called_once_with(
+            '1TY05887FT327632J', False, D('10.00'), 'GBP', msg_sub_id=None)
+
+    def test_partial_refunds_get_a_new_message_id_each_time(self):
+        with patch('paypal.express.gateway._fetch_response') as fetch:
+            gateway.refund_txn('1TY05887FT327632J', True, D('1.00'), 'GBP')
+            gateway.refund_txn('1TY05887FT327632J', True, D('1.00'), 'GBP')
+        first, second = [c[0][1]['MSGSUBID'] for c in fetch.call_args_list]
+        self.assertNotEqual(first, second)
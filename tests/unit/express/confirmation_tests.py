@@ -0,0 +1,242 @@
+import datetime
+import os
+import shutil
+import tempfile
+import time
+from decimal import Decimal as D
+
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+from mock import patch
+from oscar.apps.order.exceptions import InvalidOrderStatus
+from oscar.test.factories import create_order
+
+from paypal.exceptions import CommunicationError, PayPalError
+from paypal.express import confirmation
+from paypal.express.models import ExpressConfirmation, ExpressTransaction
+
+try:
+    from django.db.transaction import atomic
+except ImportError:
+    from django.db.transaction import commit_on_success as atomic
+
+
+def create_txn():
+    return ExpressTransaction.objects.create(
+        method='DoExpressCheckoutPayment', version='88.0', ack='Success',
+        amount=D('33.98'), currency='GBP', correlation_id='3db1d5276ddfd',
+        token='EC-6WY34243AN3588740', raw_request='', raw_response='',
+        response_time=100)
+
+
+class ProcessMixin(object):
+
+    def setUp(self):
+        self.order = create_order(number='100001')
+        self.order.status = 'Pending payment'
+        self.order.save()
+        self.confirmation = ExpressConfirmation.objects.create(
+            order_number='100001', payer_id='7ZTRBDFYYA47W',
+            token='EC-6WY34243AN3588740', amount=D('33.98'), currency='GBP')
+
+    def process(self):
+        delay = confirmation.process(self.confirmation.id)
+        self.confirmation = ExpressConfirmation.objects.get(
+            id=self.confirmation.id)
+        self.order = self.order.__class__.objects.get(id=self.order.id)
+        return delay
+
+
+@override_settings(PAYPAL_EXPRESS_CONFIRMATION_ATTEMPTS=2,
+                   PAYPAL_EXPRESS_CONFIRMATION_RETRY_BACKOFF=1.0,
+                   PAYPAL_EXPRESS_CONFIRMED_ORDER_STATUS='Being processed')
+class TestProcess(ProcessMixin, TestCase):
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_confirms_payment(self, confirm_transaction):
+        confirm_transaction.return_value = create_txn()
+        self.assertIsNone(self.process())
+        confirm_transaction.assert_called_once_with(
+            '7ZTRBDFYYA47W', 'EC-6WY34243AN3588740', D('33.98'), 'GBP')
+        self.assertEqual(ExpressConfirmation.COMPLETE,
+                         self.confirmation.status)
+        self.assertEqual('Being processed', self.order.status)
+        self.assertEqual(D('33.98'),
+                         self.order.sources.get().amount_debited)
+        self.assertEqual('3db1d5276ddfd',
+                         self.order.payment_events.get().reference)
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_retries_while_paypal_is_unavailable(self, confirm_transaction):
+        confirm_transaction.side_effect = CommunicationError("Timed out")
+        self.assertEqual(1.0, self.process())
+        self.assertEqual(ExpressConfirmation.PENDING, self.confirmation.status)
+        self.assertEqual(1, self.confirmation.attempts)
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_fails_once_attempts_are_used_up(self, confirm_transaction):
+        confirm_transaction.side_effect = CommunicationError("Timed out")
+        self.process()
+        self.assertIsNone(self.process())
+        self.assertEqual(ExpressConfirmation.FAILED, self.confirmation.status)
+        self.assertEqual('Payment failed', self.order.status)
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_fails_without_retrying_on_paypal_errors(self,
+                                                     confirm_transaction):
+        confirm_transaction.side_effect = PayPalError("Error 10486")
+        self.assertIsNone(self.process())
+        self.assertEqual(ExpressConfirmation.FAILED, self.confirmation.status)
+        self.assertEqual('Error 10486', self.confirmation.error_message)
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_does_not_record_a_recorded_payment_again(self,
+                                                      confirm_transaction):
+        confirm_transaction.return_value = create_txn()
+        confirmation._record_payment(self.order, create_txn())
+        self.process()
+        self.assertEqual(ExpressConfirmation.COMPLETE,
+                         self.confirmation.status)
+        self.assertEqual(1, self.order.sources.count())
+        self.assertEqual(1, self.order.payment_events.count())
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_is_only_processed_once(self, confirm_transaction):
+        confirm_transaction.return_value = create_txn()
+        self.process()
+        self.process()
+        self.assertEqual(1, confirm_transaction.call_count)
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_command_processes_pending_confirmations(self,
+                                                     confirm_transaction):
+        confirm_transaction.return_value = create_txn()
+        stdout = StringIO()
+        call_command('paypal_confirm_orders', older_than=-60, stdout=stdout)
+        self.assertIn('1 confirmed', stdout.getvalue())
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_command_reclaims_confirmations_left_processing(
+            self, confirm_transaction):
+        confirm_transaction.return_value = create_txn()
+        ExpressConfirmation.objects.filter(id=self.confirmation.id).update(
+            status=ExpressConfirmation.PROCESSING,
+            date_updated=timezone.now() - datetime.timedelta(seconds=700))
+        stdout = StringIO()
+        call_command('paypal_confirm_orders', processing_timeout=600,
+                     stdout=stdout)
+        self.assertIn('Reclaimed 1 payments', stdout.getvalue())
+        self.assertIn('1 confirmed', stdout.getvalue())
+
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_command_leaves_confirmations_that_are_still_processing(
+            self, confirm_transaction):
+        ExpressConfirmation.objects.filter(id=self.confirmation.id).update(
+            status=ExpressConfirmation.PROCESSING,
+            date_updated=timezone.now() - datetime.timedelta(seconds=60))
+        call_command('paypal_confirm_orders', older_than=-60,
+                     processing_timeout=600, stdout=StringIO())
+        self.assertFalse(confirm_transaction.called)
+        self.assertEqual(
+            ExpressConfirmation.PROCESSING,
+            ExpressConfirmation.objects.get(id=self.confirmation.id).status)
+
+
+@override_settings(PAYPAL_EXPRESS_CONFIRMED_ORDER_STATUS='Being processed')
+class TestRecordingFailures(ProcessMixin, TransactionTestCase):
+    """
+    Unlike a ``TestCase``, this lets the transaction around recording the
+    payment be rolled back for real
+    """
+
+    @patch('paypal.express.confirmation._set_order_status')
+    @patch('paypal.express.facade.confirm_transaction')
+    def test_needs_attention_if_the_payment_cannot_be_recorded(
+            self, confirm_transaction, set_order_status):
+        txn = create_txn()
+        confirm_transaction.return_value = txn
+        set_order_status.side_effect = InvalidOrderStatus("Not allowed")
+        self.assertIsNone(self.process())
+        self.assertEqual(ExpressConfirmation.NEEDS_ATTENTION,
+                         self.confirmation.status)
+        self.assertEqual(txn.id, self.confirmation.txn_id)
+        self.assertEqual('Not allowed', self.confirmation.error_message)
+        self.assertEqual(0, self.order.sources.count())
+        self.assertEqual(0, self.order.payment_events.count())
+
+        # It isn't picked up again
+        call_command('paypal_confirm_orders', older_than=-60,
+                     processing_timeout=-60, stdout=StringIO())
+        self.assertEqual(1, confirm_transaction.call_count)
+
+
+@override_settings(PAYPAL_EXPRESS_CONFIRMATION_WORKERS=2,
+                   PAYPAL_EXPRESS_CONFIRMED_ORDER_STATUS='Being processed')
+class TestWorkerPool(TransactionTestCase):
+    """
+    Confirms payments with the worker pool.  Each thread's connection to the
+    in-memory test database would get a database of its own, so these tests
+    use a database in a temporary file.
+
+    SQLite makes a write wait for an uncommitted one to finish, where other
+    databases don't see the uncommitted row at all.  The lock timeout is kept
+    shorter than the transactions here, so that a worker can't simply wait.
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.database = connections.databases[DEFAULT_DB_ALIAS]
+        self.original_settings = dict(self.database)
+        self.original_connection = connections[DEFAULT_DB_ALIAS]
+        self.database.update(NAME=os.path.join(self.directory, 'test.db'),
+                             OPTIONS={'timeout': 0.2})
+        del connections._connections.default
+        call_command('syncdb', interactive=False, verbosity=0)
+
+        patcher = patch('paypal.express.facade.confirm_transaction')
+        self.confirm_transaction = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.confirm_transaction.return_value = create_txn()
+
+    def tearDown(self):
+        connections[DEFAULT_DB_ALIAS].close()
+        self.database.clear()
+        self.database.update(self.original_settings)
+        connections[DEFAULT_DB_ALIAS] = self.original_connection
+        shutil.rmtree(self.directory)
+
+    def create_confirmation(self):
+        create_order(number='100001')
+        return ExpressConfirmation.objects.create(
+            order_number='100001', payer_id='7ZTRBDFYYA47W',
+            token='EC-6WY34243AN3588740', amount=D('33.98'), currency='GBP')
+
+    def wait_until_finished(self, confirmation_id, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            instance = ExpressConfirmation.objects.get(id=confirmation_id)
+            if instance.is_finished:
+                return instance
+            time.sleep(0.05)
+        return instance
+
+    def test_confirms_committed_confirmations(self):
+        instance = self.create_confirmation()
+        confirmation.submit(instance)
+        instance = self.wait_until_finished(instance.id)
+        self.assertEqual(ExpressConfirmation.COMPLETE, instance.status)
+        self.assertEqual(1, self.confirm_transaction.call_count)
+
+    def test_confirms_confirmations_once_they_are_committed(self):
+        with atomic():
+            instance = self.create_confirmation()
+            confirmation.submit(instance)
+            # Give the workers time to look for it
+            time.sleep(0.5)
+        instance = self.wait_until_finished(instance.id)
+        self.assertEqual(ExpressConfirmation.COMPLETE, instance.status)
+        self.assertEqual(1, self.confirm_transaction.call_count)
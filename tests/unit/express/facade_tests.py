@@ -7,7 +7,10 @@ from django.utils.six.moves.urllib.parse import parse_qs
 from oscar.apps.shipping.methods import Free
 
 from paypal.models import ExpressTransaction as Transaction
-from paypal.express.facade import get_paypal_url, fetch_transaction_details
+from paypal.cache import LRUCache
+from paypal.exceptions import PayPalError
+from paypal.express.facade import (
+    get_paypal_url, fetch_transaction_details, confirm_transaction)
 
 
 class MockedResponseTests(TestCase):
@@ -18,7 +21,7 @@ class MockedResponseTests(TestCase):
         response = Mock()
         response.content = self.response_body
         response.status_code = 200
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             post.return_value = response
             self.perform_action()
             self.mocked_post = post
@@ -146,3 +149,45 @@ class SuccessfulGetExpressCheckoutTests(MockedResponseTests):
         ]
         for k, v in values:
             self.assertEqual(v, ctx[k])
+
+
+class TransactionDetailsCacheTests(TestCase):
+    token = 'EC-6WY34243AN3588740'
+
+    def setUp(self):
+        self.txn = Mock()
+        patchers = [
+            patch('paypal.express.facade.get_txn', return_value=self.txn),
+            patch('paypal.express.facade._get_details_cache',
+                  return_value=LRUCache()),
+        ]
+        self.get_txn = patchers[0].start()
+        patchers[1].start()
+        for patcher in patchers:
+            self.addCleanup(patcher.stop)
+
+    def test_details_are_fetched_once_per_token(self):
+        fetch_transaction_details(self.token)
+        txn = fetch_transaction_details(self.token)
+        self.assertIs(self.txn, txn)
+        self.assertEqual(1, self.get_txn.call_count)
+
+    def test_refresh_fetches_details_again(self):
+        fetch_transaction_details(self.token)
+        fetch_transaction_details(self.token, refresh=True)
+        self.assertEqual(2, self.get_txn.call_count)
+
+    def test_confirming_payment_invalidates_details(self):
+        fetch_transaction_details(self.token)
+        with patch('paypal.express.facade.do_txn'):
+            confirm_transaction('PAYERID', self.token, D('10.00'), 'GBP')
+        fetch_transaction_details(self.token)
+        self.assertEqual(2, self.get_txn.call_count)
+
+    def test_failed_lookups_are_not_cached(self):
+        self.get_txn.side_effect = PayPalError
+        with self.assertRaises(PayPalError):
+            fetch_transaction_details(self.token)
+        self.get_txn.side_effect = None
+        fetch_transaction_details(self.token)
+        self.assertEqual(2, self.get_txn.call_count)
@@ -1,5 +1,8 @@
 from unittest import TestCase
 
+import mock
+
+from paypal import nvp
 from paypal.express.models import ExpressTransaction as Transaction
 
 
@@ -24,3 +27,21 @@ class TransactionTests(TestCase):
                                          ack='SuccessWithWarning',
                                          response_time=0)
         self.assertTrue(txn.is_successful)
+
+
+class ParsedResponseCacheTests(TestCase):
+
+    def test_response_is_only_parsed_once(self):
+        txn = Transaction(raw_response='ACK=Success&EMAIL=a%40b.com')
+        with mock.patch('paypal.nvp.decode_multi',
+                        wraps=nvp.decode_multi) as decode:
+            txn.value('ACK')
+            txn.value('EMAIL')
+            txn.value('TOKEN')
+        self.assertEqual(1, decode.call_count)
+
+    def test_cache_is_invalidated_when_raw_response_changes(self):
+        txn = Transaction(raw_response='ACK=Success')
+        self.assertEqual('Success', txn.value('ACK'))
+        txn.raw_response = 'ACK=Failure'
+        self.assertEqual('Failure', txn.value('ACK'))
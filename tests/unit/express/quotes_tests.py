@@ -0,0 +1,91 @@
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from paypal.express import quotes
+
+REQUEST_PARAMS = {
+    'L_PAYMENTREQUEST_0_NUMBER0': '9780140449136',
+    'L_PAYMENTREQUEST_0_AMT0': D('6.99'),
+    'L_PAYMENTREQUEST_0_QTY0': 2,
+    'L_PAYMENTREQUEST_0_NAME1': 'Special Offer: 10% off',
+    'L_PAYMENTREQUEST_0_AMT1': D('-1.40'),
+    'L_PAYMENTREQUEST_0_QTY1': 1,
+    'SHIPTOCOUNTRYCODE': 'GB',
+    'SHIPTOZIP': 'W12 4LQ',
+}
+
+CALLBACK_DATA = {
+    'L_NUMBER0': '9780140449136',
+    'L_AMT0': '6.99',
+    'L_QTY0': '2',
+    'L_NAME1': 'Special Offer: 10% off',
+    'L_AMT1': '-1.40',
+    'L_QTY1': '1',
+    'PAYMENTREQUEST_0_SHIPTOCOUNTRY': 'GB',
+    'PAYMENTREQUEST_0_SHIPTOZIP': 'w12 4lq',
+}
+
+
+class TestQuoteKeys(TestCase):
+
+    def test_callback_for_same_basket_and_destination_matches(self):
+        self.assertEqual(quotes.request_key(1, REQUEST_PARAMS),
+                         quotes.callback_key(1, CALLBACK_DATA))
+
+    def test_different_basket_id_does_not_match(self):
+        self.assertNotEqual(quotes.request_key(1, REQUEST_PARAMS),
+                            quotes.callback_key(2, CALLBACK_DATA))
+
+    def test_different_contents_do_not_match(self):
+        data = dict(CALLBACK_DATA, L_QTY0='3')
+        self.assertNotEqual(quotes.request_key(1, REQUEST_PARAMS),
+                            quotes.callback_key(1, data))
+
+    def test_different_destination_does_not_match(self):
+        data = dict(CALLBACK_DATA, PAYMENTREQUEST_0_SHIPTOCOUNTRY='FR')
+        self.assertNotEqual(quotes.request_key(1, REQUEST_PARAMS),
+                            quotes.callback_key(1, data))
+
+    @override_settings(PAYPAL_SHIPPING_QUOTES_BY_DESTINATION=False)
+    def test_destination_can_be_ignored(self):
+        data = dict(CALLBACK_DATA, PAYMENTREQUEST_0_SHIPTOCOUNTRY='FR')
+        self.assertEqual(quotes.request_key(1, REQUEST_PARAMS),
+                         quotes.callback_key(1, data))
+
+
+class TestQuoteStorage(TestCase):
+
+    def test_nothing_is_stored_by_default(self):
+        quotes.store('key', [('Free shipping', D('0.00'))])
+        self.assertIsNone(quotes.get('key'))
+
+    @override_settings(PAYPAL_SHIPPING_QUOTE_CACHE='local')
+    def test_quotes_are_stored(self):
+        quotes.store('key', [('Free shipping', D('0.00'))])
+        self.assertEqual([('Free shipping', D('0.00'))], quotes.get('key'))
+
+
+@override_settings(PAYPAL_SHIPPING_QUOTE_CACHE='local')
+class TestRequestQuoteStorage(TestCase):
+    shipping_quotes = [('Royal Mail', D('2.50'))]
+
+    def test_quotes_for_an_address_are_found_by_the_callback(self):
+        quotes.store_for_request(1, REQUEST_PARAMS, self.shipping_quotes)
+        self.assertEqual(self.shipping_quotes,
+                         quotes.get(quotes.callback_key(1, CALLBACK_DATA)))
+
+    def test_quotes_without_an_address_are_not_stored(self):
+        params = dict((key, value) for key, value in REQUEST_PARAMS.items()
+                      if not key.startswith('SHIPTO'))
+        quotes.store_for_request(1, params, self.shipping_quotes)
+        self.assertIsNone(quotes.get(quotes.callback_key(1, CALLBACK_DATA)))
+
+    @override_settings(PAYPAL_SHIPPING_QUOTES_BY_DESTINATION=False)
+    def test_quotes_without_an_address_are_stored_for_any_destination(self):
+        params = dict((key, value) for key, value in REQUEST_PARAMS.items()
+                      if not key.startswith('SHIPTO'))
+        quotes.store_for_request(1, params, self.shipping_quotes)
+        self.assertEqual(self.shipping_quotes,
+                         quotes.get(quotes.callback_key(1, CALLBACK_DATA)))
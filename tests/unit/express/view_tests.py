@@ -1,11 +1,14 @@
+import json
 import random
 
 from decimal import Decimal as D
 
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse, NoReverseMatch
 from mock import patch, Mock
+import requests
 
 from oscar.apps.order.models import Order
 from oscar.apps.basket.models import Basket
@@ -13,6 +16,9 @@ from oscar.core.loading import get_classes
 
 from purl import URL
 
+from paypal.express import quotes
+from paypal.express.models import ExpressConfirmation
+
 
 Partner, StockRecord = get_classes('partner.models', ('Partner',
                                                       'StockRecord'))
@@ -65,7 +71,7 @@ class MockedPayPalTests(TestCase):
 
     def setUp(self):
         self.client = Client()
-        with patch('requests.post') as post:
+        with patch('requests.Session.post') as post:
             self.patch_http_post(post)
             self.perform_action()
 
@@ -151,6 +157,22 @@ class RedirectToPayPalTests(MockedPayPalTests):
         self.assertTrue(self.url.has_query_params(params))
 
 
+class PayPalUnavailableTests(MockedPayPalTests):
+
+    def patch_http_post(self, post):
+        post.side_effect = requests.Timeout()
+
+    def perform_action(self):
+        self.add_product_to_basket()
+        self.response = self.client.get(reverse('paypal-redirect'),
+                                        follow=True)
+
+    def test_redirects_to_basket_with_try_again_message(self):
+        self.assertRedirects(self.response, reverse('basket:summary'))
+        messages = [str(m) for m in self.response.context['messages']]
+        self.assertTrue('try again' in messages[-1])
+
+
 class FailedTxnTests(MockedPayPalTests):
     response_body = 'TOKEN=EC%2d8P797793UC466090M&CHECKOUTSTATUS=PaymentActionNotInitiated&TIMESTAMP=2012%2d04%2d16T11%3a51%3a57Z&CORRELATIONID=ab8a263eb440&ACK=Failed&VERSION=60%2e0&BUILD=2808426&EMAIL=david%2e_1332854868_per%40gmail%2ecom&PAYERID=7ZTRBDFYYA47W&PAYERSTATUS=verified&FIRSTNAME=David&LASTNAME=Winterbottom&COUNTRYCODE=GB&SHIPTONAME=David%20Winterbottom&SHIPTOSTREET=1%20Main%20Terrace&SHIPTOCITY=Wolverhampton&SHIPTOSTATE=West%20Midlands&SHIPTOZIP=W12%204LQ&SHIPTOCOUNTRYCODE=GB&SHIPTOCOUNTRYNAME=United%20Kingdom&ADDRESSSTATUS=Confirmed&CURRENCYCODE=GBP&AMT=6%2e99&SHIPPINGAMT=0%2e00&HANDLINGAMT=0%2e00&TAXAMT=0%2e00&INSURANCEAMT=0%2e00&SHIPDISCAMT=0%2e00'
 
@@ -232,6 +254,68 @@ class SubmitOrderTests(MockedPayPalTests):
         self.assertEqual('line2', self.order.shipping_address.line2)
 
 
+@override_settings(PAYPAL_EXPRESS_ASYNC_CONFIRMATION=True)
+class AsyncSubmitOrderTests(SubmitOrderTests):
+
+    def perform_action(self):
+        with patch('paypal.express.confirmation.submit') as submit:
+            super(AsyncSubmitOrderTests, self).perform_action()
+        self.submit = submit
+
+    def patch_http_post(self, post):
+        super(AsyncSubmitOrderTests, self).patch_http_post(post)
+        self.post = post
+
+    def test_payment_is_not_confirmed_in_the_request(self):
+        methods = [call[0][1] for call in self.post.call_args_list]
+        self.assertFalse(
+            any('DoExpressCheckoutPayment' in payload for payload in methods))
+
+    def test_order_is_pending(self):
+        self.assertEqual('Pending payment', self.order.status)
+
+    def test_confirmation_is_queued(self):
+        confirmation = self.submit.call_args[0][0]
+        self.assertEqual(self.order.number, confirmation.order_number)
+        self.assertEqual('12345', confirmation.payer_id)
+
+    def test_redirects_to_status_page(self):
+        url = reverse('paypal-confirmation-status',
+                      kwargs={'order_number': self.order.number})
+        self.assertRedirects(self.response, url)
+        response = self.client.get(url)
+        self.assertContains(response, 'Confirming your payment')
+
+    def test_status_page_redirects_once_confirmed(self):
+        ExpressConfirmation.objects.update(status=ExpressConfirmation.COMPLETE)
+        response = self.client.get(reverse(
+            'paypal-confirmation-status',
+            kwargs={'order_number': self.order.number}))
+        self.assertRedirects(response, reverse('checkout:thank-you'))
+
+    def test_status_page_redirects_once_paid_if_recording_failed(self):
+        ExpressConfirmation.objects.update(
+            status=ExpressConfirmation.NEEDS_ATTENTION)
+        response = self.client.get(reverse(
+            'paypal-confirmation-status',
+            kwargs={'order_number': self.order.number}))
+        self.assertRedirects(response, reverse('checkout:thank-you'))
+
+    def test_status_is_available_as_json(self):
+        response = self.client.get(
+            reverse('paypal-confirmation-status',
+                    kwargs={'order_number': self.order.number}),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual({'status': 'Pending', 'redirect_url': None},
+                         json.loads(response.content.decode('utf-8')))
+
+    def test_status_is_only_shown_to_the_customer(self):
+        response = Client().get(reverse(
+            'paypal-confirmation-status',
+            kwargs={'order_number': self.order.number}))
+        self.assertEqual(404, response.status_code)
+
+
 class SubmitOrderErrorsTests(MockedPayPalTests):
 
     def perform_action(self):
@@ -263,3 +347,29 @@ class SubmitOrderErrorsTests(MockedPayPalTests):
         self.assertEqual(error, "A problem occurred while processing payment for this "
                       "order - no payment has been taken.  Please "
                       "contact customer services if this problem persists")
+
+
+@override_settings(PAYPAL_SHIPPING_QUOTE_CACHE='local')
+class ShippingOptionsTests(TestCase):
+    data = {
+        'METHOD': 'CallbackRequest',
+        'CURRENCYCODE': 'GBP',
+        'L_NUMBER0': '1234',
+        'L_AMT0': '6.99',
+        'L_QTY0': '1',
+        'PAYMENTREQUEST_0_SHIPTOCOUNTRY': 'GB',
+        'PAYMENTREQUEST_0_SHIPTOZIP': 'W12 4LQ',
+    }
+
+    def test_serves_stored_quotes_without_loading_basket(self):
+        quotes.store(quotes.callback_key('9999', self.data),
+                     [('Royal Mail', D('2.50'))])
+        url = reverse('paypal-shipping-options', kwargs={'basket_id': 9999})
+        response = self.client.post(url, self.data)
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(b'L_SHIPPINGOPTIONAMOUNT0=2.50' in response.content)
+
+    def test_unknown_basket_without_stored_quotes_returns_404(self):
+        url = reverse('paypal-shipping-options', kwargs={'basket_id': 9999})
+        response = self.client.post(url, self.data)
+        self.assertEqual(404, response.status_code)
@@ -1,7 +1,15 @@
+import threading
+
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six.moves import BaseHTTPServer
 import mock
+import requests
 
-from paypal.gateway import post
+from paypal import exceptions
+from paypal.gateway import (
+    post, get_session, reset_sessions, call_with_retries, deadline,
+    get_circuit_breaker, reset_circuit_breakers, CircuitBreaker)
 
 # Fixtures
 ERROR_RESPONSE = 'RESULT=126&PNREF=V25A2BB645A7&RESPMSG=Under review by Fraud Service&AUTHCODE=525PNI&PREFPSMSG=Review: More than one rule was triggered for Review&POSTFPSMSG=Review'
@@ -10,7 +18,7 @@ ERROR_RESPONSE = 'RESULT=126&PNREF=V25A2BB645A7&RESPMSG=Under review by Fraud Se
 class TestErrorResponse(TestCase):
 
     def setUp(self):
-        with mock.patch('requests.post') as mock_post:
+        with mock.patch('requests.Session.post') as mock_post:
             response = mock.Mock()
             response.status_code = 200
             response.content = ERROR_RESPONSE
@@ -37,3 +45,226 @@ class TestErrorResponse(TestCase):
                     '_response_time']
         for key in expected:
             self.assertTrue(key in self.pairs)
+
+
+class TestSessionPool(TestCase):
+
+    def tearDown(self):
+        reset_sessions()
+
+    def test_reuses_session_for_same_host(self):
+        self.assertIs(get_session('https://api-3t.paypal.com/nvp'),
+                      get_session('https://api-3t.paypal.com/nvp'))
+
+    def test_uses_separate_sessions_per_host(self):
+        self.assertIsNot(get_session('https://api-3t.paypal.com/nvp'),
+                         get_session('https://payflowpro.paypal.com'))
+
+    def test_creates_new_session_after_fork(self):
+        session = get_session('https://api-3t.paypal.com/nvp')
+        with mock.patch('os.getpid') as getpid:
+            getpid.return_value = -1
+            self.assertIsNot(session,
+                             get_session('https://api-3t.paypal.com/nvp'))
+
+    def test_pool_size_is_configurable(self):
+        with override_settings(PAYPAL_HTTP_POOL_SIZE=3):
+            session = get_session('https://api-3t.paypal.com/nvp')
+            adapter = session.get_adapter('https://api-3t.paypal.com/nvp')
+            self.assertEqual(3, adapter._pool_maxsize)
+
+
+@override_settings(PAYPAL_RETRIES=2, PAYPAL_RETRY_BACKOFF=0.1)
+class TestRetries(TestCase):
+
+    def setUp(self):
+        patcher = mock.patch('paypal.gateway.time.sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_retries_transport_errors_with_backoff(self):
+        func = mock.Mock(side_effect=[exceptions.CommunicationError(),
+                                      exceptions.CommunicationError(), 'ok'])
+        self.assertEqual('ok', call_with_retries(func, 'a', b=1))
+        self.assertEqual(3, func.call_count)
+        func.assert_called_with('a', b=1)
+        self.assertEqual([mock.call(0.1), mock.call(0.2)],
+                         self.sleep.call_args_list)
+
+    def test_reraises_last_error_when_retries_are_used_up(self):
+        func = mock.Mock(side_effect=exceptions.CommunicationError())
+        with self.assertRaises(exceptions.CommunicationError):
+            call_with_retries(func)
+        self.assertEqual(3, func.call_count)
+
+    def test_does_not_retry_past_the_deadline(self):
+        func = mock.Mock(side_effect=exceptions.CommunicationError())
+        with deadline(0.05):
+            with self.assertRaises(exceptions.CommunicationError):
+                call_with_retries(func)
+        self.assertEqual(1, func.call_count)
+
+    def test_does_not_retry_other_errors(self):
+        func = mock.Mock(side_effect=exceptions.CircuitOpen())
+        with self.assertRaises(exceptions.CircuitOpen):
+            call_with_retries(func)
+        self.assertEqual(1, func.call_count)
+
+
+URL = 'https://api-3t.paypal.com/nvp'
+
+
+class TestTimeouts(TestCase):
+
+    def post(self):
+        with mock.patch('requests.Session.post') as session_post:
+            session_post.return_value = mock.Mock(status_code=200,
+                                                  content='ACK=Success')
+            post(URL, {})
+        return session_post.call_args[1]['timeout']
+
+    def test_requests_have_a_timeout(self):
+        with override_settings(PAYPAL_HTTP_TIMEOUT=7):
+            self.assertEqual(7, self.post())
+
+    def test_deadline_shortens_timeout(self):
+        with deadline(2):
+            self.assertTrue(self.post() <= 2)
+
+    def test_nested_deadline_cannot_extend_outer_one(self):
+        with deadline(2):
+            with deadline(60):
+                self.assertTrue(self.post() <= 2)
+
+    def test_passed_deadline_fails_without_a_request(self):
+        with mock.patch('requests.Session.post') as session_post:
+            with deadline(-1):
+                with self.assertRaises(exceptions.DeadlineExceeded):
+                    post(URL, {})
+        self.assertFalse(session_post.called)
+
+    def test_transport_errors_become_communication_errors(self):
+        with mock.patch('requests.Session.post') as session_post:
+            session_post.side_effect = requests.Timeout()
+            with self.assertRaises(exceptions.CommunicationError):
+                post(URL, {})
+
+
+class TestCircuitBreaker(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.assertTrue(self.breaker.allow_request())
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_success_resets_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+    def test_lets_one_trial_request_through_after_reset_timeout(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.opened_at -= 30
+        self.assertTrue(self.breaker.allow_request())
+        self.assertEqual(CircuitBreaker.HALF_OPEN, self.breaker.state)
+        self.assertFalse(self.breaker.allow_request())
+
+    def test_failed_trial_request_reopens(self):
+        self.breaker.state = CircuitBreaker.HALF_OPEN
+        self.breaker.record_failure()
+        self.assertEqual(CircuitBreaker.OPEN, self.breaker.state)
+
+    def test_successful_trial_request_closes(self):
+        self.breaker.state = CircuitBreaker.HALF_OPEN
+        self.breaker.record_success()
+        self.assertEqual(CircuitBreaker.CLOSED, self.breaker.state)
+
+
+@override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=2)
+class TestCircuitBreakingPost(TestCase):
+
+    def tearDown(self):
+        reset_circuit_breakers()
+
+    def test_failing_endpoint_fails_fast(self):
+        with mock.patch('requests.Session.post') as session_post:
+            session_post.side_effect = requests.ConnectionError()
+            for __ in range(2):
+                with self.assertRaises(exceptions.CommunicationError):
+                    post(URL, {})
+            with self.assertRaises(exceptions.CircuitOpen):
+                post(URL, {})
+        self.assertEqual(2, session_post.call_count)
+
+    def test_unexpected_errors_settle_the_trial_request(self):
+        breaker = get_circuit_breaker(URL)
+        breaker.state = CircuitBreaker.OPEN
+        breaker.opened_at = 0
+        with mock.patch('requests.Session.post') as session_post:
+            session_post.side_effect = ValueError("Unexpected")
+            with self.assertRaises(ValueError):
+                post(URL, {})
+        self.assertEqual(CircuitBreaker.OPEN, breaker.state)
+        # The next trial request is let through once the timeout has passed
+        breaker.opened_at = 0
+        self.assertTrue(breaker.allow_request())
+
+    def test_breakers_are_per_endpoint(self):
+        get_circuit_breaker(URL).state = CircuitBreaker.OPEN
+        get_circuit_breaker(URL).opened_at = float('inf')
+        self.assertTrue(get_circuit_breaker(
+            'https://payflowpro.paypal.com').allow_request())
+
+    def test_can_be_disabled(self):
+        with override_settings(PAYPAL_CIRCUIT_BREAKER_THRESHOLD=None):
+            self.assertIsNone(get_circuit_breaker(URL))
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers['Content-Length']))
+        body = b'ACK=Success'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestTimings(TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), Handler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/nvp' % self.server.server_address[1]
+
+    def tearDown(self):
+        reset_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_each_phase_is_timed(self):
+        timings = post(self.url, {'METHOD': 'GetBalance'})['_timings']
+        for phase in ('encode_time', 'connect_time', 'ttfb', 'read_time',
+                      'decode_time'):
+            self.assertTrue(timings[phase] >= 0, phase)
+
+    def test_records_whether_the_connection_was_reused(self):
+        first = post(self.url, {'METHOD': 'GetBalance'})['_timings']
+        second = post(self.url, {'METHOD': 'GetBalance'})['_timings']
+        self.assertFalse(first['connection_reused'])
+        self.assertTrue(second['connection_reused'])
+        self.assertIsNone(second['connect_time'])
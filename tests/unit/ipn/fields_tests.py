@@ -0,0 +1,115 @@
+import datetime
+from decimal import Decimal as D
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from paypal import nvp
+from paypal.ipn import fields, receiver
+from paypal.ipn.dashboard.views import PaymentsListView
+from paypal.ipn.models import PaymentMessage, hash_message
+
+from tests.unit.ipn.receiver_tests import RAW_MESSAGE
+
+REFUND_MESSAGE = (
+    'mc_gross=-19.95&payment_status=Refunded&mc_currency=GBP&'
+    'txn_id=8MC585209K746392H&parent_txn_id=61E67681CH3238416&'
+    'receiver_email=seller%40example.com&'
+    'payment_date=08%3A10%3A03+Jul+14%2C+2009+PDT')
+
+
+class TestExtract(TestCase):
+
+    def test_extracts_express_checkout_fields(self):
+        values = fields.extract(nvp.decode(RAW_MESSAGE))
+        self.assertEqual('express_checkout', values['txn_type'])
+        self.assertEqual(D('19.95'), values['mc_gross'])
+        self.assertEqual('GBP', values['mc_currency'])
+        self.assertEqual('seller@example.com', values['receiver_email'])
+        self.assertEqual('', values['parent_txn_id'])
+
+    def test_extracts_parent_transaction_of_refunds(self):
+        values = fields.extract(nvp.decode(REFUND_MESSAGE))
+        self.assertEqual('61E67681CH3238416', values['parent_txn_id'])
+        self.assertEqual(D('-19.95'), values['mc_gross'])
+
+    def test_extracts_adaptive_payments_fields(self):
+        values = fields.extract(nvp.decode(
+            'transaction_type=Adaptive+Payment+PAY&pay_key=AP-2MA4865466536742J'
+            '&transaction%5B0%5D.receiver=seller%40example.com'))
+        self.assertEqual('Adaptive Payment PAY', values['txn_type'])
+        self.assertEqual('AP-2MA4865466536742J', values['pay_key'])
+        self.assertEqual('seller@example.com', values['receiver_email'])
+        self.assertIsNone(values['mc_gross'])
+
+
+class TestDecode(TestCase):
+
+    def test_uses_the_message_charset(self):
+        self.assertEqual('utf-8', fields.get_charset('a=1&charset=UTF-8'))
+        self.assertEqual('windows-1252', fields.get_charset('a=1'))
+        self.assertEqual('windows-1252',
+                         fields.get_charset('charset=unknown'))
+
+    def test_falls_back_to_latin1_for_invalid_values(self):
+        pairs = fields.decode('charset=UTF-8&txn_id=1&first_name=Ren%E9e')
+        self.assertEqual('1', pairs['txn_id'])
+        self.assertEqual(u'Ren\xe9e', pairs['first_name'])
+
+
+@override_settings(USE_TZ=True)
+class TestParsePaymentDate(TestCase):
+
+    def test_converts_from_pacific_time(self):
+        self.assertEqual(
+            datetime.datetime(2009, 1, 14, 4, 12, 59, tzinfo=timezone.utc),
+            fields.parse_payment_date('20:12:59 Jan 13, 2009 PST'))
+        self.assertEqual(
+            datetime.datetime(2009, 7, 14, 15, 10, 3, tzinfo=timezone.utc),
+            fields.parse_payment_date('08:10:03 Jul 14, 2009 PDT'))
+
+    def test_ignores_dates_it_cant_parse(self):
+        self.assertIsNone(fields.parse_payment_date(''))
+        self.assertIsNone(fields.parse_payment_date('2009-01-13 20:12:59'))
+
+
+class TestBackfill(TestCase):
+
+    def test_fills_in_fields_of_existing_messages(self):
+        message = PaymentMessage.objects.create(
+            raw_message=REFUND_MESSAGE, transaction_id='8MC585209K746392H',
+            payment_status='Refunded', txn_type=None)
+        stdout = StringIO()
+        call_command('paypal_backfill_ipn_fields', batch_size=1,
+                     stdout=stdout)
+        message = PaymentMessage.objects.get(id=message.id)
+        self.assertEqual('', message.txn_type)
+        self.assertEqual('61E67681CH3238416', message.parent_txn_id)
+        self.assertEqual(D('-19.95'), message.mc_gross)
+        self.assertIsNotNone(message.payment_date)
+        self.assertEqual(hash_message(REFUND_MESSAGE), message.message_hash)
+        self.assertIn('1 messages updated', stdout.getvalue())
+
+    def test_hashes_existing_messages(self):
+        message = PaymentMessage.objects.create(
+            raw_message=REFUND_MESSAGE, transaction_id='8MC585209K746392H',
+            payment_status='Refunded', txn_type='', message_hash='')
+        call_command('paypal_backfill_ipn_fields', stdout=StringIO())
+        self.assertEqual(hash_message(REFUND_MESSAGE),
+                         PaymentMessage.objects.get(id=message.id).message_hash)
+
+
+class TestDashboardList(TestCase):
+
+    def test_filters_on_extracted_fields(self):
+        receiver.store(RAW_MESSAGE)
+        refund, __ = receiver.store(REFUND_MESSAGE)
+        view = PaymentsListView()
+        view.request = RequestFactory().get(
+            '/', {'parent_txn_id': '61E67681CH3238416'})
+        self.assertEqual([refund.id],
+                         [message.id for message in view.get_queryset()])
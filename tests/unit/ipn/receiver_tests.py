@@ -0,0 +1,190 @@
+from django.core.management import call_command
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+import mock
+
+from paypal.exceptions import CommunicationError
+from paypal.ipn import receiver, signals
+from paypal.ipn.models import PaymentMessage
+
+RAW_MESSAGE = (
+    'mc_gross=19.95&protection_eligibility=Eligible&payer_id=LPLWNMTBWMFAY&'
+    'payment_date=20%3A12%3A59+Jan+13%2C+2009+PST&payment_status=Completed&'
+    'charset=windows-1252&mc_currency=GBP&txn_id=61E67681CH3238416&'
+    'receiver_email=seller%40example.com&txn_type=express_checkout&'
+    'test_ipn=1&verify_sign=AtkOfCXbDm2hu0ZELryHFjY-Vb7PAUvS6nMXgysbElEn9v')
+
+
+@mock.patch('paypal.ipn.receiver.submit')
+class TestIPNView(TestCase):
+
+    def post(self, raw_message=RAW_MESSAGE):
+        return self.client.post(
+            '/paypal/ipn/', raw_message,
+            content_type='application/x-www-form-urlencoded')
+
+    def test_stores_message_and_replies_straight_away(self, submit):
+        response = self.post()
+        self.assertEqual(200, response.status_code)
+        message = PaymentMessage.objects.get()
+        self.assertEqual(RAW_MESSAGE, message.raw_message)
+        self.assertEqual('61E67681CH3238416', message.transaction_id)
+        self.assertEqual('Completed', message.payment_status)
+        self.assertTrue(message.is_sandbox)
+        self.assertEqual(PaymentMessage.PENDING, message.verification_status)
+        submit.assert_called_once_with(message)
+
+    def test_counts_repeated_deliveries_against_the_first(self, submit):
+        self.post()
+        self.post()
+        message = PaymentMessage.objects.get()
+        self.assertEqual(2, message.delivery_count)
+        self.assertEqual(1, submit.call_count)
+
+    def test_stores_each_payment_status(self, submit):
+        self.post()
+        self.post(RAW_MESSAGE.replace('Completed', 'Refunded'))
+        self.assertEqual(2, PaymentMessage.objects.count())
+
+    def test_decodes_values_in_the_message_charset(self, submit):
+        # PayPal sends windows-1252 unless the seller has changed it
+        self.post(RAW_MESSAGE + '&first_name=Ren%E9e&item_name=Caf%E9+%80')
+        message = PaymentMessage.objects.get()
+        self.assertEqual('61E67681CH3238416', message.transaction_id)
+        self.assertEqual(u'Ren\xe9e', message.value('first_name'))
+        self.assertEqual(u'Caf\xe9 \u20ac', message.value('item_name'))
+
+    def test_decodes_utf8_messages(self, submit):
+        self.post(RAW_MESSAGE.replace('windows-1252', 'UTF-8') +
+                  '&first_name=Ren%C3%A9e')
+        message = PaymentMessage.objects.get()
+        self.assertEqual('61E67681CH3238416', message.transaction_id)
+        self.assertEqual(u'Ren\xe9e', message.value('first_name'))
+
+    def test_stores_adaptive_payments_messages(self, submit):
+        self.post('transaction%5B0%5D.id=4TL72158XW436683H&status=COMPLETED&'
+                  'pay_key=AP-2MA4865466536742J')
+        message = PaymentMessage.objects.get()
+        self.assertEqual('4TL72158XW436683H', message.transaction_id)
+        self.assertEqual('COMPLETED', message.payment_status)
+        self.assertEqual('AP-2MA4865466536742J', message.pay_key)
+
+
+@override_settings(PAYPAL_IPN_VERIFY_URL='http://localhost/verify',
+                   PAYPAL_IPN_VERIFICATION_ATTEMPTS=2, PAYPAL_RETRIES=0)
+@mock.patch('paypal.gateway.post_raw')
+class TestVerify(TestCase):
+
+    def setUp(self):
+        self.message = PaymentMessage.objects.create(
+            raw_message=RAW_MESSAGE, transaction_id='61E67681CH3238416',
+            payment_status='Completed')
+        self.handler = mock.Mock()
+        signals.payment_message_verified.connect(self.handler)
+
+    def tearDown(self):
+        signals.payment_message_verified.disconnect(self.handler)
+
+    def verify(self, attempt=1):
+        delay = receiver.verify(self.message.id, attempt)
+        self.message = PaymentMessage.objects.get(id=self.message.id)
+        return delay
+
+    def test_posts_message_back_unchanged(self, post_raw):
+        post_raw.return_value = b'VERIFIED'
+        self.verify()
+        url, payload, __ = post_raw.call_args[0]
+        self.assertEqual('http://localhost/verify', url)
+        self.assertEqual(('cmd=_notify-validate&' + RAW_MESSAGE).encode(),
+                         payload)
+
+    def test_records_verified_messages(self, post_raw):
+        post_raw.return_value = b'VERIFIED'
+        self.verify()
+        self.assertEqual(PaymentMessage.VERIFIED,
+                         self.message.verification_status)
+        self.assertIsNotNone(self.message.date_verified)
+        self.assertEqual(1, self.handler.call_count)
+        self.assertEqual(PaymentMessage.PROCESSED,
+                         self.message.processing_status)
+
+    def test_records_invalid_messages(self, post_raw):
+        post_raw.return_value = b'INVALID'
+        self.verify()
+        self.assertEqual(PaymentMessage.INVALID,
+                         self.message.verification_status)
+        self.assertFalse(self.handler.called)
+
+    def test_only_verifies_once(self, post_raw):
+        post_raw.return_value = b'VERIFIED'
+        self.verify()
+        self.verify()
+        self.assertEqual(1, post_raw.call_count)
+        self.assertEqual(1, self.handler.call_count)
+
+    def test_records_failed_handlers(self, post_raw):
+        post_raw.return_value = b'VERIFIED'
+        self.handler.side_effect = ValueError("No such order")
+        self.verify()
+        self.assertEqual(PaymentMessage.FAILED,
+                         self.message.processing_status)
+        self.assertEqual('No such order', self.message.processing_error)
+
+    def test_retries_while_paypal_is_unavailable(self, post_raw):
+        post_raw.side_effect = CommunicationError("Timed out")
+        self.assertEqual(5.0, self.verify())
+        self.assertIsNone(self.verify(attempt=2))
+        self.assertEqual(PaymentMessage.PENDING,
+                         self.message.verification_status)
+
+    def test_command_verifies_pending_messages(self, post_raw):
+        post_raw.return_value = b'VERIFIED'
+        stdout = StringIO()
+        call_command('paypal_verify_ipn', older_than=-60, stdout=stdout)
+        self.assertIn('1 verified', stdout.getvalue())
+
+
+class TestStore(TestCase):
+
+    def test_returns_stored_message_for_repeats(self):
+        first, created = receiver.store(RAW_MESSAGE)
+        self.assertTrue(created)
+        second, created = receiver.store(RAW_MESSAGE)
+        self.assertFalse(created)
+        self.assertEqual(first.id, second.id)
+
+    def test_counts_delivery_when_losing_a_race(self):
+        message, __ = receiver.store(RAW_MESSAGE)
+        # As if the row appeared between the check and the insert
+        with mock.patch('paypal.ipn.receiver._count_delivery',
+                        side_effect=[0, 1]):
+            duplicate, created = receiver.store(RAW_MESSAGE)
+        self.assertFalse(created)
+        self.assertEqual(message.id, duplicate.id)
+        self.assertEqual(1, PaymentMessage.objects.count())
+
+
+class TestProcess(TestCase):
+
+    def setUp(self):
+        self.message = PaymentMessage.objects.create(
+            raw_message=RAW_MESSAGE, transaction_id='61E67681CH3238416',
+            payment_status='Completed',
+            verification_status=PaymentMessage.VERIFIED)
+        self.handler = mock.Mock()
+        signals.payment_message_verified.connect(self.handler)
+
+    def tearDown(self):
+        signals.payment_message_verified.disconnect(self.handler)
+
+    def test_runs_handlers_once(self):
+        self.assertTrue(receiver.process(self.message.id))
+        self.assertFalse(receiver.process(self.message.id))
+        self.assertEqual(1, self.handler.call_count)
+
+    def test_ignores_unverified_messages(self):
+        PaymentMessage.objects.update(
+            verification_status=PaymentMessage.INVALID)
+        self.assertFalse(receiver.process(self.message.id))
+        self.assertFalse(self.handler.called)
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils.six import StringIO
+from django.utils.six.moves import BaseHTTPServer, socketserver
+import mock
+
+from paypal.ipn import replay
+from paypal.ipn.models import PaymentMessage
+
+from tests.unit.ipn.receiver_tests import RAW_MESSAGE
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.received.append(body)
+        status = 500 if body == b'fail' else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'OK')
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class TestReplayer(TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.server.received = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.url = 'http://127.0.0.1:%d/paypal/ipn/' % (
+            self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_delivers_each_message_repeatedly(self):
+        result = replay.Replayer(self.url, concurrency=1, repeat=3).run(
+            [RAW_MESSAGE])
+        self.assertEqual([RAW_MESSAGE.encode()] * 3, self.server.received)
+        self.assertEqual(1, result.num_messages)
+        self.assertEqual(3, result.acknowledged)
+        self.assertEqual(3, len(result.timings))
+
+    def test_counts_failed_deliveries(self):
+        result = replay.Replayer(self.url, concurrency=2).run(
+            [RAW_MESSAGE, 'fail'])
+        self.assertEqual(1, result.acknowledged)
+        self.assertEqual(1, result.failed)
+
+
+class TestMessageSources(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'messages.jsonl')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_reads_strings_and_objects_from_jsonl_files(self):
+        with open(self.path, 'w') as f:
+            f.write(json.dumps('txn_id=1') + '\n\n')
+            f.write(json.dumps({'raw_message': 'txn_id=2'}) + '\n')
+        self.assertEqual(['txn_id=1', 'txn_id=2'],
+                         list(replay.iter_file_messages(self.path)))
+        self.assertEqual(['txn_id=1'],
+                         list(replay.iter_file_messages(self.path, limit=1)))
+
+    def test_reads_stored_messages_in_batches(self):
+        for index in range(3):
+            PaymentMessage.objects.create(
+                raw_message='txn_id=%d' % index, transaction_id='%d' % index)
+        self.assertEqual(['txn_id=0', 'txn_id=1', 'txn_id=2'],
+                         list(replay.iter_stored_messages(batch_size=2)))
+        self.assertEqual(['txn_id=0', 'txn_id=1'],
+                         list(replay.iter_stored_messages(batch_size=1,
+                                                          limit=2)))
+
+    @mock.patch('paypal.ipn.replay.Replayer.deliver')
+    def test_command_reports_throughput_and_latency(self, deliver):
+        deliver.return_value = (True, 5.0)
+        with open(self.path, 'w') as f:
+            f.write(json.dumps(RAW_MESSAGE) + '\n')
+        stdout = StringIO()
+        call_command('paypal_replay_ipn', file=self.path, repeat=4,
+                     stdout=stdout)
+        output = stdout.getvalue()
+        self.assertIn('Replayed 4 deliveries of 1 messages', output)
+        self.assertIn('4 acknowledged', output)
+        self.assertIn('p99 5.0ms', output)
@@ -0,0 +1,180 @@
+from django.contrib.auth.models import AnonymousUser, User
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
+import mock
+
+from paypal import exceptions, metrics
+from paypal.dashboard.views import MetricsView
+from paypal.express import gateway
+from paypal.express.models import ExpressTransaction
+
+hook = mock.Mock()
+
+TIMINGS = {
+    'encode_time': 0.1,
+    'connect_time': 40.0,
+    'connection_reused': False,
+    'ttfb': 75.0,
+    'read_time': 4.0,
+    'decode_time': 0.2,
+}
+
+
+def record_response():
+    return gateway._record_response(
+        gateway.GET_EXPRESS_CHECKOUT, {'TOKEN': 'EC-6469953681606921P'}, {
+            'ACK': 'Success',
+            'CORRELATIONID': '4ce4b6ef6a1f9',
+            'PAYMENTREQUEST_0_AMT': '10.00',
+            'PAYMENTREQUEST_0_CURRENCYCODE': 'GBP',
+            '_raw_request': 'METHOD=GetExpressCheckoutDetails',
+            '_raw_response': 'ACK=Success',
+            '_response_time': 120.0,
+            '_timings': TIMINGS,
+        })
+
+
+class TestTimingsOnModels(TestCase):
+
+    def test_timings_are_saved(self):
+        record_response()
+        txn = ExpressTransaction.objects.get()
+        self.assertEqual(40.0, txn.connect_time)
+        self.assertEqual(75.0, txn.ttfb)
+        self.assertFalse(txn.connection_reused)
+
+    def test_timings_are_optional(self):
+        self.assertEqual({}, metrics.model_fields({'ACK': 'Success'}))
+
+
+@override_settings(PAYPAL_METRICS_HOOKS=['tests.unit.metrics_tests.hook'])
+class TestHooks(TestCase):
+
+    def setUp(self):
+        hook.reset_mock()
+        hook.side_effect = None
+
+    def test_hooks_are_called_with_the_timings(self):
+        txn = record_response()
+        hook.assert_called_once_with(
+            'express', gateway.GET_EXPRESS_CHECKOUT, txn, mock.ANY)
+        timings = hook.call_args[0][3]
+        self.assertEqual(120.0, timings['response_time'])
+        self.assertEqual(75.0, timings['ttfb'])
+        self.assertTrue(timings['persist_time'] >= 0)
+
+    def test_failing_hook_does_not_fail_the_call(self):
+        hook.side_effect = ValueError
+        record_response()
+        self.assertEqual(1, ExpressTransaction.objects.count())
+
+    def test_hooks_can_be_callables(self):
+        other = mock.Mock()
+        with override_settings(PAYPAL_METRICS_HOOKS=[other]):
+            record_response()
+        self.assertTrue(other.called)
+
+
+class TestRegistry(TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry()
+        self.counter = self.registry.register(metrics.Counter(
+            'calls_total', "Calls", labels=('method',)))
+        self.histogram = self.registry.register(metrics.Histogram(
+            'latency_seconds', "Latency", labels=('method',),
+            buckets=(0.1, 1.0)))
+
+    def test_renders_counters(self):
+        self.counter.inc(method='Pay')
+        self.counter.inc(method='Pay')
+        self.assertIn('calls_total{method="Pay"} 2.0\n',
+                      self.registry.render())
+
+    def test_renders_cumulative_histogram_buckets(self):
+        for value in (0.05, 0.5, 5):
+            self.histogram.observe(value, method='Pay')
+        text = self.registry.render()
+        self.assertIn('# TYPE latency_seconds histogram', text)
+        self.assertIn('latency_seconds_bucket{method="Pay",le="0.1"} 1.0', text)
+        self.assertIn('latency_seconds_bucket{method="Pay",le="1.0"} 2.0', text)
+        self.assertIn('latency_seconds_bucket{method="Pay",le="+Inf"} 3.0',
+                      text)
+        self.assertIn('latency_seconds_count{method="Pay"} 3.0', text)
+        self.assertEqual((3, 5.55), self.histogram.get(method='Pay'))
+
+    def test_escapes_label_values(self):
+        self.counter.inc(method='a "b"')
+        self.assertIn('calls_total{method="a \\"b\\""}',
+                      self.registry.render())
+
+    def test_labels_are_checked(self):
+        with self.assertRaises(ValueError):
+            self.counter.inc(api='express')
+
+
+class TestRegistryCollection(TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.clear()
+
+    def test_latency_is_collected_per_method(self):
+        record_response()
+        self.assertEqual((1, 0.12), metrics.REQUEST_DURATION.get(
+            api='express', method=gateway.GET_EXPRESS_CHECKOUT))
+        count, __ = metrics.PHASE_DURATION.get(
+            api='express', method=gateway.GET_EXPRESS_CHECKOUT, phase='ttfb')
+        self.assertEqual(1, count)
+
+    def test_failures_are_counted_by_error_code(self):
+        with self.assertRaises(exceptions.PayPalError):
+            gateway._record_response(gateway.GET_EXPRESS_CHECKOUT, {}, {
+                'ACK': 'Failure',
+                'L_ERRORCODE0': '10410',
+                '_raw_request': 'METHOD=GetExpressCheckoutDetails',
+                '_raw_response': 'ACK=Failure',
+                '_response_time': 80.0,
+            })
+        self.assertEqual(1, metrics.FAILURES.get(
+            api='express', method=gateway.GET_EXPRESS_CHECKOUT,
+            error_code='10410'))
+
+    def test_in_flight_calls_are_tracked(self):
+        with metrics.track('payflow', 'S'):
+            self.assertEqual(1, metrics.IN_FLIGHT.get(api='payflow',
+                                                      method='S'))
+        self.assertEqual(0, metrics.IN_FLIGHT.get(api='payflow', method='S'))
+
+    def test_errors_are_counted(self):
+        with self.assertRaises(exceptions.CommunicationError):
+            with metrics.track('payflow', 'S'):
+                raise exceptions.CommunicationError()
+        self.assertEqual(1, metrics.ERRORS.get(
+            api='payflow', method='S', error='CommunicationError'))
+        self.assertEqual(0, metrics.IN_FLIGHT.get(api='payflow', method='S'))
+
+
+class TestMetricsView(TestCase):
+
+    def get(self, user=None, **headers):
+        request = RequestFactory().get('/dashboard/paypal/metrics/', **headers)
+        request.user = user or AnonymousUser()
+        return MetricsView.as_view()(request)
+
+    def test_is_forbidden_to_anonymous_users(self):
+        self.assertEqual(403, self.get().status_code)
+
+    def test_is_shown_to_staff(self):
+        user = User(username='staff', is_staff=True, is_active=True)
+        response = self.get(user)
+        self.assertEqual(200, response.status_code)
+        self.assertIn(b'paypal_requests_in_flight', response.content)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+
+    @override_settings(PAYPAL_METRICS_TOKEN='s3cret')
+    def test_accepts_bearer_token(self):
+        self.assertEqual(
+            200, self.get(HTTP_AUTHORIZATION='Bearer s3cret').status_code)
+        self.assertEqual(
+            403, self.get(HTTP_AUTHORIZATION='Bearer guess').status_code)
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.utils.http import urlencode
+
+from paypal import nvp
+
+
+class TestDecode(TestCase):
+
+    def test_decodes_values(self):
+        pairs = nvp.decode('TOKEN=EC%2d8P797793UC466090M&SHIPTONAME=David%20Winterbottom&AMT=6%2e99')
+        self.assertEqual('EC-8P797793UC466090M', pairs['TOKEN'])
+        self.assertEqual('David Winterbottom', pairs['SHIPTONAME'])
+        self.assertEqual('6.99', pairs['AMT'])
+
+    def test_preserves_order(self):
+        pairs = nvp.decode('C=1&A=2&B=3')
+        self.assertEqual(['C', 'A', 'B'], list(pairs.keys()))
+
+    def test_first_value_wins_for_duplicate_keys(self):
+        self.assertEqual('1', nvp.decode('A=1&A=2')['A'])
+
+    def test_multi_keeps_all_values(self):
+        self.assertEqual(['1', '2'], nvp.decode_multi('A=1&A=2')['A'])
+
+    def test_skips_blank_values(self):
+        self.assertFalse('A' in nvp.decode('A=&B=1'))
+
+    def test_keeps_blank_values_when_asked(self):
+        self.assertEqual('', nvp.decode('A=&B=1', keep_blank_values=True)['A'])
+
+    def test_decodes_utf8(self):
+        self.assertEqual(u'Zoë', nvp.decode(b'NAME=Zo%C3%AB')['NAME'])
+
+    def test_decodes_other_encodings(self):
+        self.assertEqual(u'Zoë', nvp.decode('NAME=Zo%EB',
+                                            encoding='windows-1252')['NAME'])
+
+    def test_decodes_escaped_newlines(self):
+        pairs = nvp.decode('NOTE=line+1%0Aline+2&AMT=6%2e99')
+        self.assertEqual('line 1\nline 2', pairs['NOTE'])
+        self.assertEqual('6.99', pairs['AMT'])
+
+    def test_decodes_keys_and_values_with_separators(self):
+        pairs = nvp.decode('A%3D1=B%263&C=%3D')
+        self.assertEqual('B&3', pairs['A=1'])
+        self.assertEqual('=', pairs['C'])
+
+    def test_length_tagged_values_can_contain_separators(self):
+        pairs = nvp.decode('RESULT=0&RESPMSG[14]=Approved&=Yes!&PNREF=V1',
+                           length_tagged=True)
+        self.assertEqual('Approved&=Yes!', pairs['RESPMSG'])
+        self.assertEqual('V1', pairs['PNREF'])
+
+    def test_length_tags_are_ignored_by_default(self):
+        self.assertTrue('RESPMSG[8]' in nvp.decode('RESPMSG[8]=Approved'))
+
+
+class TestEncode(TestCase):
+
+    def test_encodes_pairs_in_order(self):
+        self.assertEqual('B=x+y%26z&A=10',
+                         nvp.encode([('B', 'x y&z'), ('A', 10)]))
+
+    def test_matches_urlencode(self):
+        params = [('NAME', u'Zoë № 1'), ('AMT', D('6.99')), ('QTY', 1),
+                  ('DESC', 'A~b/c'), ('NOTE', 'plain-text_1.0')]
+        self.assertEqual(urlencode(params), nvp.encode(params))
+
+    def test_round_trip(self):
+        params = {'NAME': u'Zoë', 'AMT': '6.99'}
+        self.assertEqual(params, dict(nvp.decode(nvp.encode(params))))
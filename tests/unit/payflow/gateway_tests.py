@@ -1,9 +1,11 @@
 from decimal import Decimal as D
 
 from django.test import TestCase
+from django.test.utils import override_settings
 import mock
 
-from paypal.payflow import gateway
+from paypal import exceptions as paypal_exceptions
+from paypal.payflow import gateway, models
 
 
 class TestAuthorizeFunction(TestCase):
@@ -81,3 +83,152 @@ class TestReferenceTransaction(TestCase):
             gateway.reference_transaction(order_number='12345',
                                           pnref='111222',
                                           amt=D('12.23'))
+
+
+class TestEndpoint(TestCase):
+
+    def test_url_can_be_set_in_settings(self):
+        with override_settings(PAYPAL_PAYFLOW_URL='http://127.0.0.1:8765/payflow',
+                               PAYPAL_PAYFLOW_VENDOR_ID='vendor',
+                               PAYPAL_PAYFLOW_PASSWORD='secret'):
+            url, __ = gateway._build_request({'TRXTYPE': 'V', 'ORIGID': '1'})
+        self.assertEqual('http://127.0.0.1:8765/payflow', url)
+
+
+def approved_response(**extra):
+    pairs = {
+        'RESULT': '0',
+        'PNREF': 'V19R3EF62FE2',
+        'RESPMSG': 'Approved',
+        'AUTHCODE': '525PNI',
+        '_raw_request': '',
+        '_raw_response': 'RESULT=0&PNREF=V19R3EF62FE2&RESPMSG=Approved',
+        '_response_time': 100
+    }
+    pairs.update(extra)
+    return pairs
+
+
+@override_settings(PAYPAL_RETRIES=2, PAYPAL_RETRY_BACKOFF=0)
+@mock.patch('paypal.gateway.post')
+class TestRequestIds(TestCase):
+
+    def sale(self, card_number='4111111111111111', amt=D('10.00'),
+             **kwargs):
+        return gateway.sale(
+            order_number='100001', card_number=card_number,
+            cvv='123', expiry_date='1214', amt=amt, **kwargs)
+
+    def sale_params(self):
+        return {'COMMENT1': '100001', 'TRXTYPE': 'S', 'TENDER': 'C',
+                'AMT': '10.00', 'CURRENCY': 'USD',
+                'ACCT': '4111111111111111', 'EXPDATE': '1214', 'CVV2': '123'}
+
+    def sent_request_ids(self, mock_post):
+        return [call[0][2]['X-VPS-REQUEST-ID']
+                for call in mock_post.call_args_list]
+
+    def test_sends_request_id_derived_from_request_and_attempt(self,
+                                                              mock_post):
+        mock_post.return_value = approved_response()
+        txn = self.sale()
+        request_id = gateway.get_request_id(self.sale_params(), 1)
+        self.assertEqual([request_id], self.sent_request_ids(mock_post))
+        self.assertEqual(request_id, txn.request_id)
+
+    def test_retries_timeouts_with_the_same_request_id(self, mock_post):
+        mock_post.side_effect = [
+            paypal_exceptions.CommunicationError("Timed out"),
+            approved_response()]
+        txn = self.sale()
+        self.assertTrue(txn.is_approved)
+        first, second = self.sent_request_ids(mock_post)
+        self.assertEqual(first, second)
+        self.assertEqual(1, models.PayflowTransaction.objects.count())
+
+    def test_raises_once_retries_are_used_up(self, mock_post):
+        mock_post.side_effect = paypal_exceptions.CommunicationError(
+            "Timed out")
+        with self.assertRaises(paypal_exceptions.CommunicationError):
+            self.sale()
+        self.assertEqual(3, mock_post.call_count)
+        # A later attempt repeats the same request ID, as the outcome of the
+        # first is unknown
+        mock_post.side_effect = None
+        mock_post.return_value = approved_response()
+        self.sale()
+        self.assertEqual(1, len(set(self.sent_request_ids(mock_post))))
+
+    def test_uses_a_new_request_id_after_a_response(self, mock_post):
+        mock_post.return_value = approved_response(RESULT='12',
+                                                   RESPMSG='Declined')
+        self.sale()
+        mock_post.return_value = approved_response(PNREF='V19R3EF62FE3')
+        self.sale()
+        first, second = self.sent_request_ids(mock_post)
+        self.assertNotEqual(first, second)
+        self.assertEqual(gateway.get_request_id(self.sale_params(), 2),
+                         second)
+
+    def test_uses_a_new_request_id_when_the_request_changes(self,
+                                                           mock_post):
+        mock_post.side_effect = paypal_exceptions.CommunicationError(
+            "Timed out")
+        with self.assertRaises(paypal_exceptions.CommunicationError):
+            self.sale()
+        mock_post.side_effect = None
+        mock_post.return_value = approved_response()
+        self.sale(amt=D('12.00'))
+        self.sale(card_number='5555555555554444')
+        self.assertEqual(3, len(set(self.sent_request_ids(mock_post))))
+
+    def test_request_id_does_not_reveal_card_details(self, mock_post):
+        mock_post.return_value = approved_response()
+        txn = self.sale()
+        self.assertNotIn('4111', txn.request_id)
+        self.assertEqual(32, len(txn.request_id))
+
+    def test_maps_duplicates_to_the_original_transaction(self, mock_post):
+        mock_post.return_value = approved_response()
+        original = self.sale()
+        # As if another request with the same ID had raced this one
+        txn = gateway._handle_response(
+            {'TRXTYPE': 'S', 'COMMENT1': '100001'},
+            approved_response(DUPLICATE='1'), original.request_id)
+        self.assertEqual(original.id, txn.id)
+        self.assertEqual(1, models.PayflowTransaction.objects.count())
+
+    def test_records_duplicates_whose_original_was_lost(self, mock_post):
+        mock_post.return_value = approved_response(DUPLICATE='1')
+        txn = self.sale()
+        self.assertTrue(txn.is_approved)
+        self.assertEqual(1, models.PayflowTransaction.objects.count())
+
+    def test_returns_recorded_transaction_for_a_request_id(self, mock_post):
+        mock_post.return_value = approved_response()
+        original = self.sale()
+        txn = gateway._transaction(dict(self.sale_params(), AMT=D('10.00')),
+                                   request_id=original.request_id)
+        self.assertEqual(original.id, txn.id)
+        self.assertEqual(1, mock_post.call_count)
+
+    def test_rejects_request_id_recorded_for_another_transaction(
+            self, mock_post):
+        mock_post.return_value = approved_response()
+        original = self.sale()
+        with self.assertRaises(paypal_exceptions.PayPalError):
+            gateway._transaction(
+                {'TRXTYPE': 'V', 'ORIGID': 'V19R3EF62FE2',
+                 'COMMENT1': '100001'},
+                request_id=original.request_id)
+        with self.assertRaises(paypal_exceptions.PayPalError):
+            gateway._transaction(
+                dict(self.sale_params(), AMT=D('10.00'), COMMENT1='100002'),
+                request_id=original.request_id)
+        self.assertEqual(1, mock_post.call_count)
+
+    @override_settings(PAYPAL_PAYFLOW_TIMEOUT=5)
+    def test_timeout_can_be_set_in_settings(self, mock_post):
+        mock_post.return_value = approved_response()
+        self.sale()
+        self.assertEqual(5, mock_post.call_args[1]['timeout'])
@@ -0,0 +1,54 @@
+from django.contrib.sites.models import Site
+from django.core.urlresolvers import reverse
+from django.db.models import get_model
+from django.test import TestCase
+
+from paypal import refdata
+
+Country = get_model('address', 'Country')
+
+
+class TestCountries(TestCase):
+    fixtures = ['countries.json']
+
+    def setUp(self):
+        refdata.clear()
+
+    def test_country_is_only_queried_once(self):
+        country = refdata.get_country('GB')
+        with self.assertNumQueries(0):
+            self.assertEqual(country, refdata.get_country('GB'))
+
+    def test_unknown_country_raises_does_not_exist(self):
+        with self.assertRaises(Country.DoesNotExist):
+            refdata.get_country('XX')
+
+    def test_saving_a_country_clears_the_cache(self):
+        country = refdata.get_country('GB')
+        country.name = 'Great Britain'
+        country.save()
+        with self.assertNumQueries(1):
+            self.assertEqual('Great Britain', refdata.get_country('GB').name)
+
+
+class TestDomain(TestCase):
+
+    def setUp(self):
+        refdata.clear()
+
+    def test_saving_the_site_clears_the_cache(self):
+        refdata.get_domain()
+        site = Site.objects.get_current()
+        site.domain = 'shop.example.com'
+        site.save()
+        self.assertEqual('shop.example.com', refdata.get_domain())
+
+
+class TestPaths(TestCase):
+
+    def test_path_matches_reverse(self):
+        for name in ('paypal-success-response', 'paypal-cancel-response',
+                     'paypal-shipping-options'):
+            self.assertEqual(
+                reverse(name, kwargs={'basket_id': 42}),
+                refdata.get_path(name, 42))
@@ -0,0 +1,118 @@
+from decimal import Decimal as D
+
+from django.db import connection
+from django.db.models import get_model
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+from oscar.core.loading import get_class
+from oscar.test.factories import create_product
+
+from paypal import snapshot
+from paypal.adaptive import gateway as adaptive_gateway
+from paypal.express import gateway as express_gateway
+from paypal.express.models import ExpressTransaction
+
+Basket = get_model('basket', 'Basket')
+Selector = get_class('partner.strategy', 'Selector')
+
+
+def create_basket(num_lines):
+    basket = Basket.objects.create()
+    basket.strategy = Selector().strategy()
+    for index in range(num_lines):
+        product = create_product(price=D('12.99'),
+                                 upc='snapshot-%d-%d' % (num_lines, index))
+        basket.add_product(product, 1)
+    # Start from a fresh instance, as the checkout views do
+    basket = Basket.objects.get(id=basket.id)
+    basket.strategy = Selector().strategy()
+    return basket
+
+
+def count_queries(func, *args, **kwargs):
+    debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    start = len(connection.queries)
+    try:
+        func(*args, **kwargs)
+        return len(connection.queries) - start
+    finally:
+        connection.use_debug_cursor = debug_cursor
+
+
+class TestBasketSnapshot(TestCase):
+
+    def test_copies_line_details(self):
+        basket = create_basket(1)
+        line = snapshot.BasketSnapshot(basket).lines[0]
+        self.assertEqual('snapshot-1-0', line.upc)
+        self.assertEqual(D('12.99'), line.unit_price_incl_tax)
+        self.assertEqual(1, line.quantity)
+
+    def test_number_of_queries_does_not_depend_on_basket_size(self):
+        self.assertEqual(
+            count_queries(snapshot.BasketSnapshot, create_basket(1)),
+            count_queries(snapshot.BasketSnapshot, create_basket(10)))
+
+
+class TestDescriptions(TestCase):
+
+    def setUp(self):
+        self.product = create_product(price=D('12.99'))
+        self.product.description = '<p>A <em>good</em> book</p>'
+
+    def test_description_is_formatted(self):
+        self.assertEqual('A good book', snapshot.get_description(self.product))
+
+    def test_description_is_only_formatted_once(self):
+        snapshot.get_description(self.product)
+        with patch('paypal.snapshot.format_description') as format:
+            self.assertEqual('A good book',
+                             snapshot.get_description(self.product))
+        self.assertFalse(format.called)
+
+    def test_changed_description_is_formatted_again(self):
+        snapshot.get_description(self.product)
+        self.product.description = 'A bad book'
+        self.assertEqual('A bad book', snapshot.get_description(self.product))
+
+    def test_saving_a_product_forgets_its_description(self):
+        snapshot.get_description(self.product)
+        self.product.save()
+        with patch('paypal.snapshot.format_description') as format:
+            snapshot.get_description(self.product)
+        self.assertTrue(format.called)
+
+    @override_settings(PAYPAL_DESCRIPTION_CACHE_SIZE=1)
+    def test_cache_is_bounded(self):
+        other = create_product(price=D('12.99'))
+        other.description = 'Another book'
+        snapshot.get_description(self.product)
+        snapshot.get_description(other)
+        self.assertEqual(1, len(snapshot._get_description_cache()))
+
+
+@patch('paypal.express.gateway._fetch_response',
+       lambda method, params: ExpressTransaction(token='EC-8P797793UC466090M'))
+class TestSetTxnQueries(TestCase):
+
+    def set_txn(self, basket):
+        express_gateway.set_txn(basket, [], 'GBP', 'http://example.com/success',
+                                'http://example.com/cancel')
+
+    def test_number_of_queries_does_not_depend_on_basket_size(self):
+        self.assertEqual(count_queries(self.set_txn, create_basket(1)),
+                         count_queries(self.set_txn, create_basket(10)))
+
+
+@patch('paypal.adaptive.gateway._request', lambda action, params: None)
+class TestSetPaymentOptionQueries(TestCase):
+
+    def set_payment_option(self, basket):
+        adaptive_gateway.set_payment_option(basket, 'AP-1YB00520VE3843125')
+
+    def test_number_of_queries_does_not_depend_on_basket_size(self):
+        self.assertEqual(
+            count_queries(self.set_payment_option, create_basket(1)),
+            count_queries(self.set_payment_option, create_basket(10)))
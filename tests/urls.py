@@ -6,6 +6,8 @@ from oscar.app import application
 urlpatterns = patterns(
     '',
     url(r'^i18n/', include('django.conf.urls.i18n')),
+    # PayPal posts IPN messages without a language prefix
+    (r'^paypal/ipn/', include('paypal.ipn.urls')),
 )
 urlpatterns += i18n_patterns(
     '',